@@ -3,244 +3,1355 @@ import threading
 import json
 import time
 import os
+import secrets
+import signal
+import argparse
+import multiprocessing
 from enum import Enum
 from datetime import datetime
+from scheduler import TimerHeap
+from ban_store import BanStore
+from admission import AdmissionController, reject_connection
+from deferred_close import DeferredCloser
+from protocol import Encoder, WebSocketFrame, encode_move_turn, encode_player_table
+from concurrent.futures import ProcessPoolExecutor
+from rules import new_board, is_valid_move, check_win, board_from_moves, board_from_client_moves
+from gomoku_ai import search_best_move
+from analysis import Analyzer
+from game_clock import GameClock, parse_time_control
+from anticheat import AntiCheat
+from position_index import PositionIndex
+from player_store import PlayerStore, SQLiteBackend
+from matchmaking import Matchmaker
+from presence import Presence
+from traffic import TrafficRecorder
+from checkpoint import Checkpoint, load_clock
+from replay_service import ReplayService
+from websocket_gateway import HandshakeError, handshake, SPECTATOR_PAGE
 
 class PlayerRole(Enum):
     BLACK = 1
     WHITE = 2
     SPECTATOR = 3
 
-class GomokuServer:
-    def __init__(self, host='localhost', port=8888):
-        self.host = host
-        self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.clients = {}
+class AIConnection:
+    """占据玩家座位的服务器端AI，对服务器其余部分表现得像一个客户端socket"""
+
+    def __init__(self, server):
+        self.server = server
+        self.thinking = False
+
+    def send(self, data, flags=0):
+        return len(data)
+
+    def shutdown(self, how):
+        self.server.remove_client(self)
+
+    def close(self):
+        pass
+
+class GameTable:
+    """一张棋桌：一局棋的状态，以及坐在这张桌上的玩家、观战者和管理员
+
+    1号桌沿用原来先到先得的入座方式，匹配成功的玩家各自开一张新桌。
+    """
+
+    def __init__(self, server, table_id, persistent=False):
+        self.server = server
+        self.table_id = table_id
+        self.persistent = persistent
+        self.members = set()
         self.players = {}
         self.spectators = []
-        self.board = [[' ' for _ in range(15)] for _ in range(15)]
+        self.board = new_board()
         self.current_turn = PlayerRole.BLACK
         self.game_started = False
         self.move_history = []
         self.chat_history = []
         self.game_id = None
+        self.player_table = []
+        self.clock = None
+        self.clock_timer = None
+        self.turn_started = time.monotonic()
+        self.rated_players = None
+        self.held = {}
+        self.presence = Presence()
+        # 本桌的计时规则，None 表示沿用服务器默认；匹配开的桌取自双方的匹配请求
+        self.time_control = None
+
+    def taken_roles(self):
+        """已有人坐的座位，包括断线后还在保留期内的座位"""
+        return set(self.players.values()) | {held["role"] for held in self.held.values()}
+
+    def seat_name(self, role):
+        for sock, seat_role in list(self.players.items()):
+            if seat_role == role and sock in self.server.clients:
+                return self.server.clients[sock]["username"]
+        for username, held in list(self.held.items()):
+            if held["role"] == role:
+                return username
+        return None
+
+    def join(self, client_socket):
+        """先到先得：有空座就入座，否则观战。需要持有 server.lock"""
+        info = self.server.clients[client_socket]
+        username = info["username"]
+        info["table"] = self
+        self.members.add(client_socket)
+        if info["is_admin"]:
+            info["role"] = None
+            self.server.send_to(client_socket, {"type": "role", "role": "ADMIN", "username": username,
+                                                "table_id": self.table_id})
+            self.send_snapshot(client_socket)
+            self.send_presence(client_socket)
+            self.server.send_user_list(client_socket)
+            return None
+        taken = self.taken_roles()
+        if len(taken) < 2:
+            role = PlayerRole.BLACK if PlayerRole.BLACK not in taken else PlayerRole.WHITE
+            self.seat(client_socket, role)
+            if len(self.players) == 2:
+                self.start_game()
+                self.send_snapshot(client_socket)
+            elif self.server.ai_opponent:
+                self.server.scheduler.call_later(self.server.ai_wait, self.seat_ai_if_waiting)
+            return role
+        self.watch(client_socket)
+        return PlayerRole.SPECTATOR
+
+    def seat(self, client_socket, role):
+        info = self.server.clients[client_socket]
+        info["table"] = self
+        info["role"] = role
+        self.members.add(client_socket)
+        self.players[client_socket] = role
+        self.server.send_to(client_socket, {"type": "role", "role": role.name, "username": info["username"],
+                                            "table_id": self.table_id})
+        self.announce_join(client_socket, info, role.name)
+
+    def watch(self, client_socket):
+        info = self.server.clients[client_socket]
+        info["table"] = self
+        info["role"] = PlayerRole.SPECTATOR
+        self.members.add(client_socket)
+        self.spectators.append(client_socket)
+        self.server.send_to(client_socket, {"type": "role", "role": "SPECTATOR", "username": info["username"],
+                                            "table_id": self.table_id})
+        self.send_snapshot(client_socket)
+        self.announce_join(client_socket, info, "SPECTATOR")
+
+    def announce_join(self, client_socket, info, role_name):
+        """新成员先拿到含自己在内的名单快照，其他人收到带版本号的增量"""
+        entry = {"username": info["username"], "role": role_name, "address": info["address"],
+                 "rating": info.get("rating")}
+        version = self.presence.apply("add", entry)
+        self.send_presence(client_socket)
+        join_msg = {"type": "user_joined", "username": info["username"], "role": role_name,
+                    "address": info["address"], "rating": info.get("rating"), "version": version}
+        self.broadcast(join_msg, include_spectators=True)
+
+    def send_presence(self, client_socket):
+        for page in self.presence.pages(self.table_id):
+            self.server.send_to(client_socket, page)
+
+    def sync_presence(self, client_socket, since):
+        """客户端发现版本号跳号时补发增量，补不上就重发快照。需要持有 server.lock"""
+        events = self.presence.since(since) if isinstance(since, int) else None
+        if events is None:
+            self.send_presence(client_socket)
+        else:
+            self.server.send_to(client_socket, {"type": "presence", "table_id": self.table_id,
+                                                "version": self.presence.version, "events": events})
+
+    def leave(self, client_socket, username, close=True):
+        """把连接从桌上移走，close 为 False 时先不关空桌。需要持有 server.lock"""
+        self.members.discard(client_socket)
+        self.players.pop(client_socket, None)
+        if client_socket in self.spectators:
+            self.spectators.remove(client_socket)
+        version = self.presence.apply("remove", {"username": username})
+        self.broadcast({"type": "user_left", "username": username, "version": version}, include_spectators=True)
+        if close:
+            self.close_if_empty()
+
+    def close_if_empty(self):
+        if not self.persistent and not self.held and not any(
+                not isinstance(sock, AIConnection) for sock in self.members):
+            self.close()
+
+    def hold_seat(self, client_socket, info):
+        """对局中的玩家断线时保留座位，返回 False 表示不需要保留。需要持有 server.lock"""
+        grace = self.server.reconnect_grace
+        if (not grace or not self.game_started or client_socket not in self.players
+                or info.get("is_bot") or info.get("kicked")):
+            return False
+        username = info["username"]
+        role = self.players.pop(client_socket)
+        self.members.discard(client_socket)
+        self.held[username] = {
+            "role": role,
+            "since": time.time(),
+            "token": info.get("resume_token"),
+            "timer": self.server.scheduler.call_later(grace, self.release_seat, username, self.game_id)
+        }
+        self.server.held_seats[username] = self
+        version = self.presence.apply("update", {"username": username, "away": True})
+        self.broadcast({"type": "player_disconnected", "username": username, "grace": grace, "version": version},
+                       include_spectators=True)
+        return True
+
+    def resume_seat(self, client_socket, login_info):
+        """断线重连的玩家回到原座位，只补发断线期间错过的落子。需要持有 server.lock"""
+        info = self.server.clients[client_socket]
+        username = info["username"]
+        held = self.held.pop(username, None)
+        if held is None:
+            return False
+        held["timer"].cancel()
+        self.server.held_seats.pop(username, None)
+        role = held["role"]
+        info["table"] = self
+        info["role"] = role
+        self.members.add(client_socket)
+        self.players[client_socket] = role
+        self.server.send_to(client_socket, {"type": "role", "role": role.name, "username": username,
+                                            "table_id": self.table_id})
+
+        last_seq = login_info.get("last_seq")
+        if (self.game_started and login_info.get("game_id") == self.game_id
+                and isinstance(last_seq, int) and 0 <= last_seq <= len(self.move_history)):
+            if info["encoding"] == "compact":
+                client_socket.send(encode_player_table(self.player_table, info["compress"]))
+            resume_msg = {
+                "type": "resume",
+                "game_id": self.game_id,
+                "seq": len(self.move_history),
+                "moves": self.move_history[last_seq:],
+                "chats": [chat for chat in self.chat_history if chat["timestamp"] >= held["since"]],
+                "turn": "BLACK" if self.current_turn == PlayerRole.BLACK else "WHITE"
+            }
+            if self.clock:
+                resume_msg["clock"] = self.clock.snapshot()
+            self.server.send_to(client_socket, resume_msg)
+        else:
+            self.send_snapshot(client_socket)
+        version = self.presence.apply("update", {"username": username, "away": False})
+        self.send_presence(client_socket)
+        self.broadcast({"type": "player_reconnected", "username": username, "role": role.name, "version": version},
+                       include_spectators=True)
+        return True
+
+    def release_seat(self, username, game_id):
+        """保留期到了还没回来：对局仍在进行就判负，然后让出座位"""
+        server = self.server
+        with server.lock:
+            held = self.held.pop(username, None)
+            if held is None:
+                return
+            server.held_seats.pop(username, None)
+            server.release_username(username)
+            server.guest_sessions.pop(held["token"], None)
+            forfeit = self.game_started and self.game_id == game_id
+            version = self.presence.apply("remove", {"username": username})
+            self.broadcast({"type": "user_left", "username": username, "version": version}, include_spectators=True)
+        print(f"断线玩家未在保留期内重连: {username}")
+        if forfeit:
+            self.forfeit(held["role"], username)
+        with server.lock:
+            self.close_if_empty()
+
+    def restore(self, state, since):
+        """按检查点恢复一局棋，对局双方按断线处理保留座位，等客户端凭令牌重连。需要持有 server.lock"""
+        server = self.server
+        self.game_id = state["game_id"]
+        self.move_history = state["moves"]
+        self.board = board_from_moves(self.move_history)
+        self.current_turn = PlayerRole.BLACK if len(self.move_history) % 2 == 0 else PlayerRole.WHITE
+        self.chat_history = state["chats"]
+        self.player_table = state["player_table"]
+        self.rated_players = tuple(state["rated_players"]) if state["rated_players"] else None
+        self.game_started = True
+        self.turn_started = time.monotonic()
+        self.clock = load_clock(state["clock"])
+        self.time_control = state.get("time_control")
+        for role_name, seat in state["seats"].items():
+            role = PlayerRole[role_name]
+            username = seat["username"]
+            if seat["bot"]:
+                self.add_ai(role, username)
+                continue
+            server.claim_username(username)
+            if seat["token"]:
+                server.guest_sessions[seat["token"]] = username
+            self.held[username] = {
+                "role": role,
+                "since": since,
+                "token": seat["token"],
+                "timer": server.scheduler.call_later(server.reconnect_grace, self.release_seat, username, self.game_id)
+            }
+            server.held_seats[username] = self
+            self.presence.apply("add", {"username": username, "role": role.name, "address": "",
+                                        "rating": None, "away": True})
+        if self.clock:
+            self.schedule_flag_check()
+
+    def forfeit(self, loser_role, loser_name, reason="disconnect"):
+        """一方断线未归或中途离开（reason 为 "left"）时判负"""
+        winner_role = PlayerRole.WHITE if loser_role == PlayerRole.BLACK else PlayerRole.BLACK
+        winner_name = self.seat_name(winner_role) or "系统"
+        winner = "白棋" if winner_role == PlayerRole.WHITE else "黑棋"
+        cause = "离开了对局" if reason == "left" else "断线未归"
+        win_msg = {
+            "type": "game_over",
+            "winner": winner,
+            "winner_name": winner_name,
+            "reason": reason,
+            "message": f"{loser_name}{cause}，{winner}({winner_name})获胜!"
+        }
+        self.broadcast(win_msg, include_spectators=True)
+
+        self.save_game_replay(winner_name)
+        self.update_ratings(winner_role if self.seat_name(winner_role) else None)
+        self.reset_game()
+
+    def close(self):
+        if self.clock_timer:
+            self.clock_timer.cancel()
+            self.clock_timer = None
+        self.clock = None
+        self.game_started = False
+        for sock in list(self.members):
+            if isinstance(sock, AIConnection):
+                self.members.discard(sock)
+                info = self.server.clients.pop(sock, None)
+                if info:
+                    self.server.usernames.discard(info["username"])
+        self.server.tables.pop(self.table_id, None)
+
+    def summary(self):
+        names = {role.name: self.server.clients[sock]["username"]
+                 for sock, role in list(self.players.items()) if sock in self.server.clients}
+        return {
+            "table_id": self.table_id,
+            "black": names.get("BLACK"),
+            "white": names.get("WHITE"),
+            "game_started": self.game_started,
+            "moves": len(self.move_history),
+            "spectators": len(self.spectators)
+        }
+
+    def play_move(self, client_socket, role, x, y):
+        if role != self.current_turn:
+            error_msg = {"type": "error", "message": "还没轮到你下棋"}
+            self.server.send_to(client_socket, error_msg)
+            return
+
+        if not self.is_valid_move(x, y):
+            return
+        if self.clock and not self.clock.press():
+            self.handle_timeout(self.clock.flagged)
+            return
+
+        piece = 'B' if role == PlayerRole.BLACK else 'W'
+        info = self.server.clients[client_socket]
+        now = time.monotonic()
+        if not info.get("is_bot"):
+            self.server.anticheat.record_move(client_socket, info["username"], info["address"],
+                                              [row[:] for row in self.board], piece, x, y,
+                                              now - self.turn_started)
+        self.turn_started = now
+        self.board[x][y] = piece
+
+        move_record = {
+            "x": x,
+            "y": y,
+            "piece": piece,
+            "username": info["username"],
+            "timestamp": time.time()
+        }
+        self.move_history.append(move_record)
+
+        move_msg = {
+            "type": "move_made",
+            "x": x,
+            "y": y,
+            "piece": piece,
+            "username": info["username"]
+        }
+
+        if self.check_win(x, y):
+            self.broadcast_move(move_msg, None)
+            winner = "黑棋" if role == PlayerRole.BLACK else "白棋"
+            winner_name = info["username"]
+            win_msg = {
+                "type": "game_over",
+                "winner": winner,
+                "winner_name": winner_name,
+                "message": f"{winner}({winner_name})获胜!"
+            }
+            self.broadcast(win_msg, include_spectators=True)
+
+            self.save_game_replay(winner_name)
+            self.update_ratings(role)
+            self.reset_game()
+        else:
+            self.current_turn = PlayerRole.WHITE if self.current_turn == PlayerRole.BLACK else PlayerRole.BLACK
+            turn_msg = {"type": "turn", "turn": "BLACK" if self.current_turn == PlayerRole.BLACK else "WHITE"}
+            if self.clock:
+                turn_msg["clock"] = self.clock.snapshot()
+                self.schedule_flag_check()
+            self.broadcast_move(move_msg, turn_msg)
+            self.schedule_ai_move()
+            self.stream_analysis()
+
+    def chat(self, client_socket, text, role, is_admin):
+        username = self.server.clients[client_socket]["username"]
+
+        if is_admin:
+            user_role = "管理员"
+        else:
+            user_role = "黑棋" if role == PlayerRole.BLACK else "白棋" if role == PlayerRole.WHITE else "观战者"
+
+        chat_record = {
+            "username": username,
+            "role": user_role,
+            "message": text,
+            "timestamp": time.time(),
+            "audience": "spectators" if role == PlayerRole.SPECTATOR else "all"
+        }
+        self.chat_history.append(chat_record)
+
+        if role == PlayerRole.SPECTATOR and not is_admin:
+            chat_msg = {
+                "type": "chat",
+                "message": text,
+                "username": username,
+                "role": user_role,
+                "audience": "spectators"
+            }
+            self.server.send_to_many([spec for spec in self.spectators if spec != client_socket], chat_msg)
+        else:
+            chat_msg = {
+                "type": "chat",
+                "message": text,
+                "username": username,
+                "role": user_role,
+                "audience": "all"
+            }
+            self.broadcast(chat_msg, include_spectators=True)
+
+    def force_end(self, reason):
+        end_msg = {
+            "type": "game_force_end",
+            "message": f"管理员强制结束游戏，理由: {reason}",
+            "reason": reason
+        }
+        self.broadcast(end_msg, include_spectators=True)
+
+        self.save_game_replay("管理员强制结束")
+        self.reset_game()
+
+    def send_snapshot(self, client_socket):
+        info = self.server.clients[client_socket]
+        if info["encoding"] == "compact":
+            client_socket.send(encode_player_table(self.player_table, info["compress"]))
+        self.server.send_to(client_socket, {"type": "board", "board": self.board})
+        self.server.send_to(client_socket, {"type": "move_history", "history": self.move_history})
+        self.server.send_to(client_socket, {"type": "chat_history", "history": self.chat_history})
+        if self.game_started and self.clock:
+            turn = "BLACK" if self.current_turn == PlayerRole.BLACK else "WHITE"
+            self.server.send_to(client_socket, {"type": "turn", "turn": turn, "clock": self.clock.snapshot()})
+
+    def broadcast(self, message, include_spectators=False):
+        if include_spectators:
+            self.server.send_to_many(list(self.members), message)
+        else:
+            self.server.send_to_many(list(self.players.keys()), message)
+
+    def player_index(self, username):
+        if username not in self.player_table:
+            self.player_table.append(username)
+            table_data = {}
+            for sock in list(self.members):
+                info = self.server.clients.get(sock)
+                if info is None or info["encoding"] != "compact":
+                    continue
+                if info["compress"] not in table_data:
+                    table_data[info["compress"]] = encode_player_table(self.player_table, info["compress"])
+                try:
+                    sock.send(table_data[info["compress"]])
+                except:
+                    pass
+        return self.player_table.index(username)
+
+    def broadcast_move(self, move_msg, turn_msg):
+        """JSON客户端收到 move_made 和 turn 两条消息，紧凑编码客户端只收到一个合并帧"""
+        move_encoder = Encoder(move_msg)
+        turn_encoder = Encoder(turn_msg) if turn_msg else None
+        json_data = move_encoder.get("json") + (turn_encoder.get("json") if turn_msg else b"")
+        websocket_data = {}
+        compact_data = encode_move_turn(
+            move_msg["x"], move_msg["y"], self.player_index(move_msg["username"]),
+            move_msg["piece"], turn_msg["turn"] if turn_msg else None,
+            turn_msg.get("clock") if turn_msg else None)
+
+        for client in list(self.members):
+            info = self.server.clients.get(client)
+            if info is None:
+                continue
+            if info["encoding"] == "compact":
+                data = compact_data
+            elif info["encoding"] == "websocket":
+                # 两条消息各占一帧，帧负载复用上面已经编码好的 JSON
+                compress = info["compress"]
+                if compress not in websocket_data:
+                    websocket_data[compress] = WebSocketFrame(
+                        move_encoder.get("websocket", compress)
+                        + (turn_encoder.get("websocket", compress) if turn_msg else b""))
+                data = websocket_data[compress]
+            else:
+                data = json_data
+            try:
+                client.send(data)
+            except:
+                pass
+
+    def save_game_replay(self, winner):
+        if not self.game_id:
+            return
+
+        replay_data = {
+            "game_id": self.game_id,
+            "start_time": self.move_history[0]["timestamp"] if self.move_history else time.time(),
+            "end_time": time.time(),
+            "winner": winner,
+            "moves": self.move_history,
+            "board_size": 15
+        }
+
+        with open(f"replays/{self.game_id}.json", "w") as f:
+            json.dump(replay_data, f, indent=2)
+
+        chat_data = {
+            "game_id": self.game_id,
+            "chats": self.chat_history
+        }
+
+        with open(f"chat_logs/{self.game_id}.json", "w") as f:
+            json.dump(chat_data, f, indent=2)
+
+        self.server.replays.add(replay_data, chat_data)
+        print(f"已保存游戏回放: {self.game_id}")
+
+    def is_valid_move(self, x, y):
+        return is_valid_move(self.board, x, y)
+
+    def check_win(self, x, y):
+        return check_win(self.board, x, y)
+
+    def seat_ai_if_waiting(self):
+        if len(self.taken_roles()) == 1 and not self.game_started:
+            self.seat_ai()
+
+    def seat_ai(self):
+        server = self.server
+        with server.lock:
+            taken = self.taken_roles()
+            if len(taken) >= 2:
+                return None
+            role = PlayerRole.BLACK if PlayerRole.BLACK not in taken else PlayerRole.WHITE
+            username = self.add_ai(role)
+            if len(self.players) == 2:
+                self.start_game()
+        print(f"AI玩家已入座: {username} ({role.name}), 棋桌 {self.table_id}")
+        self.schedule_ai_move()
+        return username
+
+    def add_ai(self, role, username=None):
+        """创建一个AI连接坐到指定座位，需要持有 server.lock"""
+        server = self.server
+        conn = AIConnection(server)
+        user_id = f"user_{server.user_counter}"
+        username = username or f"AI_{server.user_counter}"
+        server.user_counter += 1
+        server.usernames.add(username)
+        server.clients[conn] = {
+            "username": username,
+            "user_id": user_id,
+            "role": role,
+            "address": "AI",
+            "is_admin": False,
+            "is_bot": True,
+            "last_seen": time.monotonic(),
+            "pinged": False,
+            "encoding": "json",
+            "compress": False,
+            "table": self
+        }
+        self.seat(conn, role)
+        return username
+
+    def schedule_ai_move(self):
+        if not self.game_started:
+            return
+        for conn, role in list(self.players.items()):
+            if role != self.current_turn or not isinstance(conn, AIConnection) or conn.thinking:
+                continue
+            if self.server.ai_pool is None:
+                # 用 spawn 启动工作进程：fork 出来的子进程会继承监听套接字和当时所有的客户端连接
+                self.server.ai_pool = ProcessPoolExecutor(max_workers=1,
+                                                          mp_context=multiprocessing.get_context("spawn"))
+            conn.thinking = True
+            board = [row[:] for row in self.board]
+            piece = 'B' if role == PlayerRole.BLACK else 'W'
+            expected = (self.game_id, len(self.move_history))
+            future = self.server.ai_pool.submit(search_best_move, board, piece, self.server.ai_time_limit)
+            future.add_done_callback(lambda f, conn=conn, role=role: self.on_ai_result(conn, role, expected, f))
+
+    def on_ai_result(self, conn, role, expected, future):
+        conn.thinking = False
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"AI搜索失败: {e}")
+            return
+
+        self.server.ai_stats = result
+        info = self.server.clients.get(conn)
+        if info is None or conn not in self.players:
+            return
+        print(f"{info['username']} 搜索深度 {result['depth']}, 节点 {result['nodes']}, "
+              f"速度 {result['nps']} 节点/秒, 用时 {result['elapsed']:.2f}秒")
+        # 搜索期间对局已结束或重开时丢弃结果
+        if (self.game_id, len(self.move_history)) != expected:
+            return
+        self.server.process_message(conn, {"type": "move", "x": result["x"], "y": result["y"]}, role, False)
+
+    def stream_analysis(self):
+        analyzer = self.server.analyzer
+        if analyzer is None:
+            return
+        game_id = self.game_id
+        move_number = len(self.move_history)
+        board = [row[:] for row in self.board]
+
+        def deliver(result):
+            # 对局已经往前走了就不再推送过期的分析
+            if self.game_id != game_id or len(self.move_history) != move_number:
+                return
+            analysis_msg = {"type": "analysis", "game_id": game_id, "move_number": move_number, "final": True}
+            analysis_msg.update(result)
+            self.server.send_to_many(self.analysis_audience(), analysis_msg)
+
+        audience = self.analysis_audience()
+        if not audience:
+            # 没有观众也没有管理员时不分析；之后有人进来从下一步开始推送
+            return
+        quick_msg = {"type": "analysis", "game_id": game_id, "move_number": move_number, "final": False}
+        quick_msg.update(analyzer.quick(board))
+        self.server.send_to_many(audience, quick_msg)
+        # 每张棋桌最多排一个局面，新的一步替换还没开始算的旧局面
+        analyzer.submit(board, deliver, slot=self.table_id)
+
+    def analysis_audience(self):
+        # 对局双方看不到分析结果，避免变成场外指导
+        audience = []
+        for sock in list(self.members):
+            info = self.server.clients.get(sock)
+            if info and (info["role"] == PlayerRole.SPECTATOR or info["is_admin"]):
+                audience.append(sock)
+        return audience
+
+    def start_game(self):
+        self.turn_started = time.monotonic()
+        self.game_started = True
+        self.game_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{self.server.table_key(self.table_id)}"
+        seated = {role: self.server.clients[sock] for sock, role in self.players.items()}
+        # 只有两名注册玩家之间的对局计入等级分，游客和AI不计
+        if all(info.get("registered") for info in seated.values()):
+            self.rated_players = (seated[PlayerRole.BLACK]["username"], seated[PlayerRole.WHITE]["username"])
+        else:
+            self.rated_players = None
+        start_msg = {"type": "game_start", "message": "游戏开始! 黑棋先行", "game_id": self.game_id}
+        time_control = self.time_control if self.time_control is not None else self.server.time_control
+        if time_control:
+            self.clock = GameClock(**time_control)
+            self.clock.start("BLACK")
+            self.schedule_flag_check()
+            start_msg["clock"] = self.clock.snapshot()
+        self.broadcast(start_msg, include_spectators=True)
+
+    def schedule_flag_check(self):
+        # 所有对局的棋钟共用服务器的定时堆，每局同一时刻只有一个待触发的超时检查
+        if self.clock_timer:
+            self.clock_timer.cancel()
+        expected = (self.game_id, len(self.move_history))
+        self.clock_timer = self.server.scheduler.call_at(self.clock.deadline(), self.on_flag, expected)
+
+    def on_flag(self, expected):
+        if self.clock is None or (self.game_id, len(self.move_history)) != expected:
+            return
+        side = self.clock.running
+        if self.clock.time_left(side) > 0:
+            self.schedule_flag_check()
+            return
+        self.clock.flagged = side
+        self.handle_timeout(side)
+
+    def handle_timeout(self, side):
+        loser_role = PlayerRole[side]
+        loser_name = self.seat_name(loser_role) or "未知"
+        winner_role = PlayerRole.WHITE if loser_role == PlayerRole.BLACK else PlayerRole.BLACK
+        winner_name = self.seat_name(winner_role) or "系统"
+        winner = "白棋" if loser_role == PlayerRole.BLACK else "黑棋"
+        win_msg = {
+            "type": "game_over",
+            "winner": winner,
+            "winner_name": winner_name,
+            "reason": "timeout",
+            "message": f"{loser_name}超时，{winner}({winner_name})获胜!"
+        }
+        self.broadcast(win_msg, include_spectators=True)
+
+        self.save_game_replay(winner_name)
+        self.update_ratings(winner_role if self.seat_name(winner_role) else None)
+        self.reset_game()
+
+    def update_ratings(self, winner_role):
+        """winner_role 为获胜一方；胜方座位已经空了（为 None）时这局不计分"""
+        if not self.rated_players:
+            return
+        black, white = self.rated_players
+        self.rated_players = None
+        if winner_role is None:
+            return
+        winner = 'B' if winner_role == PlayerRole.BLACK else 'W'
+        ratings = self.server.player_store.record_result(black, white, winner)
+        if not ratings:
+            return
+        for info in list(self.server.clients.values()):
+            if info["username"] in ratings and info.get("registered"):
+                info["rating"] = ratings[info["username"]]
+        self.broadcast({"type": "ratings", "ratings": ratings}, include_spectators=True)
+
+    def reset_game(self):
+        if self.clock_timer:
+            self.clock_timer.cancel()
+            self.clock_timer = None
+        self.clock = None
+        self.rated_players = None
+        self.board = new_board()
+        self.current_turn = PlayerRole.BLACK
+        self.game_started = False
+        self.move_history = []
+        self.chat_history = []
+        self.player_table = []
+        self.game_id = None
+        self.broadcast({"type": "board", "board": self.board}, include_spectators=True)
+
+        # 与AI对局结束后直接开始下一局
+        if len(self.players) == 2 and any(isinstance(conn, AIConnection) for conn in self.players):
+            self.start_game()
+            self.schedule_ai_move()
+
+class GomokuServer:
+    def __init__(self, host='localhost', port=8888, backlog=128,
+                 conn_rate=2, conn_burst=10, global_conn_rate=200, global_conn_burst=400,
+                 handshake_timeout=10, idle_timeout=60, reap_interval=5,
+                 ai_opponent=False, ai_wait=30, ai_time_limit=2.0, analysis=False,
+                 time_control=None, position_index="positions.idx", player_store=None,
+                 matchmaking=None, reconnect_grace=60, node_id=None, persist_bans=True,
+                 websocket_port=None, capture_dir=None, checkpoint=None, checkpoint_interval=5,
+                 replay_cache=256, archive_dir="archive"):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.ai_opponent = ai_opponent
+        self.ai_wait = ai_wait
+        self.ai_time_limit = ai_time_limit
+        self.ai_pool = None
+        self.ai_stats = None
+        self.analyzer = Analyzer() if analysis else None
+        # 默认不计时，None 表示不启用棋钟
+        self.time_control = time_control
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # 启用检查点时新旧进程要能同时绑定同一端口，才能平滑重启
+        self.checkpoint = Checkpoint(checkpoint) if checkpoint else None
+        self.checkpoint_interval = checkpoint_interval
+        self.reuse_port = bool(checkpoint) and hasattr(socket, "SO_REUSEPORT")
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.websocket_socket = None
+        self.stopping = False
+        self.clients = {}
         self.lock = threading.Lock()
         self.user_counter = 0
-        self.banned_ips = self.load_banned_ips()
+        self.scheduler = TimerHeap()
+        self.ban_store = BanStore(self.scheduler) if persist_bans else BanStore(self.scheduler, None, None)
+        self.admission = AdmissionController(self.ban_store, global_conn_rate, global_conn_burst,
+                                             conn_rate, conn_burst)
         self.usernames = set()
-        self.last_move_time = {}
-        
+        self.anticheat = AntiCheat(self.on_cheat_alert, self.on_cheat_ban)
+        self.closer = DeferredCloser()
+        self.position_index_path = position_index
+        self.position_index = self.load_position_index()
+        self.player_store = player_store or PlayerStore(SQLiteBackend("players.db"))
+        self.matchmaker = Matchmaker(**(matchmaking or {}))
+        self.reconnect_grace = reconnect_grace
+        self.websocket_port = websocket_port
+        # 录制模式：把每个连接收到的原始数据带时间戳记下来，用 traffic.py 回放
+        self.recorder = TrafficRecorder(capture_dir) if capture_dir else None
+        self.held_seats = {}
+        self.guest_sessions = {}
+        # 集群里跨进程配对时，对手转到本进程之前用的一次性令牌
+        self.transfers = {}
+        self.transfer_timeout = 15
+        # 集群部署时由 cluster.py 设置：node_id 区分各工作进程的对局ID，cluster 是通往前端的控制通道
+        self.node_id = node_id
+        self.cluster = None
+        self.table_counter = 1
+        self.main_table = GameTable(self, 1, persistent=True)
+        self.tables = {1: self.main_table}
+        self.replays = ReplayService(archive_dir=archive_dir, capacity=replay_cache)
+
         if not os.path.exists("replays"):
             os.makedirs("replays")
         if not os.path.exists("chat_logs"):
             os.makedirs("chat_logs")
 
-    def load_banned_ips(self):
+    def load_position_index(self):
+        if not self.position_index_path or not os.path.exists(self.position_index_path):
+            return None
         try:
-            if os.path.exists("banned.json"):
-                with open("banned.json", "r") as f:
-                    banned_data = json.load(f)
-                    if isinstance(banned_data, list):
-                        return banned_data
-                    else:
-                        return list(banned_data.keys())
-            else:
-                with open("banned.json", "w") as f:
-                    json.dump([], f)
-                return []
+            index = PositionIndex(self.position_index_path)
+            print(f"已加载局面索引: {len(index.game_ids)} 局对局")
+            return index
         except Exception as e:
-            print(f"加载封禁列表失败: {e}")
-            return []
-
-    def save_banned_ips(self):
-        try:
-            with open("banned.json", "w") as f:
-                json.dump(self.banned_ips, f)
-        except Exception as e:
-            print(f"保存封禁列表失败: {e}")
+            print(f"加载局面索引失败: {e}")
+            return None
 
     def is_ip_banned(self, ip):
-        return ip in self.banned_ips
+        return self.ban_store.is_banned(ip)
 
     def ban_ip(self, ip, duration_minutes=10):
-        if ip not in self.banned_ips:
-            self.banned_ips.append(ip)
-            self.save_banned_ips()
-            print(f"已封禁IP: {ip}, 时长: {duration_minutes}分钟")
-            
-            timer = threading.Timer(duration_minutes * 60, self.unban_ip, [ip])
-            timer.daemon = True
-            timer.start()
+        key = self.ban_store.ban(ip, duration_minutes * 60)
+        if key:
+            print(f"已封禁IP: {key}, 时长: {duration_minutes}分钟")
+        return key
+
+    def ban_ips(self, targets, duration_minutes=10):
+        keys = self.ban_store.ban_many(targets, duration_minutes * 60)
+        print(f"已批量封禁 {sum(1 for key in keys if key)} 个IP/网段, 时长: {duration_minutes}分钟")
+        return keys
 
     def unban_ip(self, ip):
-        if ip in self.banned_ips:
-            self.banned_ips.remove(ip)
-            self.save_banned_ips()
+        if self.ban_store.unban(ip):
             print(f"已解封IP: {ip}")
+            return True
+        return False
+
+    def table_key(self, table_id):
+        return table_id if self.node_id is None else f"n{self.node_id}-{table_id}"
+
+    def table_for_game(self, game_id):
+        if not game_id:
+            return None
+        for table in list(self.tables.values()):
+            if table.game_id == game_id:
+                return table
+        return None
+
+    def schedule_maintenance(self):
+        self.scheduler.call_every(self.reap_interval, self.reap_idle_clients)
+        self.scheduler.call_every(self.matchmaker.widen_interval, self.match_tick)
+        if self.recorder:
+            self.scheduler.call_every(1.0, self.recorder.flush)
+        if self.checkpoint:
+            self.scheduler.call_every(self.checkpoint_interval, self.save_checkpoint)
+        # 打包任务在别的进程里跑，定时重新加载有变化的归档索引
+        self.scheduler.call_every(60, self.replays.refresh)
+
+    def save_checkpoint(self):
+        try:
+            self.checkpoint.save(self)
+        except Exception as e:
+            print(f"保存检查点失败: {e}")
 
-    def start(self):
+    def restore_checkpoint(self):
+        try:
+            meta, states = self.checkpoint.load()
+        except Exception as e:
+            print(f"读取检查点失败: {e}")
+            return
+        if meta is None:
+            return
+        restored = []
+        with self.lock:
+            self.table_counter = max(self.table_counter, meta["table_counter"])
+            self.user_counter = max(self.user_counter, meta["user_counter"])
+            self.guest_sessions.update(meta["guest_sessions"])
+            for state in states:
+                table = self.tables.get(state["table_id"]) or GameTable(self, state["table_id"])
+                self.tables[table.table_id] = table
+                table.restore(state, time.time())
+                restored.append(table)
+        for table in restored:
+            table.schedule_ai_move()
+        print(f"已从检查点恢复 {len(restored)} 局对局，等待玩家重连")
+
+    def wait_for_handoff(self, timeout=10):
+        """平滑重启：通知旧进程交接，等它写完最后一次检查点。找不到可接管的旧进程时返回 False"""
+        server_meta = self.checkpoint.meta("server")
+        pid = json.loads(server_meta)["pid"] if server_meta else None
+        if not pid or pid == os.getpid():
+            print("检查点里没有记录旧进程，无法接管")
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            print(f"旧进程 {pid} 已不在运行，无法接管: {e}")
+            return False
+        try:
+            os.kill(pid, signal.SIGUSR2)
+        except OSError as e:
+            print(f"无法通知旧进程 {pid}: {e}")
+            return False
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.checkpoint.meta("handoff") == str(pid):
+                print(f"旧进程 {pid} 已完成交接")
+                return True
+            time.sleep(0.01)
+        print(f"等待旧进程 {pid} 交接超时，加载最近一次检查点")
+        return True
+
+    def on_restart_signal(self, signum, frame):
+        # 只让 accept 失败退出主循环，交接在主线程里做
+        self.stopping = True
+        for sock in (self.server_socket, self.websocket_socket):
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def hand_off(self):
+        """停止接受连接后写最后一次检查点，通知客户端尽快重连到新进程"""
+        print("收到重启信号，已停止接受新连接，正在交接")
+        self.player_store.flush()
+        with self.lock:
+            self.checkpoint.save(self, handoff=True)
+            clients = [sock for sock, info in self.clients.items() if not info.get("is_bot")]
+        self.send_to_many(clients, {"type": "server_restart", "message": "服务器正在重启，马上自动重连",
+                                    "retry_after": 0.2})
+        for sock in clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_socket.close()
+        print(f"交接完成，已断开 {len(clients)} 个连接")
+
+    def serve_client(self, client_socket, addr):
+        print(f"新连接: {addr}")
+        client_handler = threading.Thread(target=self.handle_client, args=(client_socket, addr))
+        client_handler.daemon = True
+        client_handler.start()
+
+    def client_encoding(self, client_socket, login_info):
+        if getattr(client_socket, "websocket", False):
+            return "websocket"
+        return "compact" if login_info.get("encoding") == "compact" else "json"
+
+    def serve_websocket(self):
+        """WebSocket 端口：普通 GET 返回网页观战页面，升级请求完成握手后与 TCP 连接走同一个 handle_client"""
+        ws_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        ws_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            ws_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ws_socket.bind((self.host, self.websocket_port))
+        ws_socket.listen(self.backlog)
+        self.websocket_socket = ws_socket
+        print(f"WebSocket 网关已启动，监听地址: {self.host}:{self.websocket_port}")
+        while not self.stopping:
+            try:
+                client_socket, addr = ws_socket.accept()
+            except OSError:
+                if self.stopping:
+                    break
+                raise
+            reason = self.admission.admit(addr[0])
+            if reason:
+                client_socket.close()
+                continue
+            threading.Thread(target=self.accept_websocket, args=(client_socket, addr), daemon=True).start()
+
+    def accept_websocket(self, client_socket, addr):
+        try:
+            client_socket.settimeout(self.handshake_timeout)
+            connection = handshake(client_socket, SPECTATOR_PAGE)
+        except (HandshakeError, OSError) as e:
+            print(f"WebSocket 握手失败 {addr}: {e}")
+            client_socket.close()
+            return
+        print(f"新的 WebSocket 连接: {addr}")
+        self.handle_client(connection, addr)
+
+    def start(self, takeover=False):
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
+        if self.checkpoint:
+            # 已经在监听，新连接先排在队列里，等检查点加载完再 accept
+            if takeover and not self.wait_for_handoff():
+                # 没有旧进程交接就退出，免得两个进程监听同一端口；直接启动请去掉 --takeover
+                self.server_socket.close()
+                return
+            self.restore_checkpoint()
+            if hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGUSR2, self.on_restart_signal)
+            # accept 之前先写一次检查点记下本进程 pid，刚启动就被接管也能收到交接信号
+            self.save_checkpoint()
         print(f"服务器已启动，监听地址: {self.host}:{self.port}")
+        self.schedule_maintenance()
+        if self.websocket_port:
+            threading.Thread(target=self.serve_websocket, name="websocket-gateway", daemon=True).start()
 
         while True:
-            client_socket, addr = self.server_socket.accept()
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except OSError:
+                if self.stopping:
+                    break
+                raise
             client_ip = addr[0]
-            
-            if self.is_ip_banned(client_ip):
-                print(f"拒绝被封禁IP的连接: {client_ip}")
-                try:
-                    ban_msg = {"type": "banned", "message": "您的IP已被封禁，无法连接服务器"}
-                    client_socket.send(json.dumps(ban_msg).encode())
-                    time.sleep(1)
-                except:
-                    pass
-                client_socket.close()
+
+            reason = self.admission.admit(client_ip)
+            if reason:
+                reject_connection(client_socket, client_ip, reason)
                 continue
-                
-            print(f"新连接: {addr}")
-            client_handler = threading.Thread(target=self.handle_client, args=(client_socket, addr))
-            client_handler.daemon = True
-            client_handler.start()
+
+            self.serve_client(client_socket, addr)
+        self.hand_off()
+
+    def login_account(self, login_info):
+        """按会话令牌或密码登录，带 register 的注册新账号，返回账号；未注册且没带密码的按游客处理返回 None；
+        失败返回错误信息"""
+        if login_info.get("token"):
+            account = self.player_store.resume(login_info["token"])
+            if account is None:
+                return "登录已过期，请重新输入密码"
+            return account
+        username = login_info["username"]
+        if login_info.get("password"):
+            try:
+                if login_info.get("register"):
+                    return self.player_store.register(username, login_info["password"])
+                return self.player_store.authenticate(username, login_info["password"])
+            except ValueError as e:
+                return str(e)
+        if self.player_store.exists(username):
+            return "该用户名已注册，请输入密码"
+        return None
 
     def handle_client(self, client_socket, addr):
         client_ip = addr[0]
-        
+        username = None
+        if self.recorder:
+            client_socket = self.recorder.wrap(client_socket, addr)
+
         try:
+            client_socket.settimeout(self.handshake_timeout)
             data = client_socket.recv(1024).decode()
             login_info = json.loads(data)
-            
+
             if login_info["type"] != "login" or "username" not in login_info:
                 client_socket.send(json.dumps({"type": "error", "message": "请先发送用户名"}).encode())
                 client_socket.close()
                 return
-                
-            username = login_info["username"]
-            is_admin = login_info.get("is_admin", False)
-            
+
+            # 集群里跨进程配对的玩家凭前端发的一次性令牌转到本进程
+            transfer = self.claim_transfer(login_info)
+            if transfer:
+                account = self.player_store.get(transfer["username"]) if transfer["registered"] else None
+                guest_name = None if account else transfer["username"]
+            else:
+                guest_name = self.guest_sessions.get(login_info.get("token"))
+                account = None if guest_name else self.login_account(login_info)
+            if isinstance(account, str):
+                client_socket.send(json.dumps({"type": "error", "message": account}).encode())
+                client_socket.close()
+                return
+            username = account["username"] if account else guest_name or login_info["username"]
+            # 管理员身份只看账号，不再相信客户端自报的 is_admin
+            is_admin = bool(account and account["is_admin"])
+            if login_info.get("is_admin") and not is_admin:
+                client_socket.send(json.dumps({"type": "error", "message": "该账号没有管理员权限"}).encode())
+                client_socket.close()
+                return
+
+            # 凭令牌或密码登录的可以顶掉自己还没被发现断开的旧连接，并取回保留的座位
+            authenticated = account is not None or guest_name is not None
+            if authenticated:
+                self.take_over(username)
             with self.lock:
-                if username in self.usernames:
+                resume_table = self.held_seats.get(username) if authenticated else None
+                if username in self.usernames and resume_table is None:
                     client_socket.send(json.dumps({"type": "error", "message": "用户名已存在，请选择其他用户名"}).encode())
                     client_socket.close()
                     return
-                
-                self.usernames.add(username)
-                
+
+                self.claim_username(username)
+
+            client_socket.settimeout(None)
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             user_id = f"user_{self.user_counter}"
             self.user_counter += 1
-            
+
             with self.lock:
                 self.clients[client_socket] = {
                     "username": username,
                     "user_id": user_id,
                     "role": None,
                     "address": client_ip,
-                    "is_admin": is_admin
+                    "is_admin": is_admin,
+                    "last_seen": time.monotonic(),
+                    "pinged": False,
+                    "encoding": self.client_encoding(client_socket, login_info),
+                    "compress": (client_socket.deflate if getattr(client_socket, "websocket", False)
+                                 else login_info.get("compression") == "zlib"),
+                    "registered": account is not None,
+                    "relay": bool(login_info.get("relay")),
+                    "rating": round(account["rating"]) if account else None,
+                    "table": None
                 }
-            
+            if account:
+                session_msg = {"type": "session", "username": username,
+                               "token": self.player_store.create_session(username),
+                               "rating": round(account["rating"])}
+            else:
+                # 游客的令牌只在内存里，用于断线重连
+                token = guest_name and login_info["token"] or secrets.token_urlsafe(24)
+                self.guest_sessions[token] = username
+                self.clients[client_socket]["resume_token"] = token
+                session_msg = {"type": "session", "username": username, "token": token, "rating": None}
+            self.send_to(client_socket, session_msg)
+
+            # 要求匹配的客户端先在1号桌观战，配对成功后再移到新桌
+            matching = False
             with self.lock:
-                if len(self.players) < 2 and not is_admin:
-                    if len(self.players) == 0:
-                        role = PlayerRole.BLACK
-                        self.players[client_socket] = role
-                        welcome_msg = {"type": "role", "role": "BLACK", "username": username}
-                    else:
-                        role = PlayerRole.WHITE
-                        self.players[client_socket] = role
-                        welcome_msg = {"type": "role", "role": "WHITE", "username": username}
-                        self.game_started = True
-                        self.game_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    
-                    self.clients[client_socket]["role"] = role
-                    self.last_move_time[client_socket] = 0
-                    client_socket.send(json.dumps(welcome_msg).encode())
-                    
-                    join_msg = {"type": "user_joined", "username": username, "role": role.name, "address": client_ip}
-                    self.broadcast(join_msg, include_spectators=True)
-                    
-                    if self.game_started:
-                        self.broadcast({"type": "game_start", "message": "游戏开始! 黑棋先行"}, include_spectators=True)
-                        client_socket.send(json.dumps({"type": "board", "board": self.board}).encode())
-                        client_socket.send(json.dumps({"type": "move_history", "history": self.move_history}).encode())
-                        client_socket.send(json.dumps({"type": "chat_history", "history": self.chat_history}).encode())
+                game_table = self.table_for_game(login_info.get("game_id"))
+                if resume_table is not None and resume_table.resume_seat(client_socket, login_info):
+                    pass
+                elif transfer:
+                    # 先在1号桌观战，和等在本进程的对手开新桌
+                    self.main_table.watch(client_socket)
+                    self.clients[client_socket].update(matching=True, time_control=transfer["time_control"])
+                elif game_table is not None and not is_admin:
+                    # 带着对局ID登录的直接去观战那一局
+                    game_table.watch(client_socket)
+                elif login_info.get("relay") or login_info.get("spectate"):
+                    # 转发节点是只读订阅者，永远不入座；spectate 是只想观战的客户端（如网页）
+                    self.main_table.watch(client_socket)
+                elif login_info.get("matchmaking") and not is_admin:
+                    self.main_table.watch(client_socket)
+                    matching = True
                 else:
-                    if is_admin:
-                        role = None
-                        welcome_msg = {"type": "role", "role": "ADMIN", "username": username}
-                        client_socket.send(json.dumps(welcome_msg).encode())
-                        
-                        client_socket.send(json.dumps({"type": "board", "board": self.board}).encode())
-                        client_socket.send(json.dumps({"type": "move_history", "history": self.move_history}).encode())
-                        client_socket.send(json.dumps({"type": "chat_history", "history": self.chat_history}).encode())
-                        
-                        self.send_user_list(client_socket)
-                    else:
-                        role = PlayerRole.SPECTATOR
-                        self.spectators.append(client_socket)
-                        self.clients[client_socket]["role"] = role
-                        welcome_msg = {"type": "role", "role": "SPECTATOR", "username": username}
-                        client_socket.send(json.dumps(welcome_msg).encode())
-                        client_socket.send(json.dumps({"type": "board", "board": self.board}).encode())
-                        client_socket.send(json.dumps({"type": "move_history", "history": self.move_history}).encode())
-                        client_socket.send(json.dumps({"type": "chat_history", "history": self.chat_history}).encode())
-                        
-                        join_msg = {"type": "user_joined", "username": username, "role": "SPECTATOR", "address": client_ip}
-                        self.broadcast(join_msg, include_spectators=True)
-        
+                    self.main_table.join(client_socket)
+            if transfer:
+                self.start_match(transfer["opponent"], client_socket)
+            elif matching:
+                self.find_match(client_socket, login_info.get("time_control"))
+
         except Exception as e:
             print(f"登录错误: {e}")
             with self.lock:
                 if username in self.usernames:
-                    self.usernames.remove(username)
+                    self.release_username(username)
+                info = self.clients.pop(client_socket, None)
+                if info and info["table"]:
+                    info["table"].leave(client_socket, username)
             client_socket.close()
             return
-        
+
+        client_info = self.clients[client_socket]
+        if client_info["table"]:
+            client_info["table"].schedule_ai_move()
         buffer = ""
         try:
             while True:
                 data = client_socket.recv(1024).decode()
                 if not data:
                     break
-                
+
+                client_info["last_seen"] = time.monotonic()
+                client_info["pinged"] = False
                 buffer += data
                 while buffer:
                     try:
                         message, idx = self.parse_json(buffer)
                         buffer = buffer[idx:]
-                        
+
                         role = self.clients[client_socket]["role"]
                         is_admin = self.clients[client_socket]["is_admin"]
                         self.process_message(client_socket, message, role, is_admin)
-                        
+
                     except json.JSONDecodeError:
                         break
                     except ValueError:
                         buffer = ""
                         break
-                        
+
         except Exception as e:
             print(f"客户端错误: {e}")
         finally:
-            with self.lock:
-                username = self.clients[client_socket]["username"]
-                if username in self.usernames:
-                    self.usernames.remove(username)
-                    
-                if client_socket in self.players:
-                    del self.players[client_socket]
-                if client_socket in self.spectators:
-                    self.spectators.remove(client_socket)
-                if client_socket in self.clients:
-                    del self.clients[client_socket]
-                if client_socket in self.last_move_time:
-                    del self.last_move_time[client_socket]
+            self.remove_client(client_socket)
+
+    def remove_client(self, client_socket):
+        self.leave_queue(client_socket)
+        with self.lock:
+            client_info = self.clients.pop(client_socket, None)
+            if client_info is None:
                 client_socket.close()
-                
-                leave_msg = {"type": "user_left", "username": username}
-                self.broadcast(leave_msg, include_spectators=True)
-                print(f"客户端断开连接: {username}")
+                return
+            username = client_info["username"]
+            table = client_info["table"]
+            self.anticheat.forget(client_socket)
+            client_socket.close()
+            if table and table.hold_seat(client_socket, client_info):
+                print(f"玩家断线，保留座位 {self.reconnect_grace} 秒: {username}")
+                return
+            if username in self.usernames:
+                self.release_username(username)
+            self.guest_sessions.pop(client_info.get("resume_token"), None)
+
+            # 被踢或不保留座位时，对局中的一方离开按判负结束这局，不留给下一个入座的人接着下
+            role = table.players.get(client_socket) if table else None
+            forfeit = role is not None and table.game_started
+            game_id = table.game_id if forfeit else None
+            if table:
+                table.leave(client_socket, username, close=not forfeit)
+            print(f"客户端断开连接: {username}")
+        if forfeit:
+            if table.game_started and table.game_id == game_id:
+                table.forfeit(role, username, "left")
+            with self.lock:
+                table.close_if_empty()
+
+    def claim_username(self, username):
+        """登记在线用户名，集群部署时告诉前端，同名的登录都路由到本进程。需要持有 server.lock"""
+        self.usernames.add(username)
+        if self.cluster:
+            self.cluster.notify("online", username=username)
+
+    def release_username(self, username):
+        self.usernames.discard(username)
+        if self.cluster:
+            self.cluster.notify("offline", username=username)
+
+    def claim_transfer(self, login_info):
+        """取走登录消息里的转入令牌，用户名对不上的作废。返回转入信息或 None"""
+        token = login_info.get("token")
+        if not isinstance(token, str):
+            return None
+        with self.lock:
+            transfer = self.transfers.pop(token, None)
+        if transfer is None:
+            return None
+        transfer["timer"].cancel()
+        return transfer if transfer["username"] == login_info["username"] else None
+
+    def find_client(self, username):
+        for sock, info in list(self.clients.items()):
+            if info["username"] == username and not info.get("is_bot"):
+                return sock
+        return None
+
+    def on_cluster_match(self, match):
+        """前端的匹配队列配成一对后通知的结果"""
+        if "transfer" in match:
+            self.transfer_player(match)
+        elif "token" in match:
+            self.host_match(match)
+        else:
+            self.start_match(self.find_client(match["first"]), self.find_client(match["second"]))
+
+    def host_match(self, match):
+        """对手在别的进程：在本进程等对手凭令牌转过来再开桌，告诉前端能不能接"""
+        first = self.find_client(match["first"])
+        with self.lock:
+            ok = first is not None and self.clients[first].get("matching") and not self.in_running_game(first)
+            if ok:
+                self.transfers[match["token"]] = {
+                    "username": match["second"],
+                    "opponent": first,
+                    "registered": match["registered"],
+                    "time_control": match["time_control"],
+                    "timer": self.scheduler.call_later(self.transfer_timeout, self.expire_transfer, match["token"])
+                }
+        self.cluster.notify("hosting", token=match["token"], ok=bool(ok))
+
+    def expire_transfer(self, token):
+        with self.lock:
+            transfer = self.transfers.pop(token, None)
+            if transfer is None:
+                return
+            opponent = transfer["opponent"]
+            if opponent in self.clients and self.clients[opponent].get("matching"):
+                # 对手没能转过来，等着的一方重新排队
+                print(f"匹配的对手未能转入: {transfer['username']}")
+                self.enqueue_match(opponent)
+
+    def transfer_player(self, match):
+        """让本进程的玩家带着令牌重连，前端会把这次登录交给开桌的进程"""
+        sock = self.find_client(match["transfer"])
+        with self.lock:
+            if sock is None or not self.clients[sock].pop("matching", False) or self.in_running_game(sock):
+                return
+            transfer_msg = {"type": "match_status", "status": "transfer", "token": match["token"],
+                            "opponent": match["opponent"], "opponent_rating": match["opponent_rating"]}
+            data = self.encode_for(sock, Encoder(transfer_msg))
+        self.closer.close(sock, data)
+
+    def take_over(self, username):
+        with self.lock:
+            old = [sock for sock, info in self.clients.items()
+                   if info["username"] == username and not info.get("is_bot")]
+        for sock in old:
+            print(f"同一账号重新登录，关闭旧连接: {username}")
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.remove_client(sock)
+
+    def reap_idle_clients(self):
+        now = time.monotonic()
+        ping = Encoder({"type": "ping"})
+        with self.lock:
+            clients = list(self.clients.items())
+
+        for sock, info in clients:
+            if info.get("is_bot"):
+                continue
+            idle = now - info["last_seen"]
+            if idle >= self.idle_timeout:
+                # 只负责关闭连接，资源由handle_client的finally统一回收
+                print(f"客户端超时未响应，断开连接: {info['username']}")
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            elif idle >= self.idle_timeout / 2 and not info["pinged"]:
+                info["pinged"] = True
+                try:
+                    sock.send(self.encode_for(sock, ping), getattr(socket, "MSG_DONTWAIT", 0))
+                except OSError:
+                    pass
 
     def parse_json(self, data):
         try:
@@ -253,308 +1364,467 @@ class GomokuServer:
             else:
                 raise
 
+    def in_running_game(self, client_socket):
+        info = self.clients[client_socket]
+        table = info["table"]
+        return table is not None and client_socket in table.players and table.game_started
+
+    def find_match(self, client_socket, time_control=None):
+        """time_control 是玩家想要的计时规则，双方要求一致时新桌按它计时，否则用服务器默认"""
+        info = self.clients[client_socket]
+        if self.in_running_game(client_socket):
+            self.send_to(client_socket, {"type": "error", "message": "对局进行中，不能加入匹配"})
+            return
+        if time_control is not None:
+            try:
+                GameClock(**time_control)
+            except (TypeError, ValueError) as e:
+                self.send_to(client_socket, {"type": "error", "message": f"无效的计时规则: {e}"})
+                return
+        info["time_control"] = time_control
+        if self.cluster:
+            # 先回复再排队，前端可能马上就配好对把连接转走
+            self.send_to(client_socket, {"type": "match_status", "status": "waiting"})
+            self.enqueue_match(client_socket)
+            return
+        pair = self.enqueue_match(client_socket)
+        if pair:
+            self.start_match(*pair)
+        else:
+            status = {"type": "match_status", "status": "waiting"}
+            status.update(self.matchmaker.position(client_socket) or {})
+            self.send_to(client_socket, status)
+
+    def enqueue_match(self, client_socket):
+        """加入匹配队列，能立即配对时返回配对。集群部署时队列在前端，配对结果由前端通知"""
+        info = self.clients[client_socket]
+        info["matching"] = True
+        if self.cluster:
+            self.cluster.notify("enqueue", username=info["username"], rating=info.get("rating"),
+                                registered=info.get("registered", False), time_control=info.get("time_control"))
+            return None
+        return self.matchmaker.enqueue(client_socket, info.get("rating"))
+
+    def leave_queue(self, client_socket):
+        """退出匹配，返回之前是否在排队"""
+        info = self.clients.get(client_socket)
+        queued = bool(info and info.pop("matching", False))
+        if queued and self.cluster:
+            self.cluster.notify("cancel", username=info["username"])
+        return self.matchmaker.cancel(client_socket) or queued
+
+    def match_tick(self):
+        for pair in self.matchmaker.tick():
+            self.start_match(*pair)
+
+    def start_match(self, first, second):
+        """为配对成功的两名玩家开一张新桌，先入队的一方执黑"""
+        with self.lock:
+            missing = [sock for sock in (first, second) if sock not in self.clients or self.in_running_game(sock)
+                       or not self.clients[sock].get("matching")]
+            if missing:
+                # 有一方已经离开、取消了匹配或开始了别的对局，另一方放回队列
+                for sock in (first, second):
+                    if sock not in missing:
+                        pair = self.enqueue_match(sock)
+                        if pair:
+                            self.scheduler.call_later(0, self.start_match, *pair)
+                return
+            self.table_counter += 1
+            table = GameTable(self, self.table_counter)
+            requested = [self.clients[sock].get("time_control") for sock in (first, second)]
+            if requested[0] == requested[1]:
+                table.time_control = requested[0]
+            self.tables[table.table_id] = table
+            for sock, role in ((first, PlayerRole.BLACK), (second, PlayerRole.WHITE)):
+                info = self.clients[sock]
+                info.pop("matching", None)
+                if info["table"]:
+                    info["table"].leave(sock, info["username"])
+                table.seat(sock, role)
+            for sock, opponent in ((first, second), (second, first)):
+                self.send_to(sock, {"type": "match_status", "status": "matched", "table_id": table.table_id,
+                                    "opponent": self.clients[opponent]["username"],
+                                    "opponent_rating": self.clients[opponent].get("rating")})
+            table.start_game()
+            for sock in (first, second):
+                table.send_snapshot(sock)
+            names = (self.clients[first]["username"], self.clients[second]["username"])
+        print(f"匹配成功: {names[0]} vs {names[1]}, 棋桌 {table.table_id}")
+
+    def watch_table(self, client_socket, table_id):
+        info = self.clients[client_socket]
+        if self.in_running_game(client_socket):
+            self.send_to(client_socket, {"type": "error", "message": "对局进行中，不能离开棋桌"})
+            return
+        with self.lock:
+            table = self.tables.get(table_id)
+            if table is None:
+                self.send_to(client_socket, {"type": "error", "message": f"棋桌不存在: {table_id}"})
+                return
+            self.leave_queue(client_socket)
+            if info["table"]:
+                info["table"].leave(client_socket, info["username"])
+            if info["is_admin"]:
+                table.join(client_socket)
+            else:
+                table.watch(client_socket)
+
     def process_message(self, client_socket, message, role, is_admin):
+        if self.stopping:
+            # 最后一次检查点之后的消息不再处理，客户端重连后以新进程的状态为准
+            return
+        table = self.clients[client_socket]["table"]
+        if self.clients[client_socket].get("relay") and message["type"] not in ("ping", "pong"):
+            return
+
         if message["type"] == "move":
             if role == PlayerRole.SPECTATOR or role is None:
                 return
-                
-            if role != self.current_turn:
-                error_msg = {"type": "error", "message": "还没轮到你下棋"}
-                client_socket.send(json.dumps(error_msg).encode())
-                return
-                
-            x, y = message["x"], message["y"]
-            
-            current_time = time.time()
-            if current_time - self.last_move_time[client_socket] < 0.1:
-                self.handle_cheating(client_socket, "移动速度过快，疑似使用机器人")
-                return
-                
-            self.last_move_time[client_socket] = current_time
-            
-            if self.is_valid_move(x, y):
-                piece = 'B' if role == PlayerRole.BLACK else 'W'
-                self.board[x][y] = piece
-                
-                move_record = {
-                    "x": x, 
-                    "y": y, 
-                    "piece": piece,
-                    "username": self.clients[client_socket]["username"],
-                    "timestamp": time.time()
-                }
-                self.move_history.append(move_record)
-                
-                move_msg = {
-                    "type": "move_made", 
-                    "x": x, 
-                    "y": y, 
-                    "piece": piece,
-                    "username": self.clients[client_socket]["username"]
-                }
-                self.broadcast(move_msg, include_spectators=True)
-                
-                if self.check_win(x, y):
-                    winner = "黑棋" if role == PlayerRole.BLACK else "白棋"
-                    winner_name = self.clients[client_socket]["username"]
-                    win_msg = {
-                        "type": "game_over", 
-                        "winner": winner, 
-                        "winner_name": winner_name,
-                        "message": f"{winner}({winner_name})获胜!"
-                    }
-                    self.broadcast(win_msg, include_spectators=True)
-                    
-                    self.save_game_replay(winner_name)
-                    self.reset_game()
-                else:
-                    self.current_turn = PlayerRole.WHITE if self.current_turn == PlayerRole.BLACK else PlayerRole.BLACK
-                    turn_msg = {"type": "turn", "turn": "BLACK" if self.current_turn == PlayerRole.BLACK else "WHITE"}
-                    self.broadcast(turn_msg, include_spectators=True)
-        
+            table.play_move(client_socket, role, message["x"], message["y"])
+
         elif message["type"] == "chat":
-            username = self.clients[client_socket]["username"]
-            
-            if is_admin:
-                user_role = "管理员"
-            else:
-                user_role = "黑棋" if role == PlayerRole.BLACK else "白棋" if role == PlayerRole.WHITE else "观战者"
-            
-            chat_record = {
-                "username": username,
-                "role": user_role,
-                "message": message["message"],
-                "timestamp": time.time(),
-                "audience": "spectators" if role == PlayerRole.SPECTATOR else "all"
-            }
-            self.chat_history.append(chat_record)
-            
-            if role == PlayerRole.SPECTATOR and not is_admin:
-                chat_msg = {
-                    "type": "chat", 
-                    "message": message["message"],
-                    "username": username,
-                    "role": user_role,
-                    "audience": "spectators"
-                }
-                for spec in self.spectators:
-                    if spec != client_socket:
-                        spec.send(json.dumps(chat_msg).encode())
-            else:
-                chat_msg = {
-                    "type": "chat", 
-                    "message": message["message"],
-                    "username": username,
-                    "role": user_role,
-                    "audience": "all"
-                }
-                self.broadcast(chat_msg, include_spectators=True)
-        
+            table.chat(client_socket, message["message"], role, is_admin)
+
+        elif message["type"] == "ping":
+            self.send_to(client_socket, {"type": "pong"})
+
+        elif message["type"] == "pong":
+            pass
+
         elif message["type"] == "replay_request":
-            history_msg = {"type": "move_history", "history": self.move_history}
-            client_socket.send(json.dumps(history_msg).encode())
-        
+            history_msg = {"type": "move_history", "history": table.move_history}
+            self.send_to(client_socket, history_msg)
+
+        elif message["type"] == "replay_fetch":
+            self.fetch_replay(client_socket, message)
+
+        elif message["type"] == "position_query":
+            # 与局面分析一样，对局双方不能在棋局进行中查开局库
+            if role != PlayerRole.SPECTATOR and not is_admin and table.game_started:
+                self.send_to(client_socket, {"type": "error", "message": "对局中不能查询局面库"})
+                return
+            if self.position_index is None:
+                self.send_to(client_socket, {"type": "error", "message": "服务器没有加载局面索引"})
+                return
+            board = board_from_client_moves(message["moves"]) if "moves" in message else table.board
+            limit = self.message_limit(message)
+            if board is None or limit is None:
+                self.send_to(client_socket, {"type": "error", "message": "局面查询参数不合法"})
+                return
+            info_msg = {"type": "position_info"}
+            info_msg.update(self.position_index.query(board, limit))
+            self.send_to(client_socket, info_msg)
+
+        elif message["type"] == "find_match":
+            self.find_match(client_socket, message.get("time_control"))
+
+        elif message["type"] == "cancel_match":
+            if self.leave_queue(client_socket):
+                self.send_to(client_socket, {"type": "match_status", "status": "cancelled"})
+
+        elif message["type"] == "presence_sync":
+            with self.lock:
+                table.sync_presence(client_socket, message.get("since"))
+
+        elif message["type"] == "list_tables":
+            tables = [t.summary() for t in list(self.tables.values())]
+            self.send_to(client_socket, {"type": "table_list", "tables": tables})
+
+        elif message["type"] == "watch" and "table_id" in message:
+            self.watch_table(client_socket, message["table_id"])
+
         elif message["type"] == "admin_command":
             if not is_admin:
                 return
-                
-            if message["command"] == "ban_ip" and "target" in message:
-                self.ban_ip(message["target"])
-                response = {"type": "admin_response", "message": f"已封禁IP: {message['target']}"}
-                client_socket.send(json.dumps(response).encode())
-            
+            # 针对对局的命令默认作用于管理员所在的棋桌，也可以用 table_id 指定
+            target_table = self.tables.get(message.get("table_id"), table)
+
+            if message["command"] == "ban_ip" and "targets" in message:
+                keys = self.cluster_command(message)[0]
+                banned = [key for key in keys if key]
+                invalid = [target for target, key in zip(message["targets"], keys) if not key]
+                response = {
+                    "type": "admin_response",
+                    "message": f"已封禁 {len(banned)} 个IP/网段" + (f"，无效目标 {len(invalid)} 个" if invalid else ""),
+                    "banned": banned,
+                    "invalid": invalid
+                }
+                self.send_to(client_socket, response)
+
+            elif message["command"] == "ban_ip" and "target" in message:
+                if self.cluster_command(message)[0][0]:
+                    response = {"type": "admin_response", "message": f"已封禁IP: {message['target']}"}
+                else:
+                    response = {"type": "admin_response", "message": f"无效的IP或网段: {message['target']}"}
+                self.send_to(client_socket, response)
+
             elif message["command"] == "unban_ip" and "target" in message:
-                self.unban_ip(message["target"])
-                response = {"type": "admin_response", "message": f"已解封IP: {message['target']}"}
-                client_socket.send(json.dumps(response).encode())
-            
+                if any(self.cluster_command(message)):
+                    response = {"type": "admin_response", "message": f"已解封IP: {message['target']}"}
+                else:
+                    response = {"type": "admin_response", "message": f"该IP未被封禁: {message['target']}"}
+                self.send_to(client_socket, response)
+
             elif message["command"] == "force_end" and "reason" in message:
-                reason = message["reason"]
-                end_msg = {
-                    "type": "game_force_end", 
-                    "message": f"管理员强制结束游戏，理由: {reason}",
-                    "reason": reason
-                }
-                self.broadcast(end_msg, include_spectators=True)
-                
-                self.save_game_replay("管理员强制结束")
-                self.reset_game()
-            
+                target_table.force_end(message["reason"])
+
             elif message["command"] == "broadcast" and "message" in message:
-                broadcast_msg = {
-                    "type": "broadcast", 
-                    "message": message["message"],
-                    "from": "管理员"
-                }
-                self.broadcast(broadcast_msg, include_spectators=True)
-            
+                self.cluster_command(message)
+
             elif message["command"] == "get_user_list":
-                self.send_user_list(client_socket)
-            
-            elif message["command"] == "kick_user" and "username" in message:
-                target_username = message["username"]
-                for sock, info in list(self.clients.items()):
-                    if info["username"] == target_username:
-                        try:
-                            kick_msg = {"type": "kicked", "message": "您已被管理员踢出服务器"}
-                            sock.send(json.dumps(kick_msg).encode())
-                            time.sleep(0.1)
-                            sock.close()
-                        except:
-                            pass
-                        break
+                users = [user for result in self.cluster_command(message) for user in result]
+                self.send_to(client_socket, {"type": "user_list", "users": users})
+
+            elif message["command"] == "add_ai":
+                username = target_table.seat_ai()
+                if username:
+                    response = {"type": "admin_response", "message": f"AI玩家 {username} 已入座"}
+                else:
+                    response = {"type": "admin_response", "message": "没有空闲的玩家座位"}
+                self.send_to(client_socket, response)
+
+            elif message["command"] == "time_control" and "time_control" in message:
+                # 带 table_id 时只改那张桌，否则改服务器默认
+                target_table = self.tables.get(message["table_id"]) if "table_id" in message else None
+                try:
+                    if message["time_control"]:
+                        GameClock(**message["time_control"])
+                    if "table_id" not in message:
+                        self.time_control = message["time_control"]
+                        response = {"type": "admin_response", "message": "计时规则已更新，下一局生效"}
+                    elif target_table is None:
+                        response = {"type": "admin_response", "message": f"棋桌不存在: {message['table_id']}"}
+                    else:
+                        target_table.time_control = message["time_control"]
+                        response = {"type": "admin_response",
+                                    "message": f"棋桌 {target_table.table_id} 的计时规则已更新，下一局生效"}
+                except (TypeError, ValueError) as e:
+                    response = {"type": "admin_response", "message": f"无效的计时规则: {e}"}
+                self.send_to(client_socket, response)
+
+            elif message["command"] == "get_suspicion":
+                self.send_to(client_socket, {"type": "admin_response", "message": "可疑度统计",
+                                             "suspicion": self.anticheat.report()})
+
+            elif message["command"] == "reload_index":
+                # 旧索引可能还在被其他连接线程查询，不主动关闭，交给垃圾回收
+                self.position_index = self.load_position_index()
+                if self.position_index:
+                    response = {"type": "admin_response", "message": f"局面索引已重新加载: {len(self.position_index.game_ids)} 局"}
+                else:
+                    response = {"type": "admin_response", "message": "没有可用的局面索引"}
+                self.send_to(client_socket, response)
+
+            elif message["command"] == "get_stats":
+                stats_msg = {"type": "server_stats", "admission": self.admission.stats(), "ai": self.ai_stats,
+                             "matchmaking": self.matchmaker.stats(), "tables": len(self.tables),
+                             "replays": self.replays.stats()}
+                self.send_to(client_socket, stats_msg)
+
+            elif message["command"] == "kick_user" and ("username" in message or "usernames" in message):
+                targets = message.get("usernames") or [message["username"]]
+                kicked = [name for result in self.cluster_command(message) for name in result]
+                missing = [name for name in targets if name not in kicked]
+                response = {
+                    "type": "admin_response",
+                    "message": f"已踢出 {len(kicked)} 名用户" + (f"，未找到: {', '.join(missing)}" if missing else ""),
+                    "kicked": kicked,
+                    "missing": missing
+                }
+                self.send_to(client_socket, response)
+
+    def fetch_replay(self, client_socket, message):
+        """历史对局：按对局ID分块下发回放和聊天记录，或按玩家列出对局"""
+        if message.get("game_id"):
+            try:
+                chunks = self.replays.chunks(message["game_id"])
+            except Exception as e:
+                print(f"读取历史对局失败 {message['game_id']}: {e}")
+                chunks = None
+            if chunks is None:
+                self.send_to(client_socket, {"type": "error", "message": f"找不到对局: {message['game_id']}"})
+                return
+            for encoder in chunks:
+                client_socket.send(self.encode_for(client_socket, encoder))
+        elif message.get("player"):
+            limit = self.message_limit(message)
+            if limit is None or not isinstance(message["player"], str):
+                self.send_to(client_socket, {"type": "error", "message": "对局查询参数不合法"})
+                return
+            games = self.replays.find(message["player"], limit)
+            self.send_to(client_socket, {"type": "replay_list", "player": message["player"], "games": games})
+
+    def message_limit(self, message, default=20, maximum=100):
+        """客户端请求的条数，超过 maximum 按 maximum 算，不是正整数时返回 None"""
+        limit = message.get("limit", default)
+        if type(limit) is not int or limit < 1:
+            return None
+        return min(limit, maximum)
+
+    def cluster_command(self, message):
+        """执行可以跨进程的管理命令，返回各工作进程的结果列表；单进程部署时只有本进程一个结果"""
+        if self.cluster:
+            return self.cluster.request(message)
+        return [self.run_local_command(message)]
+
+    def run_local_command(self, message):
+        command = message["command"]
+        if command == "ban_ip":
+            duration = message.get("duration_minutes", 10)
+            if "targets" in message:
+                return self.ban_ips(message["targets"], duration)
+            return [self.ban_ip(message["target"], duration)]
+        if command == "unban_ip":
+            return self.unban_ip(message["target"])
+        if command == "kick_user":
+            return self.kick_users(message.get("usernames") or [message["username"]])
+        if command == "get_user_list":
+            return self.user_list()
+        if command == "broadcast":
+            self.broadcast({"type": "broadcast", "message": message["message"], "from": "管理员"})
+        return None
+
+    def kick_users(self, usernames):
+        targets = set(usernames)
+        kick = Encoder({"type": "kicked", "message": "您已被管理员踢出服务器"})
+        kicked = []
+        closing = []
+        with self.lock:
+            for sock, info in self.clients.items():
+                if info["username"] in targets:
+                    kicked.append(info["username"])
+                    info["kicked"] = True
+                    closing.append((sock, self.encode_for(sock, kick)))
+        self.closer.close_many(closing)
+        return kicked
+
+    def notify_admins(self, message):
+        admins = [sock for sock, info in list(self.clients.items()) if info["is_admin"]]
+        self.send_to_many(admins, message)
+
+    def on_cheat_alert(self, client_socket, summary):
+        print(f"疑似作弊: {summary['username']} 可疑度 {summary['suspicion']}")
+        self.notify_admins({
+            "type": "admin_response",
+            "message": f"疑似作弊: {summary['username']}({summary['address']}) 可疑度 {summary['suspicion']:.2f}",
+            "suspicion": summary
+        })
+
+    def on_cheat_ban(self, client_socket, summary):
+        if client_socket not in self.clients:
+            return
+        reason = (f"疑似使用机器人: 与引擎吻合率 {summary['engine_agreement']:.0%}, "
+                  f"平均用时 {summary['mean_think_time']:.2f}秒")
+        self.handle_cheating(client_socket, reason)
 
     def handle_cheating(self, cheater_socket, reason):
         cheater_info = self.clients[cheater_socket]
         cheater_ip = cheater_info["address"]
         cheater_name = cheater_info["username"]
-        
-        self.ban_ip(cheater_ip)
-        
+        table = cheater_info["table"]
+
+        self.cluster_command({"command": "ban_ip", "target": cheater_ip})
+
         winner_socket = None
         winner_name = "系统"
-        for sock, role in self.players.items():
+        for sock, role in table.players.items():
             if sock != cheater_socket:
                 winner_socket = sock
                 winner_name = self.clients[sock]["username"]
                 break
-        
+
         cheat_msg = {
             "type": "cheat_detected",
             "cheater": cheater_name,
             "winner": winner_name,
             "reason": reason
         }
-        self.broadcast(cheat_msg, include_spectators=True)
-        
-        try:
-            cheat_notice = {"type": "cheating", "message": f"您因作弊被踢出服务器: {reason}"}
-            cheater_socket.send(json.dumps(cheat_notice).encode())
-            time.sleep(0.1)
-            cheater_socket.close()
-        except:
-            pass
-        
+        table.broadcast(cheat_msg, include_spectators=True)
+
+        cheat_notice = {"type": "cheating", "message": f"您因作弊被踢出服务器: {reason}"}
+        self.closer.close(cheater_socket, self.encode_for(cheater_socket, Encoder(cheat_notice)))
+
         with self.lock:
-            if cheater_socket in self.players:
-                del self.players[cheater_socket]
             if cheater_socket in self.clients:
                 del self.clients[cheater_socket]
-            if cheater_socket in self.last_move_time:
-                del self.last_move_time[cheater_socket]
+            # 走 leave 把作弊者从名单里删掉并广播带版本号的 user_left，空桌等判完胜负再关
+            table.leave(cheater_socket, cheater_name, close=False)
+            self.anticheat.forget(cheater_socket)
+            self.guest_sessions.pop(cheater_info.get("resume_token"), None)
             if cheater_info["username"] in self.usernames:
-                self.usernames.remove(cheater_info["username"])
-        
-        if self.game_started and winner_socket:
+                self.release_username(cheater_info["username"])
+
+        if table.game_started and winner_socket:
+            winner_role = table.players[winner_socket]
             win_msg = {
-                "type": "game_over", 
-                "winner": "黑棋" if self.players[winner_socket] == PlayerRole.BLACK else "白棋", 
+                "type": "game_over",
+                "winner": "黑棋" if winner_role == PlayerRole.BLACK else "白棋",
                 "winner_name": winner_name,
                 "message": f"由于对手作弊，{winner_name}获胜!"
             }
-            self.broadcast(win_msg, include_spectators=True)
-            
-            self.save_game_replay(winner_name)
-            self.reset_game()
+            table.broadcast(win_msg, include_spectators=True)
+
+            table.save_game_replay(winner_name)
+            table.update_ratings(winner_role)
+            table.reset_game()
+        with self.lock:
+            table.close_if_empty()
 
     def send_user_list(self, client_socket):
+        self.send_to(client_socket, {"type": "user_list", "users": self.user_list()})
+
+    def user_list(self):
         user_list = []
-        for sock, info in self.clients.items():
+        for sock, info in list(self.clients.items()):
             if info["role"]:
                 role_name = "黑棋" if info["role"] == PlayerRole.BLACK else "白棋" if info["role"] == PlayerRole.WHITE else "观战者"
             else:
                 role_name = "管理员" if info["is_admin"] else "未知"
-                
+
             user_list.append({
                 "username": info["username"],
                 "role": role_name,
                 "address": info["address"],
-                "is_admin": info["is_admin"]
+                "is_admin": info["is_admin"],
+                "rating": info.get("rating"),
+                "table_id": info["table"].table_id if info.get("table") else None
             })
-        
-        user_list_msg = {"type": "user_list", "users": user_list}
-        client_socket.send(json.dumps(user_list_msg).encode())
+        return user_list
 
-    def broadcast(self, message, include_spectators=False):
-        data = json.dumps(message).encode()
-        
-        if include_spectators:
-            for client in list(self.clients.keys()):
-                try:
-                    client.send(data)
-                except:
-                    pass
-        else:
-            for player in list(self.players.keys()):
-                try:
-                    player.send(data)
-                except:
-                    pass
+    def encode_for(self, client_socket, encoder):
+        info = self.clients.get(client_socket)
+        if info is None:
+            return encoder.get("json")
+        return encoder.get(info["encoding"], info["compress"])
 
-    def save_game_replay(self, winner):
-        if not self.game_id:
-            return
-            
-        replay_data = {
-            "game_id": self.game_id,
-            "start_time": self.move_history[0]["timestamp"] if self.move_history else time.time(),
-            "end_time": time.time(),
-            "winner": winner,
-            "moves": self.move_history,
-            "board_size": 15
-        }
-        
-        with open(f"replays/{self.game_id}.json", "w") as f:
-            json.dump(replay_data, f, indent=2)
-        
-        chat_data = {
-            "game_id": self.game_id,
-            "chats": self.chat_history
-        }
-        
-        with open(f"chat_logs/{self.game_id}.json", "w") as f:
-            json.dump(chat_data, f, indent=2)
-        
-        print(f"已保存游戏回放: {self.game_id}")
-
-    def is_valid_move(self, x, y):
-        return 0 <= x < 15 and 0 <= y < 15 and self.board[x][y] == ' '
+    def send_to(self, client_socket, message):
+        client_socket.send(self.encode_for(client_socket, Encoder(message)))
 
-    def check_win(self, x, y):
-        piece = self.board[x][y]
-        directions = [
-            [(0, 1), (0, -1)],
-            [(1, 0), (-1, 0)],
-            [(1, 1), (-1, -1)],
-            [(1, -1), (-1, 1)]
-        ]
-        
-        for dir_pair in directions:
-            count = 1
-            
-            for dx, dy in dir_pair:
-                nx, ny = x, y
-                for _ in range(4):
-                    nx, ny = nx + dx, ny + dy
-                    if 0 <= nx < 15 and 0 <= ny < 15 and self.board[nx][ny] == piece:
-                        count += 1
-                    else:
-                        break
-            
-            if count >= 5:
-                return True
-                
-        return False
+    def send_to_many(self, sockets, message):
+        encoder = Encoder(message)
+        for sock in sockets:
+            try:
+                sock.send(self.encode_for(sock, encoder))
+            except:
+                pass
 
-    def reset_game(self):
-        self.board = [[' ' for _ in range(15)] for _ in range(15)]
-        self.current_turn = PlayerRole.BLACK
-        self.game_started = False
-        self.move_history = []
-        self.chat_history = []
-        self.game_id = None
-        self.broadcast({"type": "board", "board": self.board}, include_spectators=True)
+    def broadcast(self, message):
+        """发给服务器上的所有连接，不分棋桌"""
+        self.send_to_many(list(self.clients.keys()), message)
 
 if __name__ == "__main__":
-    server = GomokuServer()
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="五子棋服务器")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--checkpoint", help="检查点文件：定期保存对局状态，启动时自动恢复")
+    parser.add_argument("--takeover", action="store_true", help="平滑重启，接管检查点里记录的旧进程（需要 --checkpoint）")
+    parser.add_argument("--ai", action="store_true", help="启用AI陪练：玩家等待一段时间没有对手时由AI入座")
+    parser.add_argument("--analysis", action="store_true", help="启用局面分析：对局中每一步给观战者和管理员推送分析")
+    parser.add_argument("--time-control", type=parse_time_control,
+                        help="默认计时规则，如 fischer:600+5 或 byoyomi:600+3x30，不指定则不计时")
+    args = parser.parse_args()
+
+    server = GomokuServer(args.host, args.port, ai_opponent=args.ai, analysis=args.analysis,
+                          time_control=args.time_control, checkpoint=args.checkpoint)
+    server.start(takeover=args.takeover)
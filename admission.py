@@ -0,0 +1,102 @@
+import json
+import socket
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, now=None, amount=1):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class AdmissionController:
+    """accept() 路径上的准入控制：全局与单IP两级令牌桶，外加计数器"""
+
+    def __init__(self, ban_store, global_rate=200, global_burst=400,
+                 per_ip_rate=2, per_ip_burst=10, max_tracked_ips=100000):
+        self.ban_store = ban_store
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.per_ip_rate = per_ip_rate
+        self.per_ip_burst = per_ip_burst
+        self.max_tracked_ips = max_tracked_ips
+        self.ip_buckets = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "admitted": 0,
+            "rejected_banned": 0,
+            "rejected_ip_rate": 0,
+            "rejected_global_rate": 0,
+        }
+
+    def admit(self, ip):
+        """返回 None 表示放行，否则返回拒绝原因"""
+        if self.ban_store.is_banned(ip):
+            reason = "banned"
+        else:
+            now = time.monotonic()
+            with self.lock:
+                bucket = self.ip_buckets.get(ip)
+                if bucket is None:
+                    if len(self.ip_buckets) >= self.max_tracked_ips:
+                        self._prune(now)
+                    bucket = TokenBucket(self.per_ip_rate, self.per_ip_burst)
+                    self.ip_buckets[ip] = bucket
+                if not bucket.consume(now):
+                    reason = "ip_rate"
+                elif not self.global_bucket.consume(now):
+                    reason = "global_rate"
+                else:
+                    reason = None
+
+        with self.lock:
+            if reason is None:
+                self.counters["admitted"] += 1
+            else:
+                self.counters[f"rejected_{reason}"] += 1
+        return reason
+
+    def _prune(self, now):
+        # 令牌已经回满的桶与新建的桶等价，可以直接丢弃
+        refill = self.per_ip_burst / self.per_ip_rate
+        for ip, bucket in list(self.ip_buckets.items()):
+            if now - bucket.updated >= refill:
+                del self.ip_buckets[ip]
+        if len(self.ip_buckets) >= self.max_tracked_ips:
+            self.ip_buckets.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["tracked_ips"] = len(self.ip_buckets)
+        return stats
+
+
+def reject_connection(client_socket, client_ip, reason):
+    """按 admit() 给出的拒绝原因回一条消息并关闭连接。非阻塞地尽力发送一次，绝不在accept线程上等待"""
+    if reason == "banned":
+        print(f"拒绝被封禁IP的连接: {client_ip}")
+        message = {"type": "banned", "message": "您的IP已被封禁，无法连接服务器"}
+    else:
+        message = {"type": "rejected", "message": "连接过于频繁，请稍后再试"}
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(json.dumps(message).encode())
+    except OSError:
+        pass
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    client_socket.close()
@@ -0,0 +1,231 @@
+import json
+import math
+import multiprocessing
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from rules import BOARD_SIZE, EMPTY
+from gomoku_ai import SearchEngine, LINES, WIN_SCORE, ZOBRIST_SIDE, zobrist_hash
+
+ANALYSIS_VERSION = 1
+WIN_PROBABILITY_SCALE = 3000.0
+
+THREAT_PATTERNS = {
+    "open_four": [" cccc "],
+    "four": ["cccc ", " cccc", "ccc c", "c ccc", "cc cc"],
+    "open_three": [" ccc ", " cc c ", " c cc "],
+}
+
+
+def count_threats(board):
+    """统计双方的活三、冲四、活四数量"""
+    cells = [board[x][y] for x in range(BOARD_SIZE) for y in range(BOARD_SIZE)]
+    result = {}
+    for piece, name in (('B', "BLACK"), ('W', "WHITE")):
+        counts = {kind: 0 for kind in THREAT_PATTERNS}
+        for line in LINES:
+            text = "".join(cells[i] for i in line)
+            if piece not in text:
+                continue
+            for kind, patterns in THREAT_PATTERNS.items():
+                for pattern in patterns:
+                    counts[kind] += text.count(pattern.replace("c", piece))
+        # 活四同时会被两个冲四棋型各匹配一次
+        counts["four"] = max(0, counts["four"] - 2 * counts["open_four"])
+        result[name] = counts
+    return result
+
+
+def win_probability(score, piece):
+    """把搜索得分（相对行棋方）换算成黑方胜率"""
+    if abs(score) >= WIN_SCORE - 100:
+        p = 1.0 if score > 0 else 0.0
+    else:
+        p = 1 / (1 + math.exp(-score / WIN_PROBABILITY_SCALE))
+    return p if piece == 'B' else 1 - p
+
+
+_engine = None
+
+
+def analyze_position(board, piece, time_limit=1.0, suggestions=3):
+    """在工作进程中运行的深度分析"""
+    global _engine
+    if _engine is None:
+        _engine = SearchEngine()
+    result = _engine.search(board, piece, time_limit)
+    best = [(result["x"], result["y"])]
+    _engine.load(board)
+    for idx in _engine.candidates(piece):
+        move = divmod(idx, BOARD_SIZE)
+        if move not in best:
+            best.append(move)
+        if len(best) >= suggestions:
+            break
+    p_black = win_probability(result["score"], piece)
+    return {
+        "best_moves": [{"x": x, "y": y} for x, y in best],
+        "score": result["score"],
+        "depth": result["depth"],
+        "nodes": result["nodes"],
+        "win_probability": {"BLACK": round(p_black, 3), "WHITE": round(1 - p_black, 3)}
+    }
+
+
+_cache_db = None
+
+
+def analyze_cached(db_path, key, board, piece, time_limit=1.0):
+    """工作进程入口：先查磁盘缓存，没有再深度分析。返回 (结果, 是否来自缓存)"""
+    global _cache_db
+    if db_path:
+        if _cache_db is None:
+            _cache_db = sqlite3.connect(db_path)
+        row = _cache_db.execute("SELECT result FROM analysis WHERE key = ? AND version = ?",
+                                (format(key, "016x"), ANALYSIS_VERSION)).fetchone()
+        if row is not None:
+            return json.loads(row[0]), True
+    return analyze_position(board, piece, time_limit), False
+
+
+def side_to_move(board):
+    stones = sum(1 for row in board for cell in row if cell != EMPTY)
+    return 'B' if stones % 2 == 0 else 'W'
+
+
+def position_key(board, piece):
+    return zobrist_hash(board) ^ (ZOBRIST_SIDE if piece == 'W' else 0)
+
+
+class AnalysisCache:
+    """内存LRU + SQLite 磁盘缓存，键为局面的 Zobrist 哈希"""
+
+    def __init__(self, path="analysis_cache.db", capacity=10000):
+        self.path = path
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS analysis ("
+                            "key TEXT PRIMARY KEY, version INTEGER, result TEXT)")
+            self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            result = self.memory.get(key)
+            if result is not None:
+                self.memory.move_to_end(key)
+                return result
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT result FROM analysis WHERE key = ? AND version = ?",
+                                  (format(key, "016x"), ANALYSIS_VERSION)).fetchone()
+            if row is None:
+                return None
+            result = json.loads(row[0])
+            self._remember(key, result)
+            return result
+
+    def get_memory(self, key):
+        """只查内存，调用方所在的线程不碰磁盘"""
+        with self.lock:
+            result = self.memory.get(key)
+            if result is not None:
+                self.memory.move_to_end(key)
+            return result
+
+    def put(self, key, result, persist=True):
+        with self.lock:
+            self._remember(key, result)
+            if persist and self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?)",
+                                (format(key, "016x"), ANALYSIS_VERSION, json.dumps(result)))
+                self.db.commit()
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+
+class Analyzer:
+    """后台局面分析：威胁统计立即返回，深度搜索结果在工作进程算完后回调"""
+
+    def __init__(self, cache=None, time_limit=1.0, workers=1):
+        self.cache = cache if cache is not None else AnalysisCache()
+        self.time_limit = time_limit
+        self.workers = workers
+        self.pool = None
+        self.inflight = {}
+        self.busy = set()
+        self.waiting = {}
+        self.lock = threading.Lock()
+
+    def quick(self, board):
+        return {"threats": count_threats(board)}
+
+    def submit(self, board, callback, piece=None, slot=None):
+        """callback(result) 在结果可用时调用，内存缓存命中时同步调用；磁盘缓存在工作进程里查。
+        给了 slot（比如一张棋桌）时，同一 slot 同时只算一个局面、最多再排一个，
+        新提交的局面替换还没开始算的那个"""
+        piece = piece or side_to_move(board)
+        key = position_key(board, piece)
+        cached = self.cache.get_memory(key)
+        if cached is not None:
+            callback(cached)
+            return
+        snapshot = [row[:] for row in board]
+        with self.lock:
+            if slot is not None:
+                if slot in self.busy:
+                    self.waiting[slot] = (key, snapshot, piece, callback)
+                    return
+                self.busy.add(slot)
+            self._start(key, snapshot, piece, callback, slot)
+
+    def _start(self, key, board, piece, callback, slot):
+        """需要持有 self.lock"""
+        # 同一局面同时只算一次，后来的请求挂在同一个任务上
+        if key in self.inflight:
+            self.inflight[key][0].append(callback)
+            if slot is not None:
+                self.inflight[key][1].add(slot)
+            return
+        self.inflight[key] = ([callback], {slot} - {None})
+        if self.pool is None:
+            # spawn 启动，不继承服务器的监听套接字和客户端连接
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        future = self.pool.submit(analyze_cached, self.cache.path, key, board, piece, self.time_limit)
+        future.add_done_callback(lambda f: self._done(key, board, f))
+
+    def _done(self, key, board, future):
+        with self.lock:
+            callbacks, slots = self.inflight.pop(key, ([], set()))
+            for slot in slots:
+                self.busy.discard(slot)
+                waiting = self.waiting.pop(slot, None)
+                if waiting is not None:
+                    self.busy.add(slot)
+                    self._start(*waiting, slot)
+        try:
+            result, from_disk = future.result()
+        except Exception as e:
+            print(f"局面分析失败: {e}")
+            return
+        result["threats"] = count_threats(board)
+        self.cache.put(key, result, persist=not from_disk)
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                print(f"分析结果回调失败: {e}")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from archive import iter_segment
+from rules import transform
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, kind TEXT, mtime REAL, size INTEGER, game_id TEXT
+);
+CREATE TABLE IF NOT EXISTS games (
+    game_id TEXT PRIMARY KEY, start_time REAL, end_time REAL, winner TEXT,
+    moves INTEGER, black TEXT, white TEXT, opening TEXT
+);
+CREATE TABLE IF NOT EXISTS player_games (
+    game_id TEXT, username TEXT, color TEXT, result TEXT
+);
+CREATE TABLE IF NOT EXISTS move_times (
+    game_id TEXT, move_number INTEGER, username TEXT, seconds REAL
+);
+CREATE TABLE IF NOT EXISTS chats (
+    game_id TEXT, username TEXT, messages INTEGER, characters INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_player_games_game ON player_games(game_id);
+CREATE INDEX IF NOT EXISTS idx_player_games_user ON player_games(username);
+CREATE INDEX IF NOT EXISTS idx_move_times_game ON move_times(game_id);
+CREATE INDEX IF NOT EXISTS idx_chats_game ON chats(game_id);
+"""
+
+MOVE_TIME_BUCKETS = [1, 2, 5, 10, 30, 60, 120]
+
+
+def canonical_opening(moves, plies=3):
+    """取前几手，在 8 种对称变换中取字典序最小的表示，使对称的开局合并统计"""
+    opening = [(m["piece"], m["x"], m["y"]) for m in moves[:plies]]
+    if not opening:
+        return ""
+    variants = []
+    for k in range(8):
+        variants.append(tuple((piece,) + transform(x, y, k) for piece, x, y in opening))
+    return " ".join(f"{piece}({x},{y})" for piece, x, y in min(variants))
+
+
+def extract_replay(replay, opening_plies=3):
+    moves = replay.get("moves", [])
+    game_id = replay.get("game_id")
+    players = {}
+    for move in moves:
+        players.setdefault(move["piece"], move.get("username"))
+    black, white = players.get('B'), players.get('W')
+    winner = replay.get("winner")
+
+    player_games = []
+    for color, username in (('B', black), ('W', white)):
+        if username is None:
+            continue
+        if winner == username:
+            result = "win"
+        elif winner in (black, white):
+            result = "loss"
+        elif winner == "平局":
+            result = "draw"
+        else:
+            result = "none"
+        player_games.append((game_id, username, color, result))
+
+    # 回放的 start_time 就是第一手的时间，所以第一手没有用时
+    move_times = []
+    previous = None
+    for number, move in enumerate(moves, 1):
+        timestamp = move.get("timestamp")
+        if timestamp is not None and previous is not None:
+            move_times.append((game_id, number, move.get("username"), max(0.0, timestamp - previous)))
+        previous = timestamp
+
+    return {
+        "game": (game_id, replay.get("start_time"), replay.get("end_time"), winner, len(moves),
+                 black, white, canonical_opening(moves, opening_plies)),
+        "player_games": player_games,
+        "move_times": move_times,
+    }
+
+
+def extract_chat(chat_data):
+    game_id = chat_data.get("game_id")
+    per_user = {}
+    for chat in chat_data.get("chats", []):
+        stats = per_user.setdefault(chat.get("username"), [0, 0])
+        stats[0] += 1
+        stats[1] += len(chat.get("message", ""))
+    return {"game_id": game_id,
+            "chats": [(game_id, username, count, chars) for username, (count, chars) in per_user.items()]}
+
+
+def extract_file(task):
+    """工作进程入口：读取一个文件并抽取统计事实"""
+    path, kind, opening_plies = task
+    try:
+        if kind == "segment":
+            # 归档段文件：一次抽取段里所有对局的回放和聊天记录
+            facts = []
+            for _, record in iter_segment(path):
+                if record["replay"]:
+                    facts.append(("replay", extract_replay(record["replay"], opening_plies)))
+                if record["chat"]:
+                    facts.append(("chat", extract_chat(record["chat"])))
+            return path, facts, None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        return path, None, str(e)
+    if kind == "replay":
+        return path, extract_replay(data, opening_plies), None
+    return path, extract_chat(data), None
+
+
+class AnalyticsStore:
+    def __init__(self, path="analytics.db"):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def pending_files(self, directories):
+        """只返回新增或修改过的文件"""
+        known = {path: (mtime, size) for path, mtime, size in self.db.execute("SELECT path, mtime, size FROM files")}
+        pending = []
+        for kind, directory in directories:
+            if not directory or not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                suffix = ".idx" if kind == "segment" else ".json"
+                for entry in entries:
+                    if not entry.name.endswith(suffix) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if known.get(entry.path) != (stat.st_mtime, stat.st_size):
+                        pending.append((entry.path, kind, stat.st_mtime, stat.st_size))
+        return pending
+
+    def store(self, path, kind, mtime, size, facts):
+        if kind == "segment":
+            for fact_kind, fact in facts:
+                self.store_facts(fact_kind, fact)
+            game_id = None
+        else:
+            game_id = self.store_facts(kind, facts)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (path, kind, mtime, size, game_id))
+
+    def store_facts(self, kind, facts):
+        if kind == "replay":
+            game_id = facts["game"][0]
+            self.db.execute("DELETE FROM player_games WHERE game_id = ?", (game_id,))
+            self.db.execute("DELETE FROM move_times WHERE game_id = ?", (game_id,))
+            self.db.execute("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?)", facts["game"])
+            self.db.executemany("INSERT INTO player_games VALUES (?, ?, ?, ?)", facts["player_games"])
+            self.db.executemany("INSERT INTO move_times VALUES (?, ?, ?, ?)", facts["move_times"])
+        else:
+            game_id = facts["game_id"]
+            self.db.execute("DELETE FROM chats WHERE game_id = ?", (game_id,))
+            self.db.executemany("INSERT INTO chats VALUES (?, ?, ?, ?)", facts["chats"])
+        return game_id
+
+    def update(self, replay_dir="replays", chat_dir="chat_logs", workers=None, opening_plies=3, batch=500,
+               archive_dir="archive"):
+        pending = self.pending_files([("replay", replay_dir), ("chat", chat_dir), ("segment", archive_dir)])
+        if not pending:
+            return 0
+        meta = {path: (kind, mtime, size) for path, kind, mtime, size in pending}
+        tasks = [(path, kind, opening_plies) for path, kind, _, _ in pending]
+        processed = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, facts, error in pool.map(extract_file, tasks, chunksize=64):
+                if error:
+                    print(f"跳过无法解析的文件 {path}: {error}")
+                    continue
+                kind, mtime, size = meta[path]
+                self.store(path, kind, mtime, size, facts)
+                processed += 1
+                if processed % batch == 0:
+                    self.db.commit()
+        self.db.commit()
+        return processed
+
+    def report(self, top=10):
+        db = self.db
+        games, avg_moves = db.execute("SELECT COUNT(*), AVG(moves) FROM games").fetchone()
+        users = [
+            {"username": username, "games": total, "wins": wins, "losses": losses}
+            for username, total, wins, losses in db.execute(
+                "SELECT username, COUNT(*), SUM(result = 'win'), SUM(result = 'loss') "
+                "FROM player_games GROUP BY username ORDER BY COUNT(*) DESC")
+        ]
+        openings = [
+            {"opening": opening, "games": count}
+            for opening, count in db.execute(
+                "SELECT opening, COUNT(*) FROM games WHERE opening != '' "
+                "GROUP BY opening ORDER BY COUNT(*) DESC LIMIT ?", (top,))
+        ]
+        histogram = {}
+        lower = 0
+        for upper in MOVE_TIME_BUCKETS + [None]:
+            if upper is None:
+                count = db.execute("SELECT COUNT(*) FROM move_times WHERE seconds >= ?", (lower,)).fetchone()[0]
+                histogram[f">={lower}s"] = count
+            else:
+                count = db.execute("SELECT COUNT(*) FROM move_times WHERE seconds >= ? AND seconds < ?",
+                                   (lower, upper)).fetchone()[0]
+                histogram[f"{lower}-{upper}s"] = count
+                lower = upper
+        total_chats, chat_games = db.execute("SELECT SUM(messages), COUNT(DISTINCT game_id) FROM chats").fetchone()
+        chatters = [
+            {"username": username, "messages": count}
+            for username, count in db.execute(
+                "SELECT username, SUM(messages) FROM chats GROUP BY username "
+                "ORDER BY SUM(messages) DESC LIMIT ?", (top,))
+        ]
+        return {
+            "games": games,
+            "average_moves": round(avg_moves or 0, 1),
+            "users": users,
+            "openings": openings,
+            "move_time_histogram": histogram,
+            "chat_messages": total_chats or 0,
+            "games_with_chat": chat_games,
+            "top_chatters": chatters
+        }
+
+
+def print_report(report, top=10):
+    print(f"对局总数: {report['games']}，平均手数: {report['average_moves']}")
+    print("\n玩家战绩:")
+    for user in report["users"][:top]:
+        print(f"  {user['username']:<16} 对局 {user['games']:>5}  胜 {user['wins']:>5}  负 {user['losses']:>5}")
+    print("\n常见开局:")
+    for opening in report["openings"]:
+        print(f"  {opening['opening']:<30} {opening['games']:>6}")
+    print("\n落子用时分布:")
+    for bucket, count in report["move_time_histogram"].items():
+        print(f"  {bucket:<10} {count:>8}")
+    print(f"\n聊天消息总数: {report['chat_messages']}（{report['games_with_chat']} 局）")
+    for chatter in report["top_chatters"]:
+        print(f"  {chatter['username']:<16} {chatter['messages']:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对局与聊天记录离线统计")
+    parser.add_argument("--replays", default="replays", help="回放目录")
+    parser.add_argument("--chats", default="chat_logs", help="聊天记录目录")
+    parser.add_argument("--archive", default="archive", help="归档目录，见 archive.py")
+    parser.add_argument("--db", default="analytics.db", help="SQLite统计库路径")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数，默认为CPU核数")
+    parser.add_argument("--opening-plies", type=int, default=3, help="开局统计取前几手")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", help="把统计结果写入该JSON文件")
+    args = parser.parse_args()
+
+    store = AnalyticsStore(args.db)
+    processed = store.update(args.replays, args.chats, args.workers, args.opening_plies, archive_dir=args.archive)
+    print(f"本次处理了 {processed} 个新增或修改的文件\n")
+    report = store.report(args.top)
+    print_report(report, args.top)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,158 @@
+import math
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from gomoku_ai import search_best_move
+
+
+class RunningStats:
+    """Welford 在线均值/方差"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class PlayerProfile:
+    def __init__(self, username, address):
+        self.username = username
+        self.address = address
+        self.think_times = RunningStats()
+        self.fast_moves = 0
+        self.engine_checked = 0
+        self.engine_matched = 0
+        self.score = 0.0
+        self.alerted = False
+        self.banned = False
+
+    def agreement(self):
+        return self.engine_matched / self.engine_checked if self.engine_checked else 0.0
+
+    def summary(self):
+        return {
+            "username": self.username,
+            "address": self.address,
+            "moves": self.think_times.count,
+            "mean_think_time": round(self.think_times.mean, 3),
+            "stdev_think_time": round(self.think_times.stdev(), 3),
+            "fast_moves": self.fast_moves,
+            "engine_agreement": round(self.agreement(), 3),
+            "engine_checked": self.engine_checked,
+            "suspicion": round(self.score, 3)
+        }
+
+
+class AntiCheat:
+    """统计式机器人检测
+
+    落子路径上只做一次 put_nowait，思考时间分布和与引擎首选点的吻合率
+    都在后台线程里更新，引擎搜索放在独立进程中，不会占用网络线程的GIL。
+    可疑度超过 alert_threshold 时通知管理员，超过 ban_threshold 且样本
+    足够时才自动处理。
+    """
+
+    def __init__(self, on_alert, on_ban, alert_threshold=0.6, ban_threshold=0.85,
+                 min_samples=12, fast_move_seconds=0.3, engine_time_limit=0.3,
+                 engine_sample_rate=2, max_queue=10000):
+        self.on_alert = on_alert
+        self.on_ban = on_ban
+        self.alert_threshold = alert_threshold
+        self.ban_threshold = ban_threshold
+        self.min_samples = min_samples
+        self.fast_move_seconds = fast_move_seconds
+        self.engine_time_limit = engine_time_limit
+        self.engine_sample_rate = engine_sample_rate
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.events = queue.Queue(max_queue)
+        self.pool = None
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="anticheat")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record_move(self, key, username, address, board, piece, x, y, think_time):
+        """在落子处理线程中调用，board 需要是落子前局面的副本"""
+        try:
+            self.events.put_nowait((key, username, address, board, piece, x, y, think_time))
+        except queue.Full:
+            self.dropped += 1
+
+    def forget(self, key):
+        with self.lock:
+            self.profiles.pop(key, None)
+
+    def report(self):
+        with self.lock:
+            return [profile.summary() for profile in self.profiles.values()]
+
+    def _run(self):
+        while True:
+            key, username, address, board, piece, x, y, think_time = self.events.get()
+            try:
+                self._process(key, username, address, board, piece, x, y, think_time)
+            except Exception as e:
+                print(f"反作弊分析失败: {e}")
+
+    def _process(self, key, username, address, board, piece, x, y, think_time):
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile is None:
+                profile = self.profiles[key] = PlayerProfile(username, address)
+            profile.think_times.add(think_time)
+            if think_time < self.fast_move_seconds:
+                profile.fast_moves += 1
+            sample = profile.think_times.count % self.engine_sample_rate == 0
+
+        # 开局前几手几乎所有人都下在中心附近，不计入吻合率
+        stones = sum(1 for row in board for cell in row if cell != ' ')
+        if sample and stones >= 6:
+            if self.pool is None:
+                # spawn 启动，不继承服务器的监听套接字和客户端连接
+                self.pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            best = self.pool.submit(search_best_move, board, piece, self.engine_time_limit, 4).result()
+            with self.lock:
+                profile.engine_checked += 1
+                if (best["x"], best["y"]) == (x, y):
+                    profile.engine_matched += 1
+
+        with self.lock:
+            profile.score = self.suspicion(profile)
+            alert = profile.score >= self.alert_threshold and not profile.alerted
+            ban = (profile.score >= self.ban_threshold and not profile.banned
+                   and profile.think_times.count >= self.min_samples)
+            if alert:
+                profile.alerted = True
+            if ban:
+                profile.banned = True
+            summary = profile.summary()
+
+        if alert:
+            self.on_alert(key, summary)
+        if ban:
+            self.on_ban(key, summary)
+
+    def suspicion(self, profile):
+        stats = profile.think_times
+        if stats.count < self.min_samples:
+            return 0.0
+        # 思考时间过于均匀：变异系数越小越像程序
+        cv = stats.stdev() / stats.mean if stats.mean > 0 else 0.0
+        regularity = max(0.0, min(1.0, (0.5 - cv) / 0.4))
+        speed = profile.fast_moves / stats.count
+        agreement = 0.0
+        if profile.engine_checked >= self.min_samples // self.engine_sample_rate:
+            agreement = max(0.0, min(1.0, (profile.agreement() - 0.5) / 0.4))
+        return 0.35 * regularity + 0.15 * speed + 0.5 * agreement
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+# 对局归档：把 replays/ 和 chat_logs/ 里已结束对局的小文件打包进只追加的
+# 大段文件，每个段文件配一个偏移索引：
+#
+#   seg_000001.dat   记录 × N，记录 = 负载长度(4, 大端) + zlib(JSON {"replay", "chat"})
+#   seg_000001.idx   zlib(JSON {"version", "end", "games": [[字段...], ...]})，字段见 FIELDS
+#
+# 索引里的 end 是段文件中有效数据的末尾。打包中途崩溃时段文件末尾可能多出
+# 没进索引的记录，下次追加前先截断到 end；源文件在索引落盘之后才删除。
+
+RECORD = struct.Struct(">I")
+INDEX_VERSION = 1
+SEGMENT_SIZE = 64 << 20
+FIELDS = ("game_id", "offset", "length", "black", "white", "winner", "start_time", "end_time", "moves")
+
+
+def segment_name(number):
+    return f"seg_{number:06d}"
+
+
+def read_index(path):
+    with open(path, "rb") as f:
+        index = json.loads(zlib.decompress(f.read()))
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"不支持的归档索引版本: {path}")
+    return index
+
+
+def write_index(path, end, games):
+    with open(path + ".tmp", "wb") as f:
+        f.write(zlib.compress(json.dumps({"version": INDEX_VERSION, "end": end, "games": games},
+                                         separators=(",", ":"), ensure_ascii=False).encode()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def read_record(data_path, offset, length):
+    """读出一局：{"replay": ..., "chat": ...}，工作进程里也可以直接调用"""
+    with open(data_path, "rb") as f:
+        f.seek(offset + RECORD.size)
+        return json.loads(zlib.decompress(f.read(length)))
+
+
+def iter_segment(index_path):
+    """按文件顺序读出一个段里的所有对局，顺序读比逐局 seek 快"""
+    index = read_index(index_path)
+    with open(index_path[:-4] + ".dat", "rb") as f:
+        for game in index["games"]:
+            f.seek(game[1] + RECORD.size)
+            yield game[0], json.loads(zlib.decompress(f.read(game[2])))
+
+
+def game_players(replay):
+    players = {}
+    for move in (replay or {}).get("moves", []):
+        players.setdefault(move["piece"], move.get("username"))
+    return players.get('B'), players.get('W')
+
+
+class SegmentWriter:
+    def __init__(self, directory, number):
+        base = os.path.join(directory, segment_name(number))
+        self.data_path = base + ".dat"
+        self.index_path = base + ".idx"
+        if os.path.exists(self.index_path):
+            index = read_index(self.index_path)
+            self.games, self.size = index["games"], index["end"]
+        else:
+            self.games, self.size = [], 0
+        self.file = open(self.data_path, "r+b" if os.path.exists(self.data_path) else "w+b")
+        self.file.truncate(self.size)
+        self.file.seek(self.size)
+        self.appended = False
+
+    def append(self, game_id, replay, chat):
+        payload = zlib.compress(json.dumps({"replay": replay, "chat": chat}, separators=(",", ":"),
+                                           ensure_ascii=False).encode())
+        self.file.write(RECORD.pack(len(payload)) + payload)
+        black, white = game_players(replay)
+        replay = replay or {}
+        self.games.append([game_id, self.size, len(payload), black, white, replay.get("winner"),
+                           replay.get("start_time"), replay.get("end_time"), len(replay.get("moves", []))])
+        self.size += RECORD.size + len(payload)
+        self.appended = True
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        # 没有新记录的段不改写索引，免得读取方以为它变了
+        if self.appended:
+            write_index(self.index_path, self.size, self.games)
+
+
+class ArchiveReader:
+    """只读访问归档：按对局ID或玩家查找，读取时只解压需要的那一局"""
+
+    def __init__(self, directory="archive"):
+        self.directory = directory
+        self.games = {}
+        self.by_player = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith(".idx"))
+
+    def refresh(self):
+        """重新加载有变化的段索引，打包任务运行之后调用"""
+        for name in self.segments():
+            index_path = os.path.join(self.directory, name + ".idx")
+            try:
+                mtime = os.path.getmtime(index_path)
+                if self.loaded.get(name) == mtime:
+                    continue
+                index = read_index(index_path)
+            except Exception as e:
+                print(f"读取归档索引失败 {index_path}: {e}")
+                continue
+            data_path = os.path.join(self.directory, name + ".dat")
+            with self.lock:
+                for game in index["games"]:
+                    if game[0] not in self.games:
+                        for player in set(game[3:5]) - {None}:
+                            self.by_player.setdefault(player, []).append(game[0])
+                    self.games[game[0]] = (data_path, game)
+                self.loaded[name] = mtime
+
+    def __contains__(self, game_id):
+        return game_id in self.games
+
+    def __len__(self):
+        return len(self.games)
+
+    def entry(self, game_id):
+        found = self.games.get(game_id)
+        return dict(zip(FIELDS, found[1])) if found else None
+
+    def get(self, game_id):
+        found = self.games.get(game_id)
+        if found is None:
+            return None
+        data_path, game = found
+        return read_record(data_path, game[1], game[2])
+
+    def replay(self, game_id):
+        record = self.get(game_id)
+        return record["replay"] if record else None
+
+    def chat(self, game_id):
+        record = self.get(game_id)
+        return record["chat"] if record else None
+
+    def find(self, player=None, limit=None):
+        """按时间倒序列出对局的索引信息；对局ID以时间开头，按ID排序即可"""
+        with self.lock:
+            game_ids = list(self.by_player.get(player, [])) if player else list(self.games)
+        game_ids.sort(reverse=True)
+        return [self.entry(game_id) for game_id in game_ids[:limit]]
+
+    def iter_games(self):
+        for name in self.segments():
+            yield from iter_segment(os.path.join(self.directory, name + ".idx"))
+
+    def locations(self, exclude=()):
+        """有落子的对局在段文件里的位置 (段文件, 偏移, 长度)，给工作进程用 read_record 读取"""
+        with self.lock:
+            return [(data_path, game[1], game[2]) for game_id, (data_path, game) in self.games.items()
+                    if game[8] and game_id not in exclude]
+
+    def export(self, game_id, replay_dir="replays", chat_dir="chat_logs"):
+        """按服务器原来的格式导出一局的回放和聊天记录，返回写出的文件"""
+        record = self.get(game_id)
+        if record is None:
+            return []
+        written = []
+        for directory, data in ((replay_dir, record["replay"]), (chat_dir, record["chat"])):
+            if data is None:
+                continue
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{game_id}.json")
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2)
+            written.append(path)
+        return written
+
+
+def load_game(game_id, replay_dir="replays", chat_dir="chat_logs", archive=None):
+    """先找还没打包的文件，再找归档，返回 (回放, 聊天记录)，找不到的部分为 None"""
+    loaded = []
+    for directory in (replay_dir, chat_dir):
+        path = os.path.join(directory, f"{game_id}.json")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                loaded.append(json.load(f))
+        else:
+            loaded.append(None)
+    if archive is not None and (loaded[0] is None or loaded[1] is None) and game_id in archive:
+        record = archive.get(game_id)
+        loaded = [loaded[0] or record["replay"], loaded[1] or record["chat"]]
+    return loaded[0], loaded[1]
+
+
+def compact(replay_dir="replays", chat_dir="chat_logs", directory="archive", min_age=60,
+            segment_size=SEGMENT_SIZE, keep=False):
+    """把修改时间早于 min_age 秒的回放和聊天文件打包进段文件，返回打包的对局数"""
+    os.makedirs(directory, exist_ok=True)
+    reader = ArchiveReader(directory)
+    now = time.time()
+    sources = {}
+    for kind, source_dir in ((0, replay_dir), (1, chat_dir)):
+        if not source_dir or not os.path.isdir(source_dir):
+            continue
+        with os.scandir(source_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file() and now - entry.stat().st_mtime >= min_age:
+                    sources.setdefault(entry.name[:-5], [None, None])[kind] = entry.path
+
+    segments = reader.segments()
+    number = int(segments[-1][4:]) if segments else 1
+    writer = None
+    packed = 0
+    done = []
+    try:
+        for game_id in sorted(sources):
+            paths = [path for path in sources[game_id] if path]
+            if game_id in reader:
+                # 上次打包写完索引后没来得及删源文件
+                done.extend(paths)
+                continue
+            try:
+                data = []
+                for path in sources[game_id]:
+                    if path is None:
+                        data.append(None)
+                        continue
+                    with open(path, "r", encoding="utf-8") as f:
+                        data.append(json.load(f))
+            except Exception as e:
+                print(f"跳过无法解析的文件 {game_id}: {e}")
+                continue
+            if writer is None:
+                writer = SegmentWriter(directory, number)
+            while writer.size >= segment_size:
+                writer.close()
+                number += 1
+                writer = SegmentWriter(directory, number)
+            writer.append(game_id, data[0], data[1])
+            done.extend(paths)
+            packed += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    if not keep:
+        for path in done:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"删除已归档的文件失败 {path}: {e}")
+    return packed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对局归档：打包、查询和导出")
+    parser.add_argument("--archive", default="archive", help="归档目录")
+    parser.add_argument("--replays", default="replays", help="回放目录")
+    parser.add_argument("--chats", default="chat_logs", help="聊天记录目录")
+    parser.add_argument("--compact", action="store_true", help="把已结束对局的文件打包进段文件")
+    parser.add_argument("--min-age", type=int, default=60, help="只打包修改时间早于这么多秒的文件")
+    parser.add_argument("--segment-mb", type=int, default=SEGMENT_SIZE >> 20, help="单个段文件的大小上限(MB)")
+    parser.add_argument("--keep", action="store_true", help="打包后保留源文件")
+    parser.add_argument("--list", action="store_true", help="列出归档中的对局")
+    parser.add_argument("--player", help="只列出该玩家的对局")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--export", metavar="GAME_ID", nargs="+", help="按原格式导出对局到回放和聊天记录目录")
+    args = parser.parse_args()
+
+    if args.compact:
+        count = compact(args.replays, args.chats, args.archive, args.min_age, args.segment_mb << 20, args.keep)
+        print(f"已打包 {count} 局对局")
+    reader = ArchiveReader(args.archive)
+    if args.list or args.player:
+        for game in reader.find(args.player, args.limit):
+            print(f"{game['game_id']:<28} 黑 {game['black'] or '-':<12} 白 {game['white'] or '-':<12} "
+                  f"{game['moves']:>4}手 胜者 {game['winner'] or '-'}")
+    if args.export:
+        for game_id in args.export:
+            written = reader.export(game_id, args.replays, args.chats)
+            print(f"已导出 {game_id}: {', '.join(written)}" if written else f"归档中没有对局: {game_id}")
+    if not (args.compact or args.list or args.player or args.export):
+        print(f"归档中共有 {len(reader)} 局对局，{len(reader.segments())} 个段文件")
@@ -0,0 +1,250 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+
+
+class PrefixTrie:
+    """按地址位构建的前缀树，用于CIDR网段匹配"""
+
+    def __init__(self):
+        self.root = [None, None, None]  # [0子节点, 1子节点, 命中的网段]
+        self.size = 0
+
+    def insert(self, network):
+        node = self.root
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            bit = (bits >> (width - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = network
+
+    def remove(self, network):
+        node = self.root
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                return
+        if node[2] is not None:
+            self.size -= 1
+        node[2] = None
+
+    def match(self, address):
+        if not self.size:
+            return None
+        node = self.root
+        bits = int(address)
+        width = address.max_prefixlen
+        for i in range(width + 1):
+            if node[2] is not None:
+                return node[2]
+            if i == width:
+                break
+            node = node[(bits >> (width - 1 - i)) & 1]
+            if node is None:
+                break
+        return None
+
+
+class BanStore:
+    """IP封禁存储：单个IP用哈希表，网段用前缀树，到期由共享的定时堆处理
+
+    banned.json 保存快照 {目标: 到期时间戳或null}，之后的变更以追加方式
+    成批写入 banned.journal，日志过长时再合并回快照。path 为 None 时只保存在内存里。
+    """
+
+    def __init__(self, scheduler, path="banned.json", journal_path="banned.journal",
+                 flush_interval=1.0, compact_threshold=5000):
+        self.scheduler = scheduler
+        self.path = path
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.compact_threshold = compact_threshold
+        self.lock = threading.Lock()
+        self.ips = {}
+        self.networks = {}
+        self.tries = {4: PrefixTrie(), 6: PrefixTrie()}
+        self.pending = []
+        self.flush_scheduled = False
+        self.journal_entries = 0
+        if self.path:
+            self.load()
+
+    def load(self):
+        entries = {}
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    banned_data = json.load(f)
+                if isinstance(banned_data, list):
+                    entries = {target: None for target in banned_data}
+                else:
+                    entries = {target: expires if isinstance(expires, (int, float)) else None
+                               for target, expires in banned_data.items()}
+            else:
+                with open(self.path, "w") as f:
+                    json.dump({}, f)
+        except Exception as e:
+            print(f"加载封禁列表失败: {e}")
+
+        try:
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, "r") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        self.journal_entries += 1
+                        if record["op"] == "ban":
+                            entries[record["target"]] = record.get("expires_at")
+                        else:
+                            entries.pop(record["target"], None)
+        except Exception as e:
+            print(f"加载封禁日志失败: {e}")
+
+        now = time.time()
+        for target, expires_at in entries.items():
+            if expires_at is not None and expires_at <= now:
+                continue
+            try:
+                self._add(target, expires_at)
+            except ValueError:
+                print(f"忽略无效的封禁目标: {target}")
+
+    def _parse(self, target):
+        if "/" in target:
+            return ipaddress.ip_network(target, strict=False)
+        return ipaddress.ip_address(target)
+
+    def _add(self, target, expires_at):
+        parsed = self._parse(target)
+        if isinstance(parsed, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            key = str(parsed)
+            self.networks[key] = expires_at
+            self.tries[parsed.version].insert(parsed)
+        else:
+            key = str(parsed)
+            self.ips[key] = expires_at
+        if expires_at is not None:
+            self.scheduler.call_at_wall(expires_at, self._expire, key, expires_at)
+        return key
+
+    def _remove(self, key):
+        if key in self.ips:
+            del self.ips[key]
+            return True
+        if key in self.networks:
+            del self.networks[key]
+            network = ipaddress.ip_network(key)
+            self.tries[network.version].remove(network)
+            return True
+        return False
+
+    def is_banned(self, ip):
+        if ip in self.ips:
+            return True
+        if not self.networks:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return self.tries[address.version].match(address) is not None
+
+    def ban(self, target, duration_seconds=None):
+        return self.ban_many([target], duration_seconds)[0]
+
+    def ban_many(self, targets, duration_seconds=None):
+        expires_at = time.time() + duration_seconds if duration_seconds is not None else None
+        keys = []
+        with self.lock:
+            for target in targets:
+                try:
+                    key = self._add(target, expires_at)
+                except ValueError:
+                    keys.append(None)
+                    continue
+                keys.append(key)
+                self.pending.append({"op": "ban", "target": key, "expires_at": expires_at})
+            self._schedule_flush()
+        return keys
+
+    def unban(self, target):
+        return self.unban_many([target])[0]
+
+    def unban_many(self, targets):
+        results = []
+        with self.lock:
+            for target in targets:
+                try:
+                    key = str(self._parse(target))
+                except ValueError:
+                    results.append(False)
+                    continue
+                removed = self._remove(key)
+                if removed:
+                    self.pending.append({"op": "unban", "target": key})
+                results.append(removed)
+            self._schedule_flush()
+        return results
+
+    def _expire(self, key, expires_at):
+        with self.lock:
+            current = self.ips.get(key, self.networks.get(key))
+            # 到期前被重新封禁或已解封时，堆里的旧条目直接作废
+            if current != expires_at:
+                return
+            self._remove(key)
+            self.pending.append({"op": "unban", "target": key})
+            self._schedule_flush()
+        print(f"已解封IP: {key}")
+
+    def snapshot(self):
+        with self.lock:
+            entries = dict(self.networks)
+            entries.update(self.ips)
+        return entries
+
+    def _schedule_flush(self):
+        if self.pending and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.scheduler.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        with self.lock:
+            records = self.pending
+            self.pending = []
+            self.flush_scheduled = False
+            if not records or not self.path:
+                return
+            compact = self.journal_entries + len(records) >= self.compact_threshold
+            if compact:
+                entries = dict(self.networks)
+                entries.update(self.ips)
+
+        try:
+            if compact:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+                open(self.journal_path, "w").close()
+                self.journal_entries = 0
+            else:
+                with open(self.journal_path, "a") as f:
+                    f.write("".join(json.dumps(r) + "\n" for r in records))
+                self.journal_entries += len(records)
+        except Exception as e:
+            print(f"保存封禁列表失败: {e}")
@@ -0,0 +1,363 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from rules import BOARD_SIZE, new_board, is_valid_move, check_win
+
+# 热点路径的基准测试。每个用例先自动确定每个样本的调用次数，再采集
+# repeat 个样本（每次调用的平均耗时）。与基线比较时用 Mann-Whitney U 检验
+# （正态近似，单侧），p 值低于 --alpha 且中位数变慢超过 --min-change 的
+# 才算回归，避免把噪声当成回归。
+
+BASELINE_PATH = "bench_baseline.json"
+CASES = []
+
+
+def case(name):
+    def register(func):
+        CASES.append((name, func))
+        return func
+    return register
+
+
+def random_board(stones, seed=1):
+    rng = random.Random(seed)
+    board = new_board()
+    cells = rng.sample(range(BOARD_SIZE * BOARD_SIZE), stones)
+    for i, idx in enumerate(cells):
+        board[idx // BOARD_SIZE][idx % BOARD_SIZE] = 'B' if i % 2 == 0 else 'W'
+    return board, [divmod(idx, BOARD_SIZE) for idx in cells]
+
+
+def synthetic_moves(count, start=1700000000.0, seed=2):
+    rng = random.Random(seed)
+    cells = rng.sample(range(BOARD_SIZE * BOARD_SIZE), count)
+    return [{"x": idx // BOARD_SIZE, "y": idx % BOARD_SIZE, "piece": 'B' if i % 2 == 0 else 'W',
+             "username": "alice" if i % 2 == 0 else "bob", "timestamp": start + i * 3.0}
+            for i, idx in enumerate(cells)]
+
+
+def synthetic_chats(count, start=1700000000.0):
+    return [{"username": f"user{i % 7}", "role": "观战者", "message": f"第{i}条聊天消息",
+             "timestamp": start + i * 0.5, "audience": "all"} for i in range(count)]
+
+
+class BenchContext:
+    """基准用的服务器实例：不监听端口，文件都写到临时目录"""
+
+    def __init__(self, clients=32):
+        self.clients = clients
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        self.server = None
+        self.pairs = []
+
+    def get_server(self):
+        if self.server is None:
+            from Server import GomokuServer
+            from player_store import PlayerStore, SQLiteBackend
+            os.chdir(self.tempdir.name)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.server = GomokuServer(port=0, ai_opponent=False, analysis=False, position_index=None,
+                                           player_store=PlayerStore(SQLiteBackend(":memory:")),
+                                           persist_bans=False)
+        return self.server
+
+    def add_clients(self, table, count, encoding):
+        """用 socketpair 模拟 count 个客户端，另一端由后台线程读空"""
+        server = self.get_server()
+        for i in range(count):
+            ours, theirs = socket.socketpair()
+            server.clients[ours] = {"username": f"bench{len(self.pairs)}", "address": "local", "role": None,
+                                    "is_admin": False, "encoding": encoding, "compress": False,
+                                    "table": table, "last_seen": time.monotonic(), "pinged": False}
+            table.members.add(ours)
+            table.spectators.append(ours)
+            self.pairs.append((ours, theirs))
+            threading.Thread(target=self.drain, args=(theirs,), daemon=True).start()
+
+    def drain(self, sock):
+        try:
+            while sock.recv(1 << 16):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        for ours, theirs in self.pairs:
+            ours.close()
+            theirs.close()
+        os.chdir(self.cwd)
+        self.tempdir.cleanup()
+
+
+def feed_buffer(server, chunks):
+    """与 handle_client 相同的拆包循环，返回解析出的消息数"""
+    buffer = ""
+    count = 0
+    for data in chunks:
+        buffer += data
+        while buffer:
+            try:
+                message, idx = server.parse_json(buffer)
+                buffer = buffer[idx:]
+                count += 1
+            except json.JSONDecodeError:
+                break
+    return count
+
+
+@case("rules.check_win")
+def bench_check_win(ctx):
+    board, stones = random_board(80)
+    return lambda: [check_win(board, x, y) for x, y in stones], len(stones)
+
+
+@case("rules.is_valid_move")
+def bench_is_valid_move(ctx):
+    board, _ = random_board(80)
+    cells = [(x, y) for x in range(-1, BOARD_SIZE + 1) for y in range(-1, BOARD_SIZE + 1)]
+    return lambda: [is_valid_move(board, x, y) for x, y in cells], len(cells)
+
+
+def _messages(count):
+    return [json.dumps({"type": "move", "x": i % BOARD_SIZE, "y": (i * 7) % BOARD_SIZE}) if i % 3
+            else json.dumps({"type": "chat", "message": "加油" * (i % 10 + 1)}) for i in range(count)]
+
+
+@case("server.parse_json.multi")
+def bench_parse_multi(ctx):
+    server = ctx.get_server()
+    chunks = ["".join(_messages(50))]
+    return lambda: feed_buffer(server, chunks), 50
+
+
+@case("server.parse_json.fragmented")
+def bench_parse_fragmented(ctx):
+    server = ctx.get_server()
+    data = "".join(_messages(50))
+    chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+    return lambda: feed_buffer(server, chunks), 50
+
+
+@case("server.broadcast")
+def bench_broadcast(ctx):
+    from Server import GameTable
+    server = ctx.get_server()
+    table = GameTable(server, 900)
+    ctx.add_clients(table, ctx.clients // 2, "json")
+    ctx.add_clients(table, ctx.clients - ctx.clients // 2, "compact")
+    message = {"type": "chat", "message": "基准测试消息" * 4, "username": "alice", "role": "黑棋", "audience": "all"}
+    return lambda: table.broadcast(message, include_spectators=True), 1
+
+
+@case("server.save_game_replay")
+def bench_save_replay(ctx):
+    from Server import GameTable
+    server = ctx.get_server()
+    table = GameTable(server, 901)
+    table.game_id = "bench_replay"
+    table.move_history = synthetic_moves(120)
+    table.chat_history = synthetic_chats(200)
+
+    def save():
+        with contextlib.redirect_stdout(io.StringIO()):
+            table.save_game_replay("alice")
+    return save, 1
+
+
+def make_viewer():
+    """没有图形环境时返回 None，查看器的用例跳过"""
+    try:
+        import tkinter as tk
+        import viewer
+    except ImportError:
+        return None
+    original = tk.Tk.mainloop
+    tk.Tk.mainloop = lambda self, n=0: None
+    try:
+        return viewer.GomokuReplayViewer()
+    except tk.TclError:
+        return None
+    finally:
+        tk.Tk.mainloop = original
+
+
+@case("viewer.draw_current_step")
+def bench_draw_current_step(ctx):
+    app = make_viewer()
+    if app is None:
+        return None
+    app.replay_data = {"moves": synthetic_moves(BOARD_SIZE * BOARD_SIZE)}
+    app.total_steps = app.current_step = len(app.replay_data["moves"])
+
+    def draw():
+        app.draw_current_step()
+        app.root.update_idletasks()
+    return draw, 1
+
+
+@case("viewer.update_chat_by_time")
+def bench_update_chat_by_time(ctx):
+    app = make_viewer()
+    if app is None:
+        return None
+    chats = synthetic_chats(2000)
+    app.chat_data = {"chats": chats}
+    current = chats[len(chats) // 2]["timestamp"]
+
+    def update():
+        app.update_chat_by_time(current)
+        app.root.update_idletasks()
+    return update, 1
+
+
+def measure(op, calls, repeat, target=0.02):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= target or number >= 1 << 20:
+            break
+        number *= 2
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            op()
+        samples.append((time.perf_counter() - start) / (number * calls))
+    return samples
+
+
+def mann_whitney_greater(current, baseline):
+    """H1: current 的耗时整体大于 baseline。返回单侧 p 值（正态近似，含连续性校正）"""
+    combined = sorted([(v, 0) for v in current] + [(v, 1) for v in baseline])
+    ranks = [0.0] * len(combined)
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        i = j + 1
+    n1, n2 = len(current), len(baseline)
+    rank_sum = sum(rank for rank, (_, group) in zip(ranks, combined) if group == 0)
+    u = rank_sum - n1 * (n1 + 1) / 2
+    sigma = math.sqrt(n1 * n2 * (n1 + n2 + 1) / 12)
+    if sigma == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / sigma
+    return 1 - statistics.NormalDist().cdf(z)
+
+
+def compare(result, baseline, alpha, min_change):
+    ratio = result["median"] / baseline["median"] if baseline["median"] else 1.0
+    slower = mann_whitney_greater(result["samples"], baseline["samples"])
+    faster = mann_whitney_greater(baseline["samples"], result["samples"])
+    if slower < alpha and ratio > 1 + min_change:
+        status = "regression"
+    elif faster < alpha and ratio < 1 - min_change:
+        status = "improvement"
+    else:
+        status = "unchanged"
+    return {"ratio": round(ratio, 4), "p_slower": round(slower, 6), "p_faster": round(faster, 6), "status": status}
+
+
+def run(names=None, repeat=20, clients=32):
+    ctx = BenchContext(clients)
+    results = {}
+    try:
+        for name, setup in CASES:
+            if names and not any(name.startswith(prefix) for prefix in names):
+                continue
+            prepared = setup(ctx)
+            if prepared is None:
+                results[name] = {"skipped": "没有图形环境"}
+                continue
+            op, calls = prepared
+            samples = measure(op, calls, repeat)
+            results[name] = {
+                "samples": samples,
+                "median": statistics.median(samples),
+                "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+                "calls_per_op": calls
+            }
+    finally:
+        ctx.close()
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3f}{unit}"
+    return f"{seconds / 1e-9:.1f}ns"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="服务器、规则和回放查看器热点路径的基准测试")
+    parser.add_argument("--only", nargs="*", help="只运行名称以这些前缀开头的用例")
+    parser.add_argument("--repeat", type=int, default=20, help="每个用例的样本数")
+    parser.add_argument("--clients", type=int, default=32, help="广播用例的客户端数")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--alpha", type=float, default=0.01, help="显著性水平")
+    parser.add_argument("--min-change", type=float, default=0.10, help="中位数至少变化多少才报告")
+    parser.add_argument("--json", help="把结果写入该JSON文件")
+    args = parser.parse_args()
+
+    args.baseline = os.path.abspath(args.baseline)
+    json_path = os.path.abspath(args.json) if args.json else None
+    results = run(args.only, args.repeat, args.clients)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f).get("results", {})
+
+    regressions = 0
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:<32} 跳过: {result['skipped']}")
+            continue
+        line = f"{name:<32} 中位数 {format_time(result['median']):>10}  标准差 {format_time(result['stdev']):>10}"
+        if name in baseline and "samples" in baseline[name]:
+            result["comparison"] = compare(result, baseline[name], args.alpha, args.min_change)
+            comparison = result["comparison"]
+            line += f"  基线比 {comparison['ratio']:.3f}"
+            if comparison["status"] == "regression":
+                line += f"  ⚠ 回归 (p={comparison['p_slower']:.4f})"
+                regressions += 1
+            elif comparison["status"] == "improvement":
+                line += f"  提升 (p={comparison['p_faster']:.4f})"
+        print(line)
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+        "regressions": regressions
+    }
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"已保存基线: {args.baseline}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from game_clock import GameClock, SIDES
+
+# 对局状态检查点：每张正在对局的棋桌存一行压缩 JSON，另有一行服务器级的
+# 状态（棋桌计数、游客令牌等）。定时保存时只重写上次保存后有变化的棋桌，
+# 结束的对局删掉对应的行。棋盘不单独存，恢复时按落子记录重建。
+#
+# 平滑重启：新进程用 SO_REUSEPORT 绑定同一端口，给旧进程发 SIGUSR2。旧进程
+# 停止接受连接，写最后一次检查点并把自己的 pid 记为 handoff，通知客户端
+# 重连后退出；新进程看到 handoff 后加载检查点再开始 accept。对局双方按
+# 断线处理保留座位，客户端凭令牌重连后从断点继续。
+
+
+def dump_clock(clock):
+    if clock is None:
+        return None
+    now = time.monotonic()
+    remaining = dict(clock.remaining)
+    if clock.running:
+        remaining[clock.running] = max(0.0, remaining[clock.running] - (now - clock.started_at))
+    return {"mode": clock.mode, "increment": clock.increment, "period_time": clock.period_time,
+            "remaining": remaining, "periods": dict(clock.periods), "running": clock.running}
+
+
+def load_clock(data):
+    """恢复棋钟，行棋方从此刻重新开始计时，重启花的时间不算在任何一方头上"""
+    if not data:
+        return None
+    clock = GameClock(data["mode"], 0, data["increment"], 0, data["period_time"])
+    clock.remaining = {side: float(data["remaining"][side]) for side in SIDES}
+    clock.periods = {side: int(data["periods"][side]) for side in SIDES}
+    if data["running"]:
+        clock.start(data["running"])
+    return clock
+
+
+class Checkpoint:
+    def __init__(self, path="checkpoint.db"):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.closed = False
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS tables (table_id INTEGER PRIMARY KEY, state BLOB, saved_at REAL);
+            """)
+            self.db.commit()
+
+    def version(self, state):
+        return (state["game_id"], len(state["moves"]), len(state["chats"]),
+                json.dumps(state["seats"], sort_keys=True), state["clock"] and state["clock"]["running"])
+
+    def table_state(self, table):
+        server = table.server
+        seats = {}
+        for sock, role in list(table.players.items()):
+            info = server.clients.get(sock)
+            if info:
+                seats[role.name] = {"username": info["username"], "token": info.get("resume_token"),
+                                    "bot": bool(info.get("is_bot"))}
+        for username, held in list(table.held.items()):
+            seats[held["role"].name] = {"username": username, "token": held["token"], "bot": False}
+        return {
+            "table_id": table.table_id,
+            "game_id": table.game_id,
+            "moves": list(table.move_history),
+            "chats": list(table.chat_history),
+            "player_table": list(table.player_table),
+            "rated_players": table.rated_players,
+            "seats": seats,
+            "clock": dump_clock(table.clock),
+            "time_control": table.time_control
+        }
+
+    def save(self, server, handoff=False):
+        """保存所有正在进行的对局，返回重写的棋桌数"""
+        if self.closed:
+            return 0
+        states = [self.table_state(table) for table in list(server.tables.values()) if table.game_started]
+        meta = {
+            "pid": os.getpid(),
+            "saved_at": time.time(),
+            "table_counter": server.table_counter,
+            "user_counter": server.user_counter,
+            "guest_sessions": dict(server.guest_sessions)
+        }
+        changed = [state for state in states if self.versions.get(state["table_id"]) != self.version(state)]
+        removed = set(self.versions) - {state["table_id"] for state in states}
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO tables VALUES (?, ?, ?)", [
+                (state["table_id"], zlib.compress(json.dumps(state, separators=(",", ":")).encode()), meta["saved_at"])
+                for state in changed])
+            self.db.executemany("DELETE FROM tables WHERE table_id = ?", [(table_id,) for table_id in removed])
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('server', ?)", (json.dumps(meta),))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('handoff', ?)",
+                            (str(os.getpid()) if handoff else "",))
+            self.db.commit()
+        for state in changed:
+            self.versions[state["table_id"]] = self.version(state)
+        for table_id in removed:
+            self.versions.pop(table_id, None)
+        if handoff:
+            self.closed = True
+        return len(changed)
+
+    def meta(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def load(self):
+        """返回 (服务器状态, 棋桌状态列表)，没有检查点时返回 (None, [])"""
+        server_meta = self.meta("server")
+        if not server_meta:
+            return None, []
+        with self.lock:
+            rows = self.db.execute("SELECT state FROM tables ORDER BY table_id").fetchall()
+        states = [json.loads(zlib.decompress(row[0])) for row in rows]
+        # 以读到的内容为准，之后只重写有变化的棋桌
+        self.versions = {state["table_id"]: self.version(state) for state in states}
+        return json.loads(server_meta), states
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            self.db.close()
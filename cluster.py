@@ -0,0 +1,437 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import secrets
+import socket
+import threading
+import time
+import zlib
+
+from admission import AdmissionController, reject_connection
+from ban_store import BanStore
+from game_clock import parse_time_control
+from matchmaking import Matchmaker
+from scheduler import TimerHeap
+
+# 集群部署：前端进程在 8888 端口接受连接并做准入控制，读出（不取走）登录
+# 消息后用 SCM_RIGHTS 把套接字交给某个工作进程，之后的通信和前端无关。
+# 每个工作进程是一个完整的 GomokuServer，各自拥有自己的棋桌和对局。
+#
+# 路由规则（按顺序）：
+#   带前端发的转入令牌的，交给开桌等着它的工作进程；
+#   带对局ID（断线重连或观战）的，交给对局ID里记录的工作进程；
+#   用户名已在某个进程在线的，交给那个进程，顶号和重名检查都在进程内完成；
+#   要求匹配的按用户名哈希分散到各进程；
+#   其余的要去1号桌先到先得地入座或观战，1号桌只有 MAIN_NODE 上的那一张。
+#
+# 匹配队列在前端：工作进程把排队、取消通知前端，前端配好对后，双方在同一
+# 进程的直接开桌；不在同一进程的，先入队一方所在的进程开桌，另一方收到
+# 转入令牌后重连，由前端按令牌路由过去。
+#
+# 控制通道（multiprocessing.Pipe）上跑跨进程的管理命令：工作进程把命令
+# 发给前端，前端分发给所有工作进程执行，汇总结果后回给发起的工作进程。
+
+CLUSTER_COMMANDS = ("get_user_list", "kick_user", "ban_ip", "unban_ip", "broadcast")
+CALL_TIMEOUT = 5.0
+MAIN_NODE = 0
+# 转入令牌在前端保留的秒数，比工作进程等对手的时间稍长
+TRANSFER_TTL = 30
+# 与 GomokuServer 读取登录消息的长度一致
+LOGIN_PEEK_SIZE = 1024
+LOGIN_DECODER = json.JSONDecoder()
+
+
+def route_node(login_info, workers, online=None):
+    """根据登录消息选工作进程，online 是前端记录的 用户名 -> 所在进程"""
+    game_id = login_info.get("game_id") or ""
+    parts = game_id.split("_") if isinstance(game_id, str) else []
+    if len(parts) == 3 and parts[2].startswith("n") and "-" in parts[2]:
+        node = parts[2][1:].split("-")[0]
+        if node.isdigit() and int(node) < workers:
+            return int(node)
+    username = str(login_info.get("username", ""))
+    if online and username in online:
+        return online[username]
+    if login_info.get("matchmaking"):
+        return zlib.crc32(username.encode()) % workers
+    return MAIN_NODE
+
+
+class ClusterWorker:
+    """工作进程一侧的控制通道"""
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.counter = itertools.count()
+        thread = threading.Thread(target=self.run, name="cluster-control")
+        thread.daemon = True
+        thread.start()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def notify(self, event, **fields):
+        """不需要回复的通知：在线状态和匹配队列的变化"""
+        fields["event"] = event
+        try:
+            self.send(fields)
+        except (OSError, ValueError) as e:
+            print(f"集群控制通道错误: {e}")
+
+    def request(self, message):
+        """把管理命令交给前端分发，返回各工作进程的结果；前端无响应时只在本进程执行"""
+        request_id = next(self.counter)
+        event = threading.Event()
+        self.pending[request_id] = [event, None]
+        try:
+            self.send({"request": request_id, "message": message})
+            if event.wait(CALL_TIMEOUT):
+                return self.pending[request_id][1]
+            print(f"集群命令超时，只在本进程执行: {message['command']}")
+        except (OSError, ValueError) as e:
+            print(f"集群控制通道错误: {e}")
+        finally:
+            self.pending.pop(request_id, None)
+        return [self.server.run_local_command(message)]
+
+    def run(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                print("与集群前端的控制通道已断开")
+                return
+            if "call" in message:
+                try:
+                    result = self.server.run_local_command(message["message"])
+                except Exception as e:
+                    print(f"执行集群命令失败: {e}")
+                    result = None
+                self.send({"reply": message["call"], "result": result})
+            elif "reply" in message:
+                waiting = self.pending.get(message["reply"])
+                if waiting:
+                    waiting[1] = message["results"]
+                    waiting[0].set()
+            elif "match" in message:
+                try:
+                    self.server.on_cluster_match(message["match"])
+                except Exception as e:
+                    print(f"处理集群匹配失败: {e}")
+
+
+def run_worker(node, handoff, control, options):
+    """工作进程入口：从 handoff 套接字接收前端转交的连接"""
+    from Server import GomokuServer
+
+    # 封禁列表由前端持久化，工作进程只在内存里保存一份
+    server = GomokuServer(node_id=node, persist_bans=False, **options)
+    server.cluster = ClusterWorker(server, control)
+    server.schedule_maintenance()
+    print(f"工作进程 {node} 已启动 (pid {os.getpid()})")
+    while True:
+        try:
+            data, fds, _, _ = socket.recv_fds(handoff, 1024, 1)
+        except OSError as e:
+            print(f"接收连接失败: {e}")
+            continue
+        if not data and not fds:
+            return
+        if not fds:
+            continue
+        client_socket = socket.socket(fileno=fds[0])
+        server.serve_client(client_socket, tuple(json.loads(data)["addr"]))
+
+
+class ClusterFront:
+    def __init__(self, host='localhost', port=8888, workers=None, backlog=128,
+                 conn_rate=2, conn_burst=10, global_conn_rate=200, global_conn_burst=400,
+                 handshake_timeout=10, server_options=None):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.workers = workers or os.cpu_count() or 1
+        self.handshake_timeout = handshake_timeout
+        self.server_options = server_options or {}
+        self.scheduler = TimerHeap()
+        self.ban_store = BanStore(self.scheduler)
+        self.admission = AdmissionController(self.ban_store, global_conn_rate, global_conn_burst,
+                                             conn_rate, conn_burst)
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.processes = []
+        self.handoffs = []
+        self.controls = []
+        self.send_locks = []
+        self.pending = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.routed = [0] * self.workers
+        # 在线用户名所在的进程、匹配队列里每个人的信息、转入令牌对应的进程
+        self.online = {}
+        self.matchmaker = Matchmaker(**(self.server_options.get("matchmaking") or {}))
+        self.queued = {}
+        self.hosting = {}
+        self.transfers = {}
+
+    def spawn_workers(self):
+        # 在接受任何连接之前启动工作进程，子进程不会继承客户端套接字
+        for node in range(self.workers):
+            front_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            front_control, worker_control = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, name=f"gomoku-worker-{node}",
+                                              args=(node, worker_end, worker_control, self.server_options))
+            process.daemon = True
+            process.start()
+            worker_end.close()
+            worker_control.close()
+            self.processes.append(process)
+            self.handoffs.append(front_end)
+            self.controls.append(front_control)
+            self.send_locks.append(threading.Lock())
+            thread = threading.Thread(target=self.read_control, args=(node,), name=f"cluster-control-{node}")
+            thread.daemon = True
+            thread.start()
+
+    def send_control(self, node, message):
+        with self.send_locks[node]:
+            self.controls[node].send(message)
+
+    def read_control(self, node):
+        conn = self.controls[node]
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                print(f"工作进程 {node} 的控制通道已断开")
+                return
+            if "reply" in message:
+                waiting = self.pending.get(message["reply"])
+                if waiting:
+                    waiting[1][node] = message["result"]
+                    if len(waiting[1]) == waiting[2]:
+                        waiting[0].set()
+            elif "request" in message:
+                # 分发要等所有工作进程回复，不能占用读控制通道的线程
+                threading.Thread(target=self.fan_out, args=(node, message), daemon=True).start()
+            elif "event" in message:
+                try:
+                    self.on_event(node, message)
+                except OSError as e:
+                    print(f"处理工作进程 {node} 的通知失败: {e}")
+
+    def on_event(self, node, message):
+        event = message["event"]
+        username = message.get("username")
+        pair = None
+        with self.lock:
+            if event == "online":
+                self.online[username] = node
+            elif event == "offline":
+                if self.online.get(username) == node:
+                    del self.online[username]
+            elif event == "enqueue":
+                self.queued[username] = {"node": node, "rating": message["rating"],
+                                         "registered": message["registered"], "time_control": message["time_control"]}
+                pair = self.matchmaker.enqueue(username, message["rating"])
+            elif event == "cancel":
+                if self.queued.get(username, {}).get("node") == node:
+                    del self.queued[username]
+                    self.matchmaker.cancel(username)
+            elif event == "hosting":
+                self.host_ready(message["token"], message["ok"])
+        if pair:
+            self.start_pair(*pair)
+
+    def match_tick(self):
+        for pair in self.matchmaker.tick():
+            self.start_pair(*pair)
+
+    def start_pair(self, first, second):
+        """前端的队列配成一对：同一进程的直接开桌，否则先入队一方的进程开桌，另一方转过去"""
+        with self.lock:
+            entries = {name: self.queued.pop(name, None) for name in (first, second)}
+            if None in entries.values():
+                # 配对的同时有一方取消了，另一方放回队列
+                for name, entry in entries.items():
+                    if entry is not None:
+                        self.requeue(name, entry)
+                return
+            owner, other = entries[first]["node"], entries[second]["node"]
+            if owner == other:
+                match = {"first": first, "second": second}
+            else:
+                token = secrets.token_urlsafe(16)
+                self.hosting[token] = (first, entries[first], second, entries[second])
+                match = {"first": first, "second": second, "token": token,
+                         "registered": entries[second]["registered"], "time_control": entries[second]["time_control"]}
+        self.send_control(owner, {"match": match})
+
+    def host_ready(self, token, ok):
+        """开桌的进程回复能不能接对手，需要持有 self.lock"""
+        pending = self.hosting.pop(token, None)
+        if pending is None:
+            return
+        first, first_entry, second, second_entry = pending
+        if not ok:
+            self.requeue(second, second_entry)
+            return
+        self.transfers[token] = first_entry["node"]
+        self.scheduler.call_later(TRANSFER_TTL, self.expire_transfer, token)
+        self.send_control(second_entry["node"], {"match": {
+            "transfer": second, "token": token, "opponent": first, "opponent_rating": first_entry["rating"]}})
+
+    def expire_transfer(self, token):
+        with self.lock:
+            self.transfers.pop(token, None)
+
+    def requeue(self, username, entry):
+        """把玩家放回前端队列，需要持有 self.lock；能立即配对时稍后开桌"""
+        self.queued[username] = entry
+        pair = self.matchmaker.enqueue(username, entry["rating"])
+        if pair:
+            self.scheduler.call_later(0, self.start_pair, *pair)
+
+    def fan_out(self, origin, request):
+        message = request["message"]
+        if message.get("command") not in CLUSTER_COMMANDS:
+            results = []
+        else:
+            # 准入控制在前端，封禁和解封必须在这里生效并落盘
+            unbanned = False
+            if message["command"] == "ban_ip":
+                targets = message.get("targets") or [message["target"]]
+                self.ban_store.ban_many(targets, message.get("duration_minutes", 10) * 60)
+            elif message["command"] == "unban_ip":
+                unbanned = self.ban_store.unban(message["target"])
+            results = self.call_all(message)
+            if unbanned:
+                # 工作进程里可能已经没有这条封禁（比如重启过），以前端的结果为准
+                results.append(True)
+        try:
+            self.send_control(origin, {"reply": request["request"], "results": results})
+        except OSError as e:
+            print(f"回复工作进程 {origin} 失败: {e}")
+
+    def call_all(self, message):
+        """让所有存活的工作进程执行命令，按进程编号返回结果，超时的进程不计入"""
+        call_id = next(self.counter)
+        alive = [node for node, process in enumerate(self.processes) if process.is_alive()]
+        event = threading.Event()
+        self.pending[call_id] = [event, {}, len(alive)]
+        try:
+            for node in alive:
+                try:
+                    self.send_control(node, {"call": call_id, "message": message})
+                except OSError as e:
+                    print(f"发送集群命令到工作进程 {node} 失败: {e}")
+                    self.pending[call_id][2] -= 1
+            if self.pending[call_id][2] > 0 and not event.wait(CALL_TIMEOUT):
+                print(f"部分工作进程未响应集群命令: {message['command']}")
+            results = self.pending[call_id][1]
+        finally:
+            self.pending.pop(call_id, None)
+        return [results[node] for node in sorted(results) if results[node] is not None]
+
+    def peek_login(self, client_socket):
+        """偷看（不取走）登录消息。登录消息可能分几个包到达，一直看到能解析出
+        完整的 JSON 为止；超过握手超时或读满 LOGIN_PEEK_SIZE 仍不完整时抛出异常"""
+        deadline = time.monotonic() + self.handshake_timeout
+        seen = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("等待完整的登录消息超时")
+            client_socket.settimeout(remaining)
+            data = client_socket.recv(LOGIN_PEEK_SIZE, socket.MSG_PEEK)
+            if not data:
+                raise ConnectionError("连接在登录前关闭")
+            try:
+                # 只取第一个 JSON 值，客户端紧跟着发的消息不影响路由
+                return LOGIN_DECODER.raw_decode(data.decode(errors="replace").lstrip())[0]
+            except ValueError:
+                if len(data) >= LOGIN_PEEK_SIZE:
+                    raise
+            if len(data) == seen:
+                # MSG_PEEK 在缓冲区有数据时立刻返回，没有新数据时稍等再看
+                time.sleep(0.01)
+            seen = len(data)
+
+    def dispatch(self, client_socket, addr):
+        """偷看登录消息决定路由，然后把套接字交给工作进程"""
+        login_info = {}
+        try:
+            login_info = self.peek_login(client_socket)
+        except (OSError, ValueError) as e:
+            print(f"无法解析登录消息，按默认规则分配: {addr} ({e})")
+        if not isinstance(login_info, dict):
+            login_info = {}
+        with self.lock:
+            node = self.transfers.pop(login_info.get("token"), None) if isinstance(login_info.get("token"), str) else None
+            if node is not None:
+                self.online[str(login_info.get("username", ""))] = node
+            else:
+                node = route_node(login_info, self.workers, self.online)
+        try:
+            client_socket.settimeout(None)
+            with self.send_locks[node]:
+                socket.send_fds(self.handoffs[node], [json.dumps({"addr": list(addr)}).encode()],
+                                [client_socket.fileno()])
+            self.routed[node] += 1
+        except OSError as e:
+            print(f"转交连接到工作进程 {node} 失败: {e}")
+        finally:
+            # 工作进程已经拿到了自己的文件描述符副本
+            client_socket.close()
+
+    def stats(self):
+        return {
+            "workers": [{"node": node, "pid": process.pid, "alive": process.is_alive(), "routed": self.routed[node]}
+                        for node, process in enumerate(self.processes)],
+            "admission": self.admission.stats(),
+            "matchmaking": self.matchmaker.stats(),
+            "online": len(self.online)
+        }
+
+    def start(self):
+        self.spawn_workers()
+        self.scheduler.call_every(self.matchmaker.widen_interval, self.match_tick)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
+        print(f"集群前端已启动，监听地址: {self.host}:{self.port}，工作进程 {self.workers} 个")
+
+        while True:
+            client_socket, addr = self.server_socket.accept()
+            client_ip = addr[0]
+
+            reason = self.admission.admit(client_ip)
+            if reason:
+                reject_connection(client_socket, client_ip, reason)
+                continue
+
+            dispatcher = threading.Thread(target=self.dispatch, args=(client_socket, addr))
+            dispatcher.daemon = True
+            dispatcher.start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="多进程分片部署的五子棋服务器")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--workers", type=int, default=None, help="工作进程数，默认为CPU核数")
+    parser.add_argument("--ai", action="store_true", help="启用AI陪练")
+    parser.add_argument("--analysis", action="store_true", help="启用给观战者推送的局面分析")
+    parser.add_argument("--time-control", type=parse_time_control,
+                        help="默认计时规则，如 fischer:600+5 或 byoyomi:600+3x30，不指定则不计时")
+    args = parser.parse_args()
+
+    front = ClusterFront(args.host, args.port, args.workers,
+                         server_options={"ai_opponent": args.ai, "analysis": args.analysis,
+                                         "time_control": args.time_control})
+    front.start()
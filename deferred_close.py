@@ -0,0 +1,75 @@
+import queue
+import select
+import socket
+import threading
+import time
+
+
+class DeferredCloser:
+    """异步发送最后一条消息后再关闭连接，调用方无需等待
+
+    所有待关闭的连接由同一个线程用非阻塞发送统一刷出；超过 flush_timeout
+    仍未发完的连接直接关闭。这里只做 shutdown，真正的资源回收仍然交给
+    对应连接的 handle_client 的 finally 块。
+    """
+
+    def __init__(self, flush_timeout=2.0):
+        self.flush_timeout = flush_timeout
+        self.queue = queue.Queue()
+        self.pending = {}
+        self.thread = threading.Thread(target=self._run, name="deferred-closer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self, sock, data=b""):
+        self.queue.put((sock, data))
+
+    def close_many(self, items):
+        for sock, data in items:
+            self.queue.put((sock, data))
+
+    def _run(self):
+        while True:
+            timeout = 0.05 if self.pending else None
+            try:
+                sock, data = self.queue.get(timeout=timeout)
+                self._add(sock, data)
+                while True:
+                    sock, data = self.queue.get_nowait()
+                    self._add(sock, data)
+            except queue.Empty:
+                pass
+            if self.pending:
+                self._flush()
+
+    def _add(self, sock, data):
+        if sock in self.pending:
+            self.pending[sock][0] += data
+        else:
+            self.pending[sock] = [data, time.monotonic() + self.flush_timeout]
+
+    def _flush(self):
+        try:
+            _, writable, _ = select.select([], list(self.pending), [], 0.05)
+        except (OSError, ValueError, TypeError):
+            # 有连接已被关闭或不是真实的socket（如AI座位），逐个处理
+            writable = list(self.pending)
+
+        now = time.monotonic()
+        for sock in list(self.pending):
+            data, deadline = self.pending[sock]
+            if data and sock in writable:
+                try:
+                    sent = sock.send(data, getattr(socket, "MSG_DONTWAIT", 0))
+                    data = data[sent:]
+                    self.pending[sock][0] = data
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    data = b""
+            if not data or now >= deadline:
+                del self.pending[sock]
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
@@ -0,0 +1,101 @@
+import time
+
+SIDES = ("BLACK", "WHITE")
+
+
+class GameClock:
+    """一局棋的双方棋钟，支持 Fischer 加秒制和读秒制(byoyomi)
+
+    Fischer: 每方 initial 秒，每走一步加 increment 秒。
+    byoyomi: 每方 initial 秒基本时间，用完后每步必须在 period_time 秒内走完，
+    超出一次消耗一次读秒，periods 次用完判负。
+    """
+
+    def __init__(self, mode="fischer", initial=600, increment=5, periods=3, period_time=30):
+        if mode not in ("fischer", "byoyomi"):
+            raise ValueError(f"未知的计时方式: {mode}")
+        if initial < 0 or increment < 0 or periods < 0 or period_time <= 0:
+            raise ValueError("计时参数必须为非负数")
+        self.mode = mode
+        self.increment = increment
+        self.period_time = period_time
+        self.remaining = {side: float(initial) for side in SIDES}
+        self.periods = {side: periods for side in SIDES}
+        self.running = None
+        self.started_at = None
+        self.flagged = None
+
+    def start(self, side):
+        self.running = side
+        self.started_at = time.monotonic()
+
+    def time_left(self, side, now=None):
+        """该方从此刻起还能用多少秒才会超时"""
+        remaining = self.remaining[side]
+        if side == self.running:
+            remaining -= (now or time.monotonic()) - self.started_at
+        if self.mode == "byoyomi":
+            remaining += self.periods[side] * self.period_time
+        return remaining
+
+    def deadline(self):
+        """当前行棋方超时的 time.monotonic() 时刻"""
+        if self.running is None:
+            return None
+        return self.started_at + self.time_left(self.running, self.started_at)
+
+    def press(self, now=None):
+        """行棋方走完一步后按钟，超时返回 False，否则切换到对方"""
+        now = now or time.monotonic()
+        side = self.running
+        elapsed = now - self.started_at
+
+        if self.mode == "fischer":
+            self.remaining[side] -= elapsed
+            if self.remaining[side] <= 0:
+                self.remaining[side] = 0
+                self.flagged = side
+                return False
+            self.remaining[side] += self.increment
+        else:
+            overflow = elapsed - self.remaining[side]
+            self.remaining[side] = max(0.0, -overflow)
+            if overflow > 0:
+                used = int(overflow // self.period_time)
+                if used >= self.periods[side]:
+                    self.periods[side] = 0
+                    self.flagged = side
+                    return False
+                self.periods[side] -= used
+
+        self.start("WHITE" if side == "BLACK" else "BLACK")
+        return True
+
+    def stop(self):
+        self.running = None
+
+    def snapshot(self):
+        now = time.monotonic()
+        clock = {"mode": self.mode, "running": self.running}
+        for side in SIDES:
+            clock[side] = max(0, int(self.time_left(side, now) * 1000))
+        if self.mode == "byoyomi":
+            clock["periods"] = dict(self.periods)
+        return clock
+
+
+def parse_time_control(text):
+    """解析命令行上的计时规则："fischer:600+5" 或 "byoyomi:600+3x30"（基本时间+读秒次数x每次秒数）"""
+    try:
+        mode, spec = text.split(":")
+        initial, rest = spec.split("+")
+        if mode == "byoyomi":
+            periods, period_time = rest.split("x")
+            time_control = {"mode": mode, "initial": float(initial), "periods": int(periods),
+                            "period_time": float(period_time)}
+        else:
+            time_control = {"mode": mode, "initial": float(initial), "increment": float(rest)}
+    except ValueError:
+        raise ValueError(f"计时规则格式不正确: {text}")
+    GameClock(**time_control)
+    return time_control
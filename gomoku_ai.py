@@ -0,0 +1,291 @@
+import random
+import time
+
+from rules import BOARD_SIZE, EMPTY
+
+CELLS = BOARD_SIZE * BOARD_SIZE
+OPPONENT = {'B': 'W', 'W': 'B'}
+WIN_SCORE = 100000000
+
+# 棋型评分，c 代表己方棋子，空格代表空位
+PATTERN_SCORES = [
+    ("ccccc", 10000000),
+    (" cccc ", 100000),
+    ("cccc ", 10000),
+    (" cccc", 10000),
+    ("ccc c", 10000),
+    ("c ccc", 10000),
+    ("cc cc", 10000),
+    (" ccc ", 1000),
+    (" cc c ", 800),
+    (" c cc ", 800),
+    ("ccc  ", 100),
+    ("  ccc", 100),
+    (" cc ", 50),
+    (" c c ", 20),
+]
+PATTERNS = {
+    piece: [(pattern.replace("c", piece), score) for pattern, score in PATTERN_SCORES]
+    for piece in ('B', 'W')
+}
+
+
+def _build_lines():
+    lines = []
+    for x in range(BOARD_SIZE):
+        lines.append([x * BOARD_SIZE + y for y in range(BOARD_SIZE)])
+    for y in range(BOARD_SIZE):
+        lines.append([x * BOARD_SIZE + y for x in range(BOARD_SIZE)])
+    for start in range(-(BOARD_SIZE - 5), BOARD_SIZE - 4):
+        diag = [(x, x - start) for x in range(BOARD_SIZE) if 0 <= x - start < BOARD_SIZE]
+        lines.append([x * BOARD_SIZE + y for x, y in diag])
+        anti = [(x, start + BOARD_SIZE - 1 - x) for x in range(BOARD_SIZE)
+                if 0 <= start + BOARD_SIZE - 1 - x < BOARD_SIZE]
+        lines.append([x * BOARD_SIZE + y for x, y in anti])
+    return lines
+
+
+LINES = _build_lines()
+CELL_LINES = [[] for _ in range(CELLS)]
+for _line_id, _line in enumerate(LINES):
+    for _idx in _line:
+        CELL_LINES[_idx].append(_line_id)
+
+NEIGHBORS = []
+for _idx in range(CELLS):
+    _x, _y = divmod(_idx, BOARD_SIZE)
+    NEIGHBORS.append([
+        nx * BOARD_SIZE + ny
+        for nx in range(_x - 2, _x + 3) for ny in range(_y - 2, _y + 3)
+        if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE and (nx, ny) != (_x, _y)
+    ])
+
+_rng = random.Random(20240101)
+ZOBRIST = {piece: [_rng.getrandbits(64) for _ in range(CELLS)] for piece in ('B', 'W')}
+ZOBRIST_SIDE = _rng.getrandbits(64)
+
+
+def zobrist_hash(board):
+    h = 0
+    for x in range(BOARD_SIZE):
+        for y in range(BOARD_SIZE):
+            piece = board[x][y]
+            if piece != EMPTY:
+                h ^= ZOBRIST[piece][x * BOARD_SIZE + y]
+    return h
+
+
+_line_cache = {}
+
+
+def line_score(line):
+    """返回一条线上 黑方得分 - 白方得分"""
+    score = _line_cache.get(line)
+    if score is None:
+        score = 0
+        if 'B' in line:
+            for pattern, value in PATTERNS['B']:
+                score += line.count(pattern) * value
+        if 'W' in line:
+            for pattern, value in PATTERNS['W']:
+                score -= line.count(pattern) * value
+        if len(_line_cache) > 500000:
+            _line_cache.clear()
+        _line_cache[line] = score
+    return score
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchEngine:
+    """迭代加深的 alpha-beta 搜索，置换表以 Zobrist 哈希为键"""
+
+    def __init__(self, tt_size=1000000, branch_limit=12):
+        self.tt = {}
+        self.tt_size = tt_size
+        self.branch_limit = branch_limit
+        self.nodes = 0
+        self.deadline = 0
+
+    def load(self, board):
+        self.cells = [board[x][y] for x in range(BOARD_SIZE) for y in range(BOARD_SIZE)]
+        self.stones = [i for i, piece in enumerate(self.cells) if piece != EMPTY]
+        self.hash = 0
+        for i in self.stones:
+            self.hash ^= ZOBRIST[self.cells[i]][i]
+        self.line_values = [line_score("".join(self.cells[i] for i in line)) for line in LINES]
+        self.total = sum(self.line_values)
+
+    def place(self, idx, piece):
+        cells = self.cells
+        cells[idx] = piece
+        self.stones.append(idx)
+        self.hash ^= ZOBRIST[piece][idx]
+        self._rescore(idx)
+
+    def undo(self, idx):
+        piece = self.cells[idx]
+        self.cells[idx] = EMPTY
+        self.stones.pop()
+        self.hash ^= ZOBRIST[piece][idx]
+        self._rescore(idx)
+
+    def _rescore(self, idx):
+        cells = self.cells
+        values = self.line_values
+        for line_id in CELL_LINES[idx]:
+            value = line_score("".join([cells[i] for i in LINES[line_id]]))
+            self.total += value - values[line_id]
+            values[line_id] = value
+
+    def is_five(self, idx):
+        piece = self.cells[idx]
+        x, y = divmod(idx, BOARD_SIZE)
+        for dx, dy in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            count = 1
+            for sign in (1, -1):
+                nx, ny = x + dx * sign, y + dy * sign
+                while 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE and self.cells[nx * BOARD_SIZE + ny] == piece:
+                    count += 1
+                    nx, ny = nx + dx * sign, ny + dy * sign
+            if count >= 5:
+                return True
+        return False
+
+    def evaluate(self, piece):
+        return self.total if piece == 'B' else -self.total
+
+    def candidates(self, piece, tt_move=None):
+        cells = self.cells
+        seen = set()
+        for idx in self.stones:
+            for n in NEIGHBORS[idx]:
+                if cells[n] == EMPTY:
+                    seen.add(n)
+        if not seen:
+            return [CELLS // 2]
+
+        # 按落子后己方收益与替对方堵点的收益排序，只保留前若干个
+        sign = 1 if piece == 'B' else -1
+        opponent = OPPONENT[piece]
+        base = self.total
+        scored = []
+        for idx in seen:
+            self.place(idx, piece)
+            attack = (self.total - base) * sign
+            self.undo(idx)
+            self.place(idx, opponent)
+            defend = (base - self.total) * sign
+            self.undo(idx)
+            scored.append((attack + defend * 0.9, idx))
+        scored.sort(reverse=True)
+        moves = [idx for _, idx in scored[:self.branch_limit]]
+        if tt_move is not None and tt_move in seen:
+            if tt_move in moves:
+                moves.remove(tt_move)
+            moves.insert(0, tt_move)
+        return moves
+
+    def negamax(self, depth, alpha, beta, piece, ply):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+        key = self.hash ^ (ZOBRIST_SIDE if piece == 'W' else 0)
+        entry = self.tt.get(key)
+        tt_move = None
+        if entry is not None:
+            entry_depth, value, flag, tt_move = entry
+            if entry_depth >= depth:
+                if flag == 0:
+                    return value
+                if flag < 0 and value <= alpha:
+                    return value
+                if flag > 0 and value >= beta:
+                    return value
+
+        if depth == 0:
+            return self.evaluate(piece)
+
+        original_alpha = alpha
+        best_value = -WIN_SCORE * 2
+        best_move = None
+        opponent = OPPONENT[piece]
+        for idx in self.candidates(piece, tt_move):
+            self.place(idx, piece)
+            if self.is_five(idx):
+                value = WIN_SCORE - ply
+            elif len(self.stones) == CELLS:
+                value = 0
+            else:
+                value = -self.negamax(depth - 1, -beta, -alpha, opponent, ply + 1)
+            self.undo(idx)
+
+            if value > best_value:
+                best_value = value
+                best_move = idx
+            if value > alpha:
+                alpha = value
+            if alpha >= beta:
+                break
+
+        if best_value <= original_alpha:
+            flag = -1
+        elif best_value >= beta:
+            flag = 1
+        else:
+            flag = 0
+        if len(self.tt) >= self.tt_size:
+            self.tt.clear()
+        self.tt[key] = (depth, best_value, flag, best_move)
+        return best_value
+
+    def search(self, board, piece, time_limit=2.0, max_depth=8):
+        start = time.monotonic()
+        self.deadline = start + time_limit
+        self.nodes = 0
+        self.load(board)
+
+        best_move = None
+        best_value = 0
+        completed_depth = 0
+        for depth in range(1, max_depth + 1):
+            try:
+                value = self.negamax(depth, -WIN_SCORE * 2, WIN_SCORE * 2, piece, 0)
+            except SearchTimeout:
+                self.load(board)
+                break
+            key = self.hash ^ (ZOBRIST_SIDE if piece == 'W' else 0)
+            best_move = self.tt[key][3]
+            best_value = value
+            completed_depth = depth
+            if abs(value) >= WIN_SCORE - max_depth:
+                break
+
+        if best_move is None:
+            best_move = self.candidates(piece)[0]
+
+        elapsed = time.monotonic() - start
+        x, y = divmod(best_move, BOARD_SIZE)
+        return {
+            "x": x,
+            "y": y,
+            "score": best_value,
+            "depth": completed_depth,
+            "nodes": self.nodes,
+            "elapsed": elapsed,
+            "nps": int(self.nodes / elapsed) if elapsed > 0 else 0
+        }
+
+
+_engine = None
+
+
+def search_best_move(board, piece, time_limit=2.0, max_depth=8):
+    """供进程池调用的入口，引擎和置换表在工作进程内跨步复用"""
+    global _engine
+    if _engine is None:
+        _engine = SearchEngine()
+    return _engine.search(board, piece, time_limit, max_depth)
@@ -0,0 +1,176 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_RATING = 1500
+
+
+class QueueEntry:
+    __slots__ = ("key", "rating", "bucket", "enqueued_at", "active")
+
+    def __init__(self, key, rating, bucket, enqueued_at):
+        self.key = key
+        self.rating = rating
+        self.bucket = bucket
+        self.enqueued_at = enqueued_at
+        self.active = True
+
+
+class Matchmaker:
+    """按等级分分段的匹配队列
+
+    等级分按 bucket_width 分段，每段是一个按入队先后排列的 OrderedDict。
+    每个玩家的可接受分差从 base_window 开始，随等待时间按 widen_rate
+    每秒放宽，最多到 max_window；两人的分段距离不超过双方窗口中较大的
+    一个即可配对，所以等得久的玩家也能接住新来的玩家。
+
+    入队时只查看窗口内的分段（段数有上限），各段只看最早入队的人；窗口
+    放宽由一个按下次放宽时刻排序的堆驱动，tick() 只处理到期的条目，
+    入队、取消、配对都是 O(log n)。
+    """
+
+    def __init__(self, base_window=50, widen_rate=10, max_window=400, bucket_width=25,
+                 widen_interval=1.0, history=1000):
+        self.base_window = base_window
+        self.widen_rate = widen_rate
+        self.max_window = max_window
+        self.bucket_width = bucket_width
+        self.widen_interval = widen_interval
+        self.buckets = {}
+        self.entries = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.matched = 0
+        self.cancelled = 0
+        self.wait_times = deque(maxlen=history)
+        self.rating_gaps = deque(maxlen=history)
+
+    def reach(self, entry, now):
+        """当前窗口覆盖的分段数"""
+        window = min(self.max_window, self.base_window + self.widen_rate * (now - entry.enqueued_at))
+        return int(window // self.bucket_width)
+
+    def enqueue(self, key, rating=None, now=None):
+        """加入队列，能立即配对时返回 (先入队的key, key)，否则返回 None"""
+        now = time.monotonic() if now is None else now
+        rating = DEFAULT_RATING if rating is None else rating
+        with self.lock:
+            if key in self.entries:
+                self._remove(self.entries[key])
+            entry = QueueEntry(key, rating, int(rating // self.bucket_width), now)
+            self.enqueued += 1
+            opponent = self._find(entry, now)
+            if opponent is not None:
+                self._remove(opponent)
+                return self._pair(opponent, entry, now)
+            self._insert(entry, now)
+            return None
+
+    def cancel(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            self._remove(entry)
+            self.cancelled += 1
+            return True
+
+    def tick(self, now=None):
+        """放宽到期条目的窗口并重新尝试配对，返回新配成的对子列表"""
+        now = time.monotonic() if now is None else now
+        pairs = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, entry = heapq.heappop(self.heap)
+                if not entry.active:
+                    continue
+                opponent = self._find(entry, now)
+                if opponent is not None:
+                    self._remove(entry)
+                    self._remove(opponent)
+                    first, second = sorted((entry, opponent), key=lambda e: e.enqueued_at)
+                    pairs.append(self._pair(first, second, now))
+                elif self.reach(entry, now) * self.bucket_width < self.max_window:
+                    # 窗口已到上限的条目不用再放宽，之后的新玩家入队时会找到它
+                    heapq.heappush(self.heap, (now + self.widen_interval, next(self.counter), entry))
+        return pairs
+
+    def position(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            return {"rating": entry.rating, "waiting": round(time.monotonic() - entry.enqueued_at, 1),
+                    "queued": len(self.entries)}
+
+    def _insert(self, entry, now):
+        self.buckets.setdefault(entry.bucket, OrderedDict())[entry.key] = entry
+        self.entries[entry.key] = entry
+        heapq.heappush(self.heap, (now + self.widen_interval, next(self.counter), entry))
+
+    def _remove(self, entry):
+        # 堆里的条目惰性删除，弹出时发现 active 为 False 就跳过
+        entry.active = False
+        bucket = self.buckets[entry.bucket]
+        del bucket[entry.key]
+        if not bucket:
+            del self.buckets[entry.bucket]
+        del self.entries[entry.key]
+
+    def _oldest(self, bucket_index, exclude):
+        bucket = self.buckets.get(bucket_index)
+        if not bucket:
+            return None
+        for entry in bucket.values():
+            if entry is not exclude:
+                return entry
+        return None
+
+    def _find(self, entry, now):
+        own_reach = self.reach(entry, now)
+        max_reach = self.max_window // self.bucket_width
+        for distance in range(max_reach + 1):
+            best = None
+            for index in {entry.bucket - distance, entry.bucket + distance}:
+                candidate = self._oldest(index, entry)
+                if candidate is None or distance > max(own_reach, self.reach(candidate, now)):
+                    continue
+                if best is None or candidate.enqueued_at < best.enqueued_at:
+                    best = candidate
+            if best is not None:
+                return best
+        return None
+
+    def _pair(self, first, second, now):
+        self.matched += 1
+        self.wait_times.append(now - first.enqueued_at)
+        self.wait_times.append(now - second.enqueued_at)
+        self.rating_gaps.append(abs(first.rating - second.rating))
+        return first.key, second.key
+
+    def stats(self):
+        with self.lock:
+            waits = sorted(self.wait_times)
+            gaps = list(self.rating_gaps)
+            now = time.monotonic()
+            longest = max((now - entry.enqueued_at for entry in self.entries.values()), default=0.0)
+            queued = len(self.entries)
+
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))], 2) if waits else 0.0
+
+        return {
+            "queued": queued,
+            "enqueued": self.enqueued,
+            "matched_pairs": self.matched,
+            "cancelled": self.cancelled,
+            "wait_p50": percentile(0.5),
+            "wait_p90": percentile(0.9),
+            "wait_max": round(waits[-1], 2) if waits else 0.0,
+            "longest_waiting": round(longest, 2),
+            "mean_rating_gap": round(sum(gaps) / len(gaps), 1) if gaps else 0.0
+        }
@@ -0,0 +1,359 @@
+import argparse
+import hashlib
+import hmac
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from ratings import expected_score
+
+PBKDF2_ITERATIONS = 200000
+DEFAULT_RATING = 1500.0
+
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations)
+    return f"pbkdf2_sha256${iterations}${salt}${digest.hex()}"
+
+
+def verify_password(password, encoded):
+    try:
+        _, iterations, salt, _ = encoded.split("$")
+        return hmac.compare_digest(hash_password(password, salt, int(iterations)), encoded)
+    except (ValueError, AttributeError):
+        return False
+
+
+def token_key(token):
+    # 库里只存令牌的摘要，数据库泄露也不能直接拿来登录
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def new_account(username, password_hash, is_admin=False):
+    now = time.time()
+    return {
+        "username": username,
+        "password_hash": password_hash,
+        "is_admin": is_admin,
+        "rating": DEFAULT_RATING,
+        "games": 0,
+        "wins": 0,
+        "losses": 0,
+        "draws": 0,
+        "created_at": now,
+        "last_seen": now
+    }
+
+
+class PlayerBackend:
+    """玩家数据的持久化接口，PlayerStore 只通过这些方法访问存储"""
+
+    def load_account(self, username):
+        raise NotImplementedError
+
+    def load_recent(self, limit):
+        raise NotImplementedError
+
+    def load_usernames(self):
+        raise NotImplementedError
+
+    def load_session(self, key):
+        raise NotImplementedError
+
+    def apply(self, accounts, sessions, revoked):
+        """在一个事务里写入一批账号、会话，并删除作废的会话"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+ACCOUNT_FIELDS = ("username", "password_hash", "is_admin", "rating", "games", "wins",
+                  "losses", "draws", "created_at", "last_seen")
+
+
+class SQLiteBackend(PlayerBackend):
+    def __init__(self, path="players.db"):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS accounts (
+                    username TEXT PRIMARY KEY, password_hash TEXT, is_admin INTEGER,
+                    rating REAL, games INTEGER, wins INTEGER, losses INTEGER, draws INTEGER,
+                    created_at REAL, last_seen REAL
+                );
+                CREATE TABLE IF NOT EXISTS sessions (
+                    token TEXT PRIMARY KEY, username TEXT, expires_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_accounts_last_seen ON accounts(last_seen);
+            """)
+            self.db.commit()
+
+    def _account(self, row):
+        if row is None:
+            return None
+        account = dict(zip(ACCOUNT_FIELDS, row))
+        account["is_admin"] = bool(account["is_admin"])
+        return account
+
+    def load_account(self, username):
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM accounts WHERE username = ?",
+                                  (username,)).fetchone()
+        return self._account(row)
+
+    def load_recent(self, limit):
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM accounts "
+                                   "ORDER BY last_seen DESC LIMIT ?", (limit,)).fetchall()
+        return [self._account(row) for row in rows]
+
+    def load_usernames(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT username FROM accounts")]
+
+    def load_session(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT username, expires_at FROM sessions WHERE token = ?", (key,)).fetchone()
+        return row
+
+    def apply(self, accounts, sessions, revoked):
+        with self.lock:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO accounts ({', '.join(ACCOUNT_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(ACCOUNT_FIELDS))})",
+                [tuple(account[field] for field in ACCOUNT_FIELDS) for account in accounts])
+            self.db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", sessions)
+            self.db.executemany("DELETE FROM sessions WHERE token = ?", [(key,) for key in revoked])
+            self.db.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class PlayerStore:
+    """账号、等级分和会话令牌
+
+    热点账号缓存在内存里，启动时预热最近活跃的一批；所有写入都交给后台
+    线程合并成批量事务，登录和对局结束的路径上不做同步的磁盘写入。
+    """
+
+    def __init__(self, backend=None, cache_size=10000, session_ttl=7 * 86400, flush_interval=0.5, k=32):
+        self.backend = backend or SQLiteBackend()
+        self.cache_size = cache_size
+        self.session_ttl = session_ttl
+        self.flush_interval = flush_interval
+        self.k = k
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.sessions = {}
+        self.dirty = {}
+        self.new_sessions = {}
+        self.revoked = set()
+        self.wakeup = queue.Queue()
+        # 全部已注册的用户名常驻内存，游客登录判断重名时不用查库
+        self.names = set(self.backend.load_usernames())
+        for account in reversed(self.backend.load_recent(cache_size)):
+            self.cache[account["username"]] = account
+        self.thread = threading.Thread(target=self._run, name="player-store")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _cached(self, username):
+        account = self.cache.get(username)
+        if account is not None:
+            self.cache.move_to_end(username)
+        return account
+
+    def _remember(self, account):
+        self.cache[account["username"]] = account
+        self.cache.move_to_end(account["username"])
+        while len(self.cache) > self.cache_size:
+            name, _ = self.cache.popitem(last=False)
+            # 还没落盘的账号不能丢，否则下次未命中会读到旧数据
+            if name in self.dirty:
+                self.cache[name] = self.dirty[name]
+                break
+
+    def _mark_dirty(self, account):
+        self.dirty[account["username"]] = account
+        self.wakeup.put_nowait(None)
+
+    def get(self, username):
+        with self.lock:
+            account = self._cached(username)
+        if account is None:
+            account = self.backend.load_account(username)
+            if account is not None:
+                with self.lock:
+                    account = self._cached(username) or account
+                    self._remember(account)
+        return account
+
+    def exists(self, username):
+        with self.lock:
+            return username in self.names
+
+    def register(self, username, password):
+        """注册新账号并返回，用户名已被注册时抛出 ValueError"""
+        if self.exists(username) or self.get(username) is not None:
+            raise ValueError("该用户名已注册")
+        password_hash = hash_password(password)
+        with self.lock:
+            if username in self.names:
+                raise ValueError("该用户名已注册")
+            account = new_account(username, password_hash)
+            self.names.add(username)
+            self._remember(account)
+            self._mark_dirty(account)
+        return account
+
+    def authenticate(self, username, password):
+        """校验密码并返回账号，失败抛出 ValueError"""
+        account = self.get(username) if self.exists(username) else None
+        if account is None:
+            raise ValueError("账号不存在，请先注册")
+        if not verify_password(password, account["password_hash"]):
+            raise ValueError("用户名或密码错误")
+        with self.lock:
+            account["last_seen"] = time.time()
+            self._mark_dirty(account)
+        return account
+
+    def create_session(self, username):
+        token = secrets.token_urlsafe(24)
+        key = token_key(token)
+        expires_at = time.time() + self.session_ttl
+        with self.lock:
+            self.sessions[key] = (username, expires_at)
+            self.new_sessions[key] = (key, username, expires_at)
+            self.wakeup.put_nowait(None)
+        return token
+
+    def resume(self, token):
+        """凭会话令牌登录，不需要重新计算密码摘要。令牌无效返回 None"""
+        key = token_key(token)
+        with self.lock:
+            session = self.sessions.get(key)
+        if session is None:
+            session = self.backend.load_session(key)
+            if session is None:
+                return None
+            with self.lock:
+                self.sessions[key] = session
+        username, expires_at = session
+        if expires_at < time.time():
+            self.revoke(token)
+            return None
+        account = self.get(username)
+        if account is not None:
+            with self.lock:
+                account["last_seen"] = time.time()
+                self._mark_dirty(account)
+        return account
+
+    def revoke(self, token):
+        key = token_key(token)
+        with self.lock:
+            self.sessions.pop(key, None)
+            self.new_sessions.pop(key, None)
+            self.revoked.add(key)
+            self.wakeup.put_nowait(None)
+
+    def record_result(self, black, white, winner=None):
+        """对局结束时更新双方等级分，winner 为胜方棋子 'B' / 'W'，None 表示和棋。返回双方新的等级分"""
+        black_account, white_account = self.get(black), self.get(white)
+        if black_account is None or white_account is None:
+            return None
+        with self.lock:
+            score = 0.5 if winner is None else (1.0 if winner == 'B' else 0.0)
+            delta = self.k * (score - expected_score(black_account["rating"], white_account["rating"]))
+            black_account["rating"] += delta
+            white_account["rating"] -= delta
+            for account, result in ((black_account, score), (white_account, 1.0 - score)):
+                account["games"] += 1
+                if result == 1.0:
+                    account["wins"] += 1
+                elif result == 0.0:
+                    account["losses"] += 1
+                else:
+                    account["draws"] += 1
+                self._mark_dirty(account)
+            return {black: round(black_account["rating"]), white: round(white_account["rating"])}
+
+    def set_admin(self, username, is_admin=True):
+        account = self.get(username)
+        if account is None:
+            return False
+        with self.lock:
+            account["is_admin"] = is_admin
+            self._mark_dirty(account)
+        return True
+
+    def flush(self):
+        with self.lock:
+            accounts = [dict(account) for account in self.dirty.values()]
+            sessions = list(self.new_sessions.values())
+            revoked = list(self.revoked)
+            self.dirty.clear()
+            self.new_sessions.clear()
+            self.revoked.clear()
+        if accounts or sessions or revoked:
+            self.backend.apply(accounts, sessions, revoked)
+
+    def _run(self):
+        while True:
+            self.wakeup.get()
+            # 稍等一会儿，把这段时间内的写入合并成一个事务
+            time.sleep(self.flush_interval)
+            while not self.wakeup.empty():
+                self.wakeup.get_nowait()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"保存玩家数据失败: {e}")
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="玩家账号管理")
+    parser.add_argument("--db", default="players.db", help="SQLite玩家库路径")
+    parser.add_argument("--create", metavar="USERNAME", help="创建账号（密码从 --password 读取）")
+    parser.add_argument("--password", help="新账号的密码")
+    parser.add_argument("--make-admin", metavar="USERNAME", help="授予管理员权限")
+    parser.add_argument("--revoke-admin", metavar="USERNAME", help="撤销管理员权限")
+    parser.add_argument("--top", type=int, default=0, help="列出等级分最高的若干名玩家")
+    args = parser.parse_args()
+
+    store = PlayerStore(SQLiteBackend(args.db))
+    if args.create:
+        if not args.password:
+            parser.error("创建账号需要 --password")
+        if store.exists(args.create):
+            print(f"用户名已存在: {args.create}")
+        else:
+            store.register(args.create, args.password)
+            print(f"已创建账号: {args.create}")
+    for username, flag in ((args.make_admin, True), (args.revoke_admin, False)):
+        if username:
+            if store.set_admin(username, flag):
+                print(f"已{'授予' if flag else '撤销'} {username} 的管理员权限")
+            else:
+                print(f"账号不存在: {username}")
+    store.flush()
+    if args.top:
+        for account in sorted(store.backend.load_recent(10 ** 9), key=lambda a: -a["rating"])[:args.top]:
+            print(f"{account['username']:<16} {account['rating']:>7.1f}  "
+                  f"胜 {account['wins']}  负 {account['losses']}  和 {account['draws']}")
+    store.close()
@@ -0,0 +1,290 @@
+import argparse
+import heapq
+import json
+import mmap
+import os
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from archive import ArchiveReader, read_record
+from rules import BOARD_SIZE, EMPTY, transform
+from gomoku_ai import ZOBRIST, CELLS
+
+# 局面索引文件格式（全部大端）：
+#
+#   | 文件头 | 倒排记录 × posting_count | 开局库记录 × book_count |
+#
+# 倒排记录: 局面哈希(8) 对局序号(4) 下一手x(1) 下一手y(1) 结果(1)
+# 开局库记录: 局面哈希(8) 下一手x(1) 下一手y(1) 对局数(4) 黑胜(4) 白胜(4)
+#
+# 局面在 8 种对称变换下取 Zobrist 哈希最小的一种作为规范形式，下一手也
+# 换算到规范方向保存。两段记录都按字节序排好，大端编码下字节序就是
+# (哈希, ...) 的数值顺序，查询时在 mmap 上二分即可。对局序号对应
+# .games 文件中的第几行对局ID。
+
+MAGIC = b"GPIX"
+# 版本 2 起索引包含空棋盘局面，旧索引需要重建
+VERSION = 2
+HEADER = struct.Struct(">4sBQQH")
+POSTING = struct.Struct(">QIBBB")
+BOOK = struct.Struct(">QBBIII")
+HASH = struct.Struct(">Q")
+
+NO_MOVE = 255
+RESULT_NONE, RESULT_BLACK, RESULT_WHITE, RESULT_DRAW = 0, 1, 2, 3
+
+# TRANSFORMED[k][idx]: 第 k 种对称变换后格子的下标
+TRANSFORMED = [
+    [a * BOARD_SIZE + b for a, b in (transform(idx // BOARD_SIZE, idx % BOARD_SIZE, k) for idx in range(CELLS))]
+    for k in range(8)
+]
+
+
+def inverse_transform(k):
+    """镜像类变换是自身的逆，纯旋转的逆是反向旋转"""
+    return k if k & 4 else (4 - k) % 4
+
+
+def canonical_hash(board):
+    """返回 (规范哈希, 取到规范形式的变换编号)"""
+    hashes = [0] * 8
+    for x in range(BOARD_SIZE):
+        for y in range(BOARD_SIZE):
+            piece = board[x][y]
+            if piece != EMPTY:
+                idx = x * BOARD_SIZE + y
+                for k in range(8):
+                    hashes[k] ^= ZOBRIST[piece][TRANSFORMED[k][idx]]
+    best = min(range(8), key=hashes.__getitem__)
+    return hashes[best], best
+
+
+def game_result(replay, moves):
+    players = {}
+    for move in moves:
+        players.setdefault(move["piece"], move.get("username"))
+    winner = replay.get("winner")
+    if winner is None:
+        return RESULT_NONE
+    if winner == players.get('B'):
+        return RESULT_BLACK
+    if winner == players.get('W'):
+        return RESULT_WHITE
+    if winner == "平局":
+        return RESULT_DRAW
+    return RESULT_NONE
+
+
+def extract_positions(task):
+    """工作进程入口：返回一局棋每个局面的 (规范哈希, 规范方向的下一手, 结果)"""
+    path, max_ply = task
+    try:
+        if isinstance(path, tuple):
+            # 归档里的对局：(段文件, 偏移, 长度)
+            replay = read_record(*path)["replay"]
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                replay = json.load(f)
+    except Exception as e:
+        return path, None, None, str(e)
+    moves = replay.get("moves", [])
+    result = game_result(replay, moves)
+    hashes = [0] * 8
+    positions = []
+    # 从空棋盘开始记录，第一手的统计挂在空棋盘（哈希 0）下面
+    for move in moves[:max_ply + 1]:
+        idx = move["x"] * BOARD_SIZE + move["y"]
+        best = min(range(8), key=hashes.__getitem__)
+        nx, ny = divmod(TRANSFORMED[best][idx], BOARD_SIZE)
+        positions.append((hashes[best], nx, ny, result))
+        for k in range(8):
+            hashes[k] ^= ZOBRIST[move["piece"]][TRANSFORMED[k][idx]]
+    if 0 < len(moves) <= max_ply:
+        positions.append((min(hashes), NO_MOVE, NO_MOVE, result))
+    return path, replay.get("game_id") or os.path.basename(path)[:-5], positions, None
+
+
+def _read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            record = f.read(POSTING.size)
+            if not record:
+                return
+            yield record
+
+
+def _write_run(records, directory):
+    records.sort()
+    fd, path = tempfile.mkstemp(suffix=".run", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(b"".join(records))
+    return path
+
+
+def build_index(replay_dir="replays", path="positions.idx", max_ply=40, workers=None, run_size=2000000,
+                archive_dir="archive"):
+    """从回放目录和归档重建局面索引。记录分批排序写入临时文件，最后多路归并，内存占用与对局数无关"""
+    files = sorted(entry.path for entry in os.scandir(replay_dir)
+                   if entry.name.endswith(".json") and entry.is_file()) if os.path.isdir(replay_dir) else []
+    loose = {os.path.basename(f)[:-5] for f in files}
+    files += ArchiveReader(archive_dir).locations(exclude=loose)
+    directory = os.path.dirname(os.path.abspath(path))
+    runs = []
+    buffer = []
+    game_ids = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for file_path, game_id, positions, error in pool.map(
+                    extract_positions, [(f, max_ply) for f in files], chunksize=64):
+                if error:
+                    print(f"跳过无法解析的文件 {file_path}: {error}")
+                    continue
+                number = len(game_ids)
+                game_ids.append(game_id)
+                buffer.extend(POSTING.pack(h, number, x, y, r) for h, x, y, r in positions)
+                if len(buffer) >= run_size:
+                    runs.append(_write_run(buffer, directory))
+                    buffer = []
+        if buffer:
+            runs.append(_write_run(buffer, directory))
+
+        book_fd, book_path = tempfile.mkstemp(suffix=".book", dir=directory)
+        runs.append(book_path)
+        postings = 0
+        books = 0
+        with open(path + ".tmp", "wb") as out, os.fdopen(book_fd, "wb") as book_out:
+            out.write(HEADER.pack(MAGIC, VERSION, 0, 0, max_ply))
+            current = None
+            stats = {}
+
+            def flush_book():
+                nonlocal books
+                for (x, y), (games, black, white) in sorted(stats.items()):
+                    book_out.write(BOOK.pack(current, x, y, games, black, white))
+                    books += 1
+                stats.clear()
+
+            for record in heapq.merge(*(_read_run(run) for run in runs[:-1])):
+                out.write(record)
+                postings += 1
+                h, _, x, y, result = POSTING.unpack(record)
+                if h != current:
+                    flush_book()
+                    current = h
+                entry = stats.setdefault((x, y), [0, 0, 0])
+                entry[0] += 1
+                entry[1] += result == RESULT_BLACK
+                entry[2] += result == RESULT_WHITE
+            flush_book()
+            book_out.flush()
+
+            with open(book_path, "rb") as f:
+                while True:
+                    chunk = f.read(1 << 20)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, postings, books, max_ply))
+
+        with open(path + ".games.tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(game_ids))
+        os.replace(path + ".games.tmp", games_path(path))
+        os.replace(path + ".tmp", path)
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+    return len(game_ids), postings, books
+
+
+def games_path(path):
+    return os.path.splitext(path)[0] + ".games"
+
+
+class PositionIndex:
+    """只读的局面索引，查询走 mmap 二分，不把索引读进内存"""
+
+    def __init__(self, path="positions.idx"):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.posting_count, self.book_count, self.max_ply = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"不是有效的局面索引文件: {path}")
+        self.posting_base = HEADER.size
+        self.book_base = self.posting_base + self.posting_count * POSTING.size
+        with open(games_path(path), "r", encoding="utf-8") as f:
+            self.game_ids = f.read().split("\n")
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def _lower_bound(self, base, size, count, h):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if HASH.unpack_from(self.mm, base + mid * size)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _records(self, base, record, count, h):
+        i = self._lower_bound(base, record.size, count, h)
+        while i < count:
+            values = record.unpack_from(self.mm, base + i * record.size)
+            if values[0] != h:
+                return
+            yield values
+            i += 1
+
+    def book(self, board):
+        """该局面之后各下一手的对局数和胜负，坐标已换回 board 的方向"""
+        h, k = canonical_hash(board)
+        inverse = inverse_transform(k)
+        moves = []
+        for _, x, y, games, black, white in self._records(self.book_base, BOOK, self.book_count, h):
+            entry = {"games": games, "black_wins": black, "white_wins": white}
+            if x != NO_MOVE:
+                entry["x"], entry["y"] = transform(x, y, inverse)
+            moves.append(entry)
+        moves.sort(key=lambda m: -m["games"])
+        return moves
+
+    def games(self, board, limit=20):
+        """经过该局面的对局ID（最多 limit 个）"""
+        h, _ = canonical_hash(board)
+        result = []
+        for _, number, _, _, _ in self._records(self.posting_base, POSTING, self.posting_count, h):
+            if len(result) >= limit:
+                break
+            result.append(self.game_ids[number])
+        return result
+
+    def query(self, board, limit=20):
+        book = self.book(board)
+        return {
+            "games": sum(entry["games"] for entry in book),
+            "black_wins": sum(entry["black_wins"] for entry in book),
+            "white_wins": sum(entry["white_wins"] for entry in book),
+            "book": [entry for entry in book if "x" in entry][:limit],
+            "game_ids": self.games(board, limit)
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="从回放目录和归档构建局面索引与开局库")
+    parser.add_argument("--replays", default="replays", help="回放目录")
+    parser.add_argument("--output", default="positions.idx", help="索引文件路径")
+    parser.add_argument("--max-ply", type=int, default=40, help="每局最多索引前几手")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数，默认为CPU核数")
+    parser.add_argument("--archive", default="archive", help="归档目录，见 archive.py")
+    args = parser.parse_args()
+
+    games, postings, books = build_index(args.replays, args.output, args.max_ply, args.workers,
+                                         archive_dir=args.archive)
+    print(f"已索引 {games} 局对局，{postings} 个局面记录，{books} 条开局库记录")
@@ -0,0 +1,52 @@
+from collections import deque
+
+# 棋桌的在线名单，带版本号。每次变化（加入、离开、状态改变）版本号加一，
+# 随对应的 user_joined / user_left / player_disconnected 等消息一起下发。
+# 新成员先收到分页的名单快照，之后只收增量；客户端发现版本号跳号时发
+# presence_sync，最近的变化还在日志里就补发增量，否则重发快照。
+
+PAGE_SIZE = 200
+
+
+class Presence:
+    def __init__(self, log_size=1000):
+        self.entries = {}
+        self.version = 0
+        self.log = deque(maxlen=log_size)
+
+    def apply(self, op, entry):
+        """op 为 add / update / remove，返回新的版本号"""
+        username = entry["username"]
+        if op == "remove":
+            if self.entries.pop(username, None) is None:
+                return self.version
+        elif op == "update":
+            if username not in self.entries:
+                return self.version
+            self.entries[username] = dict(self.entries[username], **entry)
+            entry = self.entries[username]
+        else:
+            self.entries[username] = entry
+        self.version += 1
+        self.log.append((self.version, op, entry))
+        return self.version
+
+    def since(self, version):
+        """version 之后的全部变化；日志里已经找不到时返回 None"""
+        if version == self.version:
+            return []
+        if not self.log or version < self.log[0][0] - 1 or version > self.version:
+            return None
+        return [{"version": v, "op": op, "user": entry} for v, op, entry in self.log if v > version]
+
+    def pages(self, table_id, page_size=PAGE_SIZE):
+        users = list(self.entries.values())
+        total = len(users)
+        offset = 0
+        while True:
+            page = users[offset:offset + page_size]
+            yield {"type": "presence", "table_id": table_id, "version": self.version, "offset": offset,
+                   "total": total, "users": page, "done": offset + page_size >= total}
+            offset += page_size
+            if offset >= total:
+                return
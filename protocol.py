@@ -0,0 +1,207 @@
+import json
+import struct
+import zlib
+
+# 紧凑编码：客户端在 login 消息中带上 "encoding": "compact"（可选
+# "compression": "zlib"）后，服务器发给它的消息改用二进制帧：
+#
+#   | 长度(4字节, 大端, 不含自身) | 标志(1字节) | 类型ID(1字节) | 负载 |
+#
+# 普通消息的负载是去掉 "type" 字段的 JSON，超过阈值时可用 zlib 压缩；
+# 落子与回合合并为一个定长的 MOVE_TURN 帧，玩家以会话内的玩家表序号表示。
+# 未协商的客户端仍然收到原来的 JSON 文本，JSON 总以 "{" 开头，
+# 而帧的首字节是长度的最高字节，不会与之冲突，解码器据此区分两种格式。
+
+MESSAGE_TYPES = [
+    "role", "game_start", "move_made", "turn", "game_over", "game_force_end",
+    "board", "chat", "broadcast", "error", "user_joined", "user_left",
+    "move_history", "chat_history", "user_list", "banned", "rejected", "kicked",
+    "cheat_detected", "cheating", "ping", "pong", "admin_response", "server_stats",
+    "analysis", "position_info", "session", "ratings", "match_status", "table_list",
+    "resume", "player_disconnected", "player_reconnected", "server_restart",
+    "presence", "replay_data", "replay_list",
+]
+TYPE_IDS = {name: i + 1 for i, name in enumerate(MESSAGE_TYPES)}
+TYPE_NAMES = {i: name for name, i in TYPE_IDS.items()}
+
+MOVE_TURN = 0x80
+PLAYER_TABLE = 0x81
+MOVE_TURN_CLOCK = 0x82
+GENERIC = 0xFF  # 没有分配编号的消息类型，负载中保留完整 JSON
+
+FLAG_ZLIB = 0x01
+HEADER = struct.Struct(">IBB")
+MOVE_TURN_BODY = struct.Struct(">BBBBB")
+# 带棋钟的合并帧：在 MOVE_TURN 后追加双方剩余毫秒数、读秒次数和计时方式
+MOVE_TURN_CLOCK_BODY = struct.Struct(">BBBBBIIBBB")
+CLOCK_MODES = {"fischer": 0, "byoyomi": 1}
+CLOCK_MODE_NAMES = {0: "fischer", 1: "byoyomi"}
+PIECES = {'B': 1, 'W': 2}
+PIECE_NAMES = {1: 'B', 2: 'W'}
+TURNS = {None: 0, "BLACK": 1, "WHITE": 2}
+TURN_NAMES = {1: "BLACK", 2: "WHITE"}
+
+COMPRESS_THRESHOLD = 512
+
+# WebSocket 连接（见 websocket_gateway.py）收到的是装在文本帧里的 JSON，
+# 帧的负载直接复用 JSON 编码的缓存。协商了 permessage-deflate 时服务器
+# 不保留压缩上下文（server_no_context_takeover），同一条消息压缩后对所有
+# 连接都一样，也可以只压缩一次。
+WS_TEXT = 0x1
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+WS_FIN = 0x80
+WS_RSV1 = 0x40
+
+
+class WebSocketFrame(bytes):
+    """已经封装好的 WebSocket 帧，连接发送时原样写出，不再封装"""
+
+
+def deflate_message(payload):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4] if data.endswith(b"\x00\x00\xff\xff") else data
+
+
+def encode_ws_frame(payload, compress=False, opcode=WS_TEXT):
+    first = WS_FIN | opcode
+    if compress and len(payload) > COMPRESS_THRESHOLD:
+        payload = deflate_message(payload)
+        first |= WS_RSV1
+    length = len(payload)
+    if length < 126:
+        header = struct.pack(">BB", first, length)
+    elif length < 65536:
+        header = struct.pack(">BBH", first, 126, length)
+    else:
+        header = struct.pack(">BBQ", first, 127, length)
+    return WebSocketFrame(header + payload)
+
+
+def encode_json(message):
+    return json.dumps(message).encode()
+
+
+def _frame(type_id, body, compress):
+    flags = 0
+    if compress and len(body) > COMPRESS_THRESHOLD:
+        packed = zlib.compress(body)
+        if len(packed) < len(body):
+            body = packed
+            flags |= FLAG_ZLIB
+    return HEADER.pack(len(body) + 2, flags, type_id) + body
+
+
+def encode_frame(message, compress=False):
+    type_id = TYPE_IDS.get(message.get("type"))
+    if type_id is None:
+        return _frame(GENERIC, encode_json(message), compress)
+    payload = {k: v for k, v in message.items() if k != "type"}
+    return _frame(type_id, encode_json(payload), compress)
+
+
+def encode_move_turn(x, y, player_index, piece, next_turn, clock=None):
+    """next_turn 为 None 表示这一步之后没有回合消息（例如游戏结束）"""
+    if clock is None:
+        body = MOVE_TURN_BODY.pack(x, y, player_index, PIECES[piece], TURNS[next_turn])
+        return HEADER.pack(len(body) + 2, 0, MOVE_TURN) + body
+    periods = clock.get("periods", {})
+    body = MOVE_TURN_CLOCK_BODY.pack(
+        x, y, player_index, PIECES[piece], TURNS[next_turn],
+        clock["BLACK"], clock["WHITE"], periods.get("BLACK", 0), periods.get("WHITE", 0),
+        CLOCK_MODES[clock["mode"]])
+    return HEADER.pack(len(body) + 2, 0, MOVE_TURN_CLOCK) + body
+
+
+def encode_player_table(players, compress=False):
+    return _frame(PLAYER_TABLE, encode_json({"players": players}), compress)
+
+
+class Encoder:
+    """按连接的编码方式缓存一条消息的序列化结果，广播时每种格式只编码一次"""
+
+    def __init__(self, message):
+        self.message = message
+        self.cache = {}
+
+    def get(self, encoding, compress=False):
+        key = (encoding, compress)
+        data = self.cache.get(key)
+        if data is None:
+            if encoding == "compact":
+                data = encode_frame(self.message, compress)
+            elif encoding == "websocket":
+                data = encode_ws_frame(self.get("json"), compress)
+            else:
+                data = encode_json(self.message)
+            self.cache[key] = data
+        return data
+
+
+class FrameDecoder:
+    """把收到的字节流还原成与 JSON 协议相同的消息字典"""
+
+    def __init__(self):
+        self.buffer = b""
+        self.players = []
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while self.buffer:
+            if self.buffer[:1] == b"{":
+                text = self.buffer.decode(errors="ignore")
+                try:
+                    message, end = self.decoder.raw_decode(text)
+                except json.JSONDecodeError:
+                    break
+                self.buffer = self.buffer[len(text[:end].encode()):]
+                messages.append(message)
+                continue
+
+            if len(self.buffer) < 4:
+                break
+            length = struct.unpack_from(">I", self.buffer)[0]
+            if len(self.buffer) < 4 + length:
+                break
+            flags, type_id = self.buffer[4], self.buffer[5]
+            body = self.buffer[6:4 + length]
+            self.buffer = self.buffer[4 + length:]
+            if flags & FLAG_ZLIB:
+                body = zlib.decompress(body)
+            messages.extend(self.decode_body(type_id, body))
+        return messages
+
+    def decode_body(self, type_id, body):
+        if type_id == MOVE_TURN:
+            x, y, index, piece, turn = MOVE_TURN_BODY.unpack(body)
+            username = self.players[index] if index < len(self.players) else "未知"
+            messages = [{"type": "move_made", "x": x, "y": y,
+                         "piece": PIECE_NAMES[piece], "username": username}]
+            if turn:
+                messages.append({"type": "turn", "turn": TURN_NAMES[turn]})
+            return messages
+        if type_id == MOVE_TURN_CLOCK:
+            x, y, index, piece, turn, black_ms, white_ms, black_periods, white_periods, mode = \
+                MOVE_TURN_CLOCK_BODY.unpack(body)
+            username = self.players[index] if index < len(self.players) else "未知"
+            messages = [{"type": "move_made", "x": x, "y": y,
+                         "piece": PIECE_NAMES[piece], "username": username}]
+            if turn:
+                clock = {"mode": CLOCK_MODE_NAMES[mode], "running": TURN_NAMES[turn],
+                         "BLACK": black_ms, "WHITE": white_ms}
+                if clock["mode"] == "byoyomi":
+                    clock["periods"] = {"BLACK": black_periods, "WHITE": white_periods}
+                messages.append({"type": "turn", "turn": TURN_NAMES[turn], "clock": clock})
+            return messages
+        if type_id == PLAYER_TABLE:
+            self.players = json.loads(body)["players"]
+            return []
+        message = json.loads(body)
+        if type_id != GENERIC:
+            message["type"] = TYPE_NAMES[type_id]
+        return [message]
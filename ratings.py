@@ -0,0 +1,6 @@
+# Elo 等级分的公共部分，服务器的账号库和离线锦标赛共用
+
+
+def expected_score(rating, other):
+    """rating 一方对 other 一方的期望得分"""
+    return 1 / (1 + 10 ** ((other - rating) / 400))
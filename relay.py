@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from protocol import Encoder, FrameDecoder, encode_json, encode_move_turn, encode_player_table
+from rules import EMPTY, new_board
+
+# 观战转发节点：以只读订阅者身份登录上游（服务器或另一个转发节点），
+# 每条广播只收一次，再转发给连到本节点的观战者。本节点维护一份棋桌
+# 镜像，新观战者加入时按服务器的方式发送快照，所以转发节点可以串联。
+
+FORWARD_TYPES = {
+    "game_start", "move_made", "turn", "game_over", "game_force_end", "board", "move_history",
+    "chat", "broadcast", "user_joined", "user_left", "analysis", "ratings",
+    "player_disconnected", "player_reconnected", "cheat_detected",
+}
+
+
+class Relay:
+    def __init__(self, upstream_host='localhost', upstream_port=8888, host='localhost', port=8890,
+                 game_id=None, username=None, retry_interval=2.0, handshake_timeout=10):
+        self.upstream = (upstream_host, upstream_port)
+        self.host = host
+        self.port = port
+        self.game_id = game_id
+        self.username = username or f"relay_{socket.gethostname()}_{os.getpid()}"
+        self.retry_interval = retry_interval
+        self.handshake_timeout = handshake_timeout
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.upstream_socket = None
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.relayed = 0
+        self.reset_state()
+
+    def reset_state(self):
+        self.table_id = None
+        self.board = new_board()
+        self.move_history = []
+        self.chat_history = []
+        self.player_table = []
+        self.game_started = False
+        self.last_turn = None
+        self.last_turn_at = 0.0
+
+    def set_turn(self, turn_msg):
+        self.last_turn = turn_msg
+        self.last_turn_at = time.monotonic()
+
+    # ---- 上游 ----
+
+    def run_upstream(self):
+        while True:
+            try:
+                sock = socket.create_connection(self.upstream, timeout=self.handshake_timeout)
+                sock.settimeout(None)
+                login_msg = {"type": "login", "username": self.username, "relay": True,
+                             "encoding": "compact", "compression": "zlib"}
+                if self.game_id:
+                    login_msg["game_id"] = self.game_id
+                sock.send(json.dumps(login_msg).encode())
+                self.upstream_socket = sock
+                print(f"已连接上游: {self.upstream[0]}:{self.upstream[1]}")
+                self.receive_upstream(sock)
+            except OSError as e:
+                print(f"上游连接失败: {e}")
+            self.upstream_socket = None
+            time.sleep(self.retry_interval)
+
+    def receive_upstream(self, sock):
+        decoder = FrameDecoder()
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                print("上游连接已断开，稍后重连")
+                return
+            messages = decoder.feed(data)
+            with self.lock:
+                i = 0
+                while i < len(messages):
+                    message = messages[i]
+                    # 紧凑帧解出来的落子和回合是相邻的两条，合并转发
+                    if (message["type"] == "move_made" and i + 1 < len(messages)
+                            and messages[i + 1]["type"] == "turn"):
+                        self.on_move(message, messages[i + 1])
+                        i += 2
+                        continue
+                    self.on_upstream(sock, message)
+                    i += 1
+
+    def on_upstream(self, sock, message):
+        """更新镜像并转发，需要持有 self.lock"""
+        kind = message["type"]
+        if kind == "ping":
+            sock.send(json.dumps({"type": "pong"}).encode())
+            return
+        if kind == "role":
+            if message.get("table_id") != self.table_id:
+                self.reset_state()
+                self.table_id = message.get("table_id")
+                for client_socket, info in list(self.clients.items()):
+                    self.send_to(client_socket, self.role_message(info))
+            return
+        if kind in ("error", "banned", "rejected", "kicked"):
+            print(f"上游消息: {message.get('message')}")
+            return
+        if kind == "move_made":
+            self.on_move(message, None)
+            return
+        if kind == "board":
+            self.board = message["board"]
+            if all(cell == EMPTY for row in self.board for cell in row):
+                # 服务器重置棋局时只发一个空棋盘，历史也随之清空
+                self.move_history = []
+                self.chat_history = []
+                self.game_started = False
+                self.last_turn = None
+        elif kind == "move_history":
+            self.move_history = message["history"]
+        elif kind == "chat_history":
+            # 只用于新观战者的快照，不转发，免得已有的观战者重复显示
+            self.chat_history = message["history"]
+            return
+        elif kind == "game_start":
+            self.game_started = True
+        elif kind in ("game_over", "game_force_end"):
+            self.game_started = False
+            self.last_turn = None
+        elif kind == "turn":
+            self.set_turn(message)
+        elif kind == "chat":
+            self.chat_history.append({"username": message["username"], "role": message["role"],
+                                      "message": message["message"], "timestamp": time.time(),
+                                      "audience": message["audience"]})
+        if kind in FORWARD_TYPES:
+            self.broadcast(message)
+
+    def on_move(self, move_msg, turn_msg):
+        x, y = move_msg["x"], move_msg["y"]
+        self.board[x][y] = move_msg["piece"]
+        self.move_history.append({"x": x, "y": y, "piece": move_msg["piece"],
+                                  "username": move_msg["username"], "timestamp": time.time()})
+        if turn_msg:
+            self.set_turn(turn_msg)
+        self.broadcast_move(move_msg, turn_msg)
+
+    # ---- 下游 ----
+
+    def role_message(self, info):
+        return {"type": "role", "role": "SPECTATOR", "username": info["username"], "table_id": self.table_id}
+
+    def send_snapshot(self, client_socket):
+        """与服务器的 send_snapshot 相同的加入快照"""
+        info = self.clients[client_socket]
+        if info["encoding"] == "compact":
+            client_socket.send(encode_player_table(self.player_table, info["compress"]))
+        self.send_to(client_socket, {"type": "board", "board": self.board})
+        self.send_to(client_socket, {"type": "move_history", "history": self.move_history})
+        self.send_to(client_socket, {"type": "chat_history", "history": self.chat_history})
+        if self.game_started and self.last_turn and self.last_turn.get("clock"):
+            # 上游只在回合切换时发剩余时间，这里扣掉之后走过的时间
+            clock = dict(self.last_turn["clock"])
+            running = clock.get("running")
+            if running in clock:
+                clock[running] = max(0, clock[running] - int((time.monotonic() - self.last_turn_at) * 1000))
+            self.send_to(client_socket, {"type": "turn", "turn": self.last_turn["turn"], "clock": clock})
+
+    def player_index(self, username):
+        if username not in self.player_table:
+            self.player_table.append(username)
+            table_data = {}
+            for sock, info in list(self.clients.items()):
+                if info["encoding"] != "compact":
+                    continue
+                if info["compress"] not in table_data:
+                    table_data[info["compress"]] = encode_player_table(self.player_table, info["compress"])
+                try:
+                    sock.send(table_data[info["compress"]])
+                except OSError:
+                    pass
+        return self.player_table.index(username)
+
+    def broadcast_move(self, move_msg, turn_msg):
+        json_data = encode_json(move_msg)
+        if turn_msg:
+            json_data += encode_json(turn_msg)
+        compact_data = encode_move_turn(
+            move_msg["x"], move_msg["y"], self.player_index(move_msg["username"]),
+            move_msg["piece"], turn_msg["turn"] if turn_msg else None,
+            turn_msg.get("clock") if turn_msg else None)
+        for sock, info in list(self.clients.items()):
+            try:
+                sock.send(compact_data if info["encoding"] == "compact" else json_data)
+            except OSError:
+                pass
+        self.relayed += 1
+
+    def send_to(self, client_socket, message):
+        info = self.clients.get(client_socket)
+        encoder = Encoder(message)
+        client_socket.send(encoder.get(info["encoding"], info["compress"]) if info else encoder.get("json"))
+
+    def broadcast(self, message):
+        encoder = Encoder(message)
+        for sock, info in list(self.clients.items()):
+            try:
+                sock.send(encoder.get(info["encoding"], info["compress"]))
+            except OSError:
+                pass
+        self.relayed += 1
+
+    def handle_client(self, client_socket, addr):
+        try:
+            client_socket.settimeout(self.handshake_timeout)
+            login_info = json.loads(client_socket.recv(1024).decode())
+            client_socket.settimeout(None)
+            if login_info.get("type") != "login" or "username" not in login_info:
+                client_socket.send(json.dumps({"type": "error", "message": "请先发送用户名"}).encode())
+                client_socket.close()
+                return
+            with self.lock:
+                self.clients[client_socket] = {
+                    "username": login_info["username"],
+                    "address": f"{addr[0]}:{addr[1]}",
+                    "encoding": "compact" if login_info.get("encoding") == "compact" else "json",
+                    "compress": login_info.get("compression") == "zlib"
+                }
+                self.send_to(client_socket, self.role_message(self.clients[client_socket]))
+                self.send_snapshot(client_socket)
+        except Exception as e:
+            print(f"登录错误: {e}")
+            with self.lock:
+                self.clients.pop(client_socket, None)
+            client_socket.close()
+            return
+
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = client_socket.recv(1024)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    if message.get("type") == "ping":
+                        self.send_to(client_socket, {"type": "pong"})
+                    elif message.get("type") in ("move", "chat"):
+                        self.send_to(client_socket, {"type": "error", "message": "通过转发节点只能观战"})
+        except Exception as e:
+            print(f"客户端错误: {e}")
+        finally:
+            with self.lock:
+                info = self.clients.pop(client_socket, None)
+            client_socket.close()
+            if info:
+                print(f"观战者断开连接: {info['username']}")
+
+    def stats(self):
+        with self.lock:
+            return {"spectators": len(self.clients), "relayed": self.relayed,
+                    "upstream": self.upstream_socket is not None, "table_id": self.table_id}
+
+    def start(self):
+        threading.Thread(target=self.run_upstream, name="relay-upstream", daemon=True).start()
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(128)
+        print(f"转发节点已启动，监听地址: {self.host}:{self.port}，上游: {self.upstream[0]}:{self.upstream[1]}")
+        while True:
+            client_socket, addr = self.server_socket.accept()
+            print(f"新观战者: {addr}")
+            threading.Thread(target=self.handle_client, args=(client_socket, addr), daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="观战转发节点，可以串联")
+    parser.add_argument("--upstream", default="localhost:8888", help="上游服务器或转发节点 host:port")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8890)
+    parser.add_argument("--game-id", help="只转发这一局，默认转发1号桌")
+    args = parser.parse_args()
+
+    upstream_host, _, upstream_port = args.upstream.rpartition(":")
+    relay = Relay(upstream_host or "localhost", int(upstream_port), args.host, args.port, args.game_id)
+    relay.start()
@@ -0,0 +1,149 @@
+import json
+import re
+import secrets
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+from archive import ArchiveReader, game_players, load_game
+from protocol import Encoder, FrameDecoder
+
+# 历史对局查询：replay_fetch 按对局ID取回放和聊天记录，或按玩家列出对局。
+# 一局拆成若干 replay_data 分块依次下发，每块最多 CHUNK_SIZE 步落子和同样多条
+# 聊天，第一块带上对局信息，客户端收齐 chunks 块后拼成完整回放。
+# 最近请求过的对局以编码好的分块缓存在 LRU 里，再次请求时不读盘也不重新编码。
+
+CHUNK_SIZE = 200
+# 找不到对局时最多每隔这么多秒重新加载一次归档索引，随便编个对局ID不能逼服务器反复扫目录
+REFRESH_INTERVAL = 5.0
+GAME_ID = re.compile(r"[\w-]+")
+
+
+class ReplayService:
+    def __init__(self, replay_dir="replays", chat_dir="chat_logs", archive_dir="archive",
+                 capacity=256, recent_size=1000):
+        self.replay_dir = replay_dir
+        self.chat_dir = chat_dir
+        self.archive = ArchiveReader(archive_dir)
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        # 本进程保存的对局，打包进归档之前按玩家查找靠它
+        self.recent = deque(maxlen=recent_size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshed_at = time.monotonic()
+
+    def chunks(self, game_id):
+        """返回一局的分块编码器列表，找不到时返回 None"""
+        if not isinstance(game_id, str) or not GAME_ID.fullmatch(game_id):
+            return None
+        with self.lock:
+            chunks = self.cache.get(game_id)
+            if chunks is not None:
+                self.cache.move_to_end(game_id)
+                self.hits += 1
+                return chunks
+            self.misses += 1
+        replay, chat = load_game(game_id, self.replay_dir, self.chat_dir, self.archive)
+        if replay is None and chat is None:
+            # 可能刚被打包任务移进归档，重新加载索引再找一次
+            if not self.refresh(REFRESH_INTERVAL):
+                return None
+            replay, chat = load_game(game_id, self.replay_dir, self.chat_dir, self.archive)
+            if replay is None and chat is None:
+                return None
+        return self.put(game_id, replay, chat)
+
+    def put(self, game_id, replay, chat):
+        replay = replay or {}
+        moves = replay.get("moves", [])
+        chats = (chat or {}).get("chats", [])
+        total = max(1, -(-max(len(moves), len(chats)) // CHUNK_SIZE))
+        chunks = []
+        for i in range(total):
+            message = {"type": "replay_data", "game_id": game_id, "chunk": i, "chunks": total,
+                       "moves": moves[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE],
+                       "chats": chats[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]}
+            if i == 0:
+                message["info"] = {key: replay.get(key) for key in ("start_time", "end_time", "winner", "board_size")}
+            chunks.append(Encoder(message))
+        with self.lock:
+            self.cache[game_id] = chunks
+            self.cache.move_to_end(game_id)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return chunks
+
+    def add(self, replay, chat):
+        """对局结束时调用：刚结束的对局最常被查看，顺手放进缓存"""
+        game_id = replay["game_id"]
+        black, white = game_players(replay)
+        with self.lock:
+            self.recent.append({"game_id": game_id, "black": black, "white": white,
+                                "winner": replay.get("winner"), "start_time": replay.get("start_time"),
+                                "end_time": replay.get("end_time"), "moves": len(replay.get("moves", []))})
+        self.put(game_id, replay, chat)
+
+    def find(self, player, limit=20):
+        """按时间倒序列出玩家的对局"""
+        with self.lock:
+            games = {game["game_id"]: game for game in self.recent if player in (game["black"], game["white"])}
+        for game in self.archive.find(player, limit):
+            games.setdefault(game["game_id"], {key: value for key, value in game.items()
+                                               if key not in ("offset", "length")})
+        return sorted(games.values(), key=lambda game: game["game_id"], reverse=True)[:limit]
+
+    def refresh(self, min_interval=0):
+        """重新加载有变化的归档索引；距上次不到 min_interval 秒时跳过，返回是否加载了"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.refreshed_at < min_interval:
+                return False
+            self.refreshed_at = now
+        self.archive.refresh()
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses,
+                    "archived": len(self.archive)}
+
+
+def assemble(chunks):
+    """把收齐的 replay_data 分块拼回服务器保存时的回放和聊天记录格式"""
+    chunks = sorted(chunks, key=lambda chunk: chunk["chunk"])
+    game_id = chunks[0]["game_id"]
+    replay = dict(chunks[0].get("info") or {}, game_id=game_id,
+                  moves=[move for chunk in chunks for move in chunk["moves"]])
+    chat = {"game_id": game_id, "chats": [chat for chunk in chunks for chat in chunk["chats"]]}
+    return replay, chat
+
+
+def fetch_remote(host, port, game_id=None, player=None, limit=20, timeout=10):
+    """以观战身份连上服务器取历史对局，给回放查看器这类不参加对局的工具用。
+    按对局ID返回 (回放, 聊天记录)，按玩家返回对局列表"""
+    request = {"type": "replay_fetch", "game_id": game_id} if game_id else \
+        {"type": "replay_fetch", "player": player, "limit": limit}
+    login_msg = {"type": "login", "username": f"回放查看器_{secrets.token_hex(3)}", "spectate": True,
+                 "encoding": "compact", "compression": "zlib"}
+    decoder = FrameDecoder()
+    chunks = []
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.send(json.dumps(login_msg).encode())
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("服务器关闭了连接")
+            for message in decoder.feed(data):
+                if message["type"] == "session":
+                    sock.send(json.dumps(request).encode())
+                elif message["type"] in ("error", "banned", "rejected"):
+                    raise RuntimeError(message["message"])
+                elif message["type"] == "replay_list" and not game_id:
+                    return message["games"]
+                elif message["type"] == "replay_data" and message["game_id"] == game_id:
+                    chunks.append(message)
+                    if len(chunks) == message["chunks"]:
+                        return assemble(chunks)
@@ -0,0 +1,71 @@
+BOARD_SIZE = 15
+EMPTY = ' '
+
+DIRECTIONS = [
+    [(0, 1), (0, -1)],
+    [(1, 0), (-1, 0)],
+    [(1, 1), (-1, -1)],
+    [(1, -1), (-1, 1)]
+]
+
+
+def new_board():
+    return [[EMPTY for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)]
+
+
+def is_valid_move(board, x, y):
+    return 0 <= x < BOARD_SIZE and 0 <= y < BOARD_SIZE and board[x][y] == EMPTY
+
+
+def check_win(board, x, y):
+    piece = board[x][y]
+
+    for dir_pair in DIRECTIONS:
+        count = 1
+
+        for dx, dy in dir_pair:
+            nx, ny = x, y
+            for _ in range(4):
+                nx, ny = nx + dx, ny + dy
+                if 0 <= nx < BOARD_SIZE and 0 <= ny < BOARD_SIZE and board[nx][ny] == piece:
+                    count += 1
+                else:
+                    break
+
+        if count >= 5:
+            return True
+
+    return False
+
+
+def board_from_moves(moves):
+    board = new_board()
+    for move in moves:
+        board[move["x"]][move["y"]] = move["piece"]
+    return board
+
+
+def board_from_client_moves(moves):
+    """按客户端给的落子序列摆棋盘，坐标越界、重复落子或棋子不是 B/W 时返回 None"""
+    if not isinstance(moves, list):
+        return None
+    board = new_board()
+    for move in moves:
+        if not isinstance(move, dict):
+            return None
+        x, y = move.get("x"), move.get("y")
+        if type(x) is not int or type(y) is not int or move.get("piece") not in ('B', 'W'):
+            return None
+        if not is_valid_move(board, x, y):
+            return None
+        board[x][y] = move["piece"]
+    return board
+
+
+def transform(x, y, k, size=BOARD_SIZE):
+    """棋盘的 8 种对称变换（4 种旋转 × 是否镜像），k 取 0~7"""
+    if k & 4:
+        y = size - 1 - y
+    for _ in range(k & 3):
+        x, y = y, size - 1 - x
+    return x, y
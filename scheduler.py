@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class TimerHandle:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerHeap:
+    """所有定时任务共用一个最小堆和一个线程，而不是每个任务一个Timer线程"""
+
+    def __init__(self, name="timer-heap"):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + max(0, delay), callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """when 使用 time.monotonic() 的时间基准"""
+        handle = TimerHandle(when, callback, args)
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), handle))
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        self.start()
+        return handle
+
+    def call_at_wall(self, timestamp, callback, *args):
+        """按 time.time() 的绝对时间调度，用于持久化下来的到期时间"""
+        return self.call_later(timestamp - time.time(), callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        def tick():
+            try:
+                callback(*args)
+            finally:
+                if not handle.cancelled:
+                    inner[0] = self.call_later(interval, tick)
+
+        inner = [None]
+        handle = _RepeatingHandle(inner)
+        inner[0] = self.call_later(interval, tick)
+        return handle
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for _, _, h in self._heap if not h.cancelled)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - time.monotonic())
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+                _, _, handle = heapq.heappop(self._heap)
+
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                print(f"定时任务执行失败: {e}")
+
+
+class _RepeatingHandle:
+    def __init__(self, inner):
+        self._inner = inner
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self._inner[0]:
+            self._inner[0].cancel()
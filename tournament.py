@@ -0,0 +1,201 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from rules import BOARD_SIZE, EMPTY, new_board, is_valid_move, check_win
+from ratings import expected_score
+from gomoku_ai import SearchEngine
+
+DRAW = "平局"
+
+
+class RandomBot:
+    """在已有棋子附近随机落子"""
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def choose(self, board, piece):
+        near = set()
+        for x in range(BOARD_SIZE):
+            for y in range(BOARD_SIZE):
+                if board[x][y] == EMPTY:
+                    continue
+                for nx in range(x - 1, x + 2):
+                    for ny in range(y - 1, y + 2):
+                        if is_valid_move(board, nx, ny):
+                            near.add((nx, ny))
+        if not near:
+            near = {(x, y) for x in range(BOARD_SIZE) for y in range(BOARD_SIZE) if board[x][y] == EMPTY}
+        return self.rng.choice(sorted(near))
+
+
+class GreedyBot:
+    """只看一步：取评估排序后的第一个候选点"""
+
+    def __init__(self, seed=None):
+        self.engine = SearchEngine()
+
+    def choose(self, board, piece):
+        self.engine.load(board)
+        return divmod(self.engine.candidates(piece)[0], BOARD_SIZE)
+
+
+class SearchBot:
+    def __init__(self, time_limit=0.5, max_depth=8, seed=None):
+        self.engine = SearchEngine()
+        self.time_limit = time_limit
+        self.max_depth = max_depth
+
+    def choose(self, board, piece):
+        result = self.engine.search(board, piece, self.time_limit, self.max_depth)
+        return result["x"], result["y"]
+
+
+def make_bot(spec, seed=None):
+    """spec 形如 random、greedy、ai:0.5（每步秒数）或 ai:0.5:4（再限制深度）"""
+    kind, _, params = spec.partition(":")
+    if kind == "random":
+        return RandomBot(seed)
+    if kind == "greedy":
+        return GreedyBot(seed)
+    if kind == "ai":
+        args = [float(p) for p in params.split(":") if p]
+        time_limit = args[0] if args else 0.5
+        max_depth = int(args[1]) if len(args) > 1 else 8
+        return SearchBot(time_limit, max_depth, seed)
+    raise ValueError(f"未知的策略: {spec}")
+
+
+def play_game(task):
+    """在工作进程中完整下完一局，返回与 replays/ 相同格式的回放数据"""
+    game_id, black_name, black_spec, white_name, white_spec, seed = task
+    bots = {'B': make_bot(black_spec, seed), 'W': make_bot(white_spec, seed + 1)}
+    names = {'B': black_name, 'W': white_name}
+    board = new_board()
+    moves = []
+    piece = 'B'
+    winner = DRAW
+    start_time = time.time()
+
+    for _ in range(BOARD_SIZE * BOARD_SIZE):
+        x, y = bots[piece].choose(board, piece)
+        if not is_valid_move(board, x, y):
+            # 非法落子判负，与服务器拒绝落子不同，这里必须分出结果
+            winner = names['W' if piece == 'B' else 'B']
+            break
+        board[x][y] = piece
+        moves.append({
+            "x": x,
+            "y": y,
+            "piece": piece,
+            "username": names[piece],
+            "timestamp": time.time()
+        })
+        if check_win(board, x, y):
+            winner = names[piece]
+            break
+        piece = 'W' if piece == 'B' else 'B'
+
+    return {
+        "game_id": game_id,
+        "start_time": start_time,
+        "end_time": time.time(),
+        "winner": winner,
+        "moves": moves,
+        "board_size": BOARD_SIZE
+    }
+
+
+def update_elo(ratings, black, white, winner, k=32):
+    score = 0.5 if winner == DRAW else (1.0 if winner == black else 0.0)
+    expected = expected_score(ratings[black], ratings[white])
+    ratings[black] += k * (score - expected)
+    ratings[white] -= k * (score - expected)
+
+
+def build_schedule(players, games_per_pair, seed):
+    prefix = f"tournament_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    tasks = []
+    for (a, a_spec), (b, b_spec) in itertools.combinations(players, 2):
+        for i in range(games_per_pair):
+            # 轮换先后手
+            if i % 2 == 0:
+                black, black_spec, white, white_spec = a, a_spec, b, b_spec
+            else:
+                black, black_spec, white, white_spec = b, b_spec, a, a_spec
+            n = len(tasks)
+            tasks.append((f"{prefix}_{n:05d}", black, black_spec, white, white_spec, seed + n * 2))
+    return tasks
+
+
+def run_tournament(players, games_per_pair=2, workers=None, output_dir="replays", seed=0):
+    tasks = build_schedule(players, games_per_pair, seed)
+    ratings = {name: 1500.0 for name, _ in players}
+    records = {name: {"win": 0, "loss": 0, "draw": 0} for name, _ in players}
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map 保持任务顺序，Elo 按对局编号依次更新，结果可复现
+        for task, replay in zip(tasks, pool.map(play_game, tasks, chunksize=1)):
+            _, black, _, white, _, _ = task
+            winner = replay["winner"]
+            update_elo(ratings, black, white, winner)
+            if winner == DRAW:
+                records[black]["draw"] += 1
+                records[white]["draw"] += 1
+            else:
+                loser = white if winner == black else black
+                records[winner]["win"] += 1
+                records[loser]["loss"] += 1
+
+            if output_dir:
+                with open(os.path.join(output_dir, f"{replay['game_id']}.json"), "w") as f:
+                    json.dump(replay, f, indent=2)
+            print(f"{replay['game_id']}: {black}(黑) vs {white}(白) -> {winner}, {len(replay['moves'])}手")
+
+    return ratings, records
+
+
+def print_table(ratings, records):
+    print(f"{'排名':<4}{'选手':<16}{'Elo':>8}{'胜':>6}{'负':>6}{'和':>6}")
+    for rank, name in enumerate(sorted(ratings, key=ratings.get, reverse=True), 1):
+        r = records[name]
+        print(f"{rank:<4}{name:<16}{ratings[name]:>8.1f}{r['win']:>6}{r['loss']:>6}{r['draw']:>6}")
+
+
+def parse_players(specs):
+    players = []
+    for spec in specs:
+        name, sep, strategy = spec.partition("=")
+        if not sep:
+            name, strategy = spec, spec
+        make_bot(strategy)
+        players.append((name, strategy))
+    return players
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="五子棋机器人循环赛")
+    parser.add_argument("players", nargs="+",
+                        help="参赛选手，格式为 名字=策略 或 策略，策略可选 random、greedy、ai:秒数[:深度]")
+    parser.add_argument("--games", type=int, default=2, help="每对选手之间的对局数")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数，默认为CPU核数")
+    parser.add_argument("--output", default="replays", help="回放输出目录，传空字符串则不保存")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="把Elo表写入该JSON文件")
+    args = parser.parse_args()
+
+    ratings, records = run_tournament(parse_players(args.players), args.games, args.workers,
+                                      args.output, args.seed)
+    print_table(ratings, records)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({name: {"elo": round(ratings[name], 1), **records[name]} for name in ratings},
+                      f, indent=2, ensure_ascii=False)
@@ -0,0 +1,435 @@
+import argparse
+import bisect
+import contextlib
+import io
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from protocol import FrameDecoder, WebSocketFrame
+
+# 流量录制文件格式（大端）：
+#
+#   | 文件头: "GTRC" 版本(1) 录制开始时间(8, double) | 记录 × N |
+#   记录: 连接序号(4) 相对开始的毫秒数(4) 类型(1) 负载长度(4) 负载
+#
+# OPEN 的负载是客户端地址；IN 是收到的原始字节（保留原来的分包方式，
+# 拆包问题也能重现）；OUT 只记下发出的消息类型，逗号分隔，回放时用来比较
+# 响应是否一致；CLOSE 没有负载。
+
+MAGIC = b"GTRC"
+VERSION = 1
+FILE_HEADER = struct.Struct(">4sBd")
+RECORD = struct.Struct(">IIBI")
+OPEN, IN, OUT, CLOSE = 1, 2, 3, 4
+# 按顺序回放时，每个输入最多等这么多秒让之前录到的响应到齐
+SEQUENCE_TIMEOUT = 1.0
+
+
+class TrafficRecorder:
+    def __init__(self, directory="captures"):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(os.path.abspath(directory), f"capture_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+        self.start = time.time()
+        self.file = open(self.path, "wb", buffering=1 << 16)
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, self.start))
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def record(self, conn_id, kind, payload=b""):
+        t = int((time.time() - self.start) * 1000)
+        with self.lock:
+            self.file.write(RECORD.pack(conn_id, t, kind, len(payload)) + payload)
+
+    def wrap(self, sock, addr):
+        with self.lock:
+            self.counter += 1
+            conn_id = self.counter
+        self.record(conn_id, OPEN, f"{addr[0]}:{addr[1]}".encode())
+        return CapturedSocket(sock, self, conn_id)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CapturedSocket:
+    """录制模式下包在客户端连接外面，记录收到的字节和发出的消息类型"""
+
+    def __init__(self, sock, recorder, conn_id):
+        self.sock = sock
+        self.recorder = recorder
+        self.conn_id = conn_id
+        self.decoder = FrameDecoder()
+        self.decode_lock = threading.Lock()
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def recv(self, bufsize, *args):
+        data = self.sock.recv(bufsize, *args)
+        if data:
+            self.recorder.record(self.conn_id, IN, data)
+        return data
+
+    def send(self, data, *args):
+        sent = self.sock.send(data, *args)
+        self._record_out(data[:sent])
+        return sent
+
+    def sendall(self, data, *args):
+        self.sock.sendall(data, *args)
+        self._record_out(data)
+
+    def _record_out(self, data):
+        if isinstance(data, WebSocketFrame):
+            # 浏览器连接只录收到的消息，回放时按普通 JSON 连接发送
+            return
+        try:
+            with self.decode_lock:
+                types = [message.get("type", "?") for message in self.decoder.feed(data)]
+        except Exception:
+            types = ["?"]
+        if types:
+            self.recorder.record(self.conn_id, OUT, ",".join(types).encode())
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.recorder.record(self.conn_id, CLOSE)
+        self.sock.close()
+
+
+def read_capture(path):
+    """返回 (录制开始时间, {连接序号: {"addr", "events": [(秒, 类型, 负载)]}})"""
+    sessions = {}
+    with open(path, "rb") as f:
+        magic, version, start = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"不是有效的流量录制文件: {path}")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            conn_id, t, kind, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            if kind == OPEN:
+                sessions[conn_id] = {"addr": payload.decode(), "events": []}
+            elif conn_id in sessions:
+                sessions[conn_id]["events"].append((t / 1000, kind, payload))
+    return start, sessions
+
+
+def rename_login(payload, suffix):
+    """多份回放时给登录的用户名加后缀，避免重名；只改完整的 JSON 登录消息"""
+    try:
+        login = json.loads(payload.decode())
+    except (UnicodeDecodeError, ValueError):
+        return payload
+    if isinstance(login, dict) and login.get("type") == "login" and "username" in login:
+        login["username"] = f"{login['username']}{suffix}"
+        return json.dumps(login).encode()
+    return payload
+
+
+class Sequencer:
+    """速度为 0 时所有连接共用的发送顺序：按录制时间依次放行每个输入，并且
+    等录制中在它之前各连接收到的响应都到齐了再发，落子不会赶在对手前面"""
+
+    def __init__(self, runs):
+        inputs = sorted((t, position, i, run) for position, run in enumerate(runs)
+                        for i, (t, _, _) in enumerate(run.inputs()))
+        self.turns = {(run, i): (rank, t) for rank, (t, _, i, run) in enumerate(inputs)}
+        # 每个连接录到的每条响应消息的时间
+        self.outputs = {run: [t for t, kind, payload in run.events if kind == OUT
+                              for _ in payload.decode().split(",")] for run in runs}
+        self.closed = set()
+        self.finished = set()
+        self.next = 0
+        self.condition = threading.Condition()
+
+    def caught_up(self, t):
+        return all(len(run.types) >= bisect.bisect_left(times, t)
+                   for run, times in self.outputs.items() if run not in self.closed)
+
+    def wait(self, run, i):
+        rank, t = self.turns[(run, i)]
+        with self.condition:
+            self.condition.wait_for(lambda: self.next >= rank)
+            # 响应对不上时不会无限等下去，超时后照样发送，差异留给报告
+            self.condition.wait_for(lambda: self.caught_up(t), SEQUENCE_TIMEOUT)
+
+    def received(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def done(self, run, i):
+        with self.condition:
+            self.finished.add(self.turns[(run, i)][0])
+            while self.next in self.finished:
+                self.next += 1
+            self.condition.notify_all()
+
+    def finish(self, run):
+        """连接结束时放行它剩下的输入，也不再等它的响应"""
+        with self.condition:
+            self.closed.add(run)
+            self.finished.update(rank for (owner, _), (rank, _) in self.turns.items() if owner is run)
+            while self.next in self.finished:
+                self.next += 1
+            self.condition.notify_all()
+
+
+def expected_responses(events):
+    """录制时的响应：每个 IN 之后到下一个 IN 之前第一个 OUT 的延迟，以及所有响应的消息类型"""
+    types = []
+    latencies = []
+    pending = None
+    for t, kind, payload in events:
+        if kind == IN:
+            pending = t
+        elif kind == OUT:
+            types.extend(payload.decode().split(","))
+            if pending is not None:
+                latencies.append(t - pending)
+                pending = None
+    return types, latencies
+
+
+class ReplaySession:
+    def __init__(self, conn_id, session, suffix=""):
+        self.conn_id = conn_id
+        self.addr = session["addr"]
+        self.events = session["events"]
+        self.suffix = suffix
+        self.types = []
+        self.latencies = []
+        self.error = None
+        self.pending = None
+        self.answered = threading.Event()
+        self.lock = threading.Lock()
+        self.sequencer = None
+
+    def inputs(self):
+        return [e for e in self.events if e[1] in (IN, CLOSE)]
+
+    def receive(self, sock):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                now = time.monotonic()
+                messages = decoder.feed(data)
+                with self.lock:
+                    self.types.extend(message.get("type", "?") for message in messages)
+                    if self.pending is not None and messages:
+                        self.latencies.append(now - self.pending)
+                        self.pending = None
+                if messages:
+                    self.answered.set()
+                    if self.sequencer:
+                        self.sequencer.received()
+        except (OSError, ValueError):
+            return
+
+    def run(self, host, port, origin, speed, drain, sequencer=None):
+        def wait_until(t):
+            if speed > 0:
+                delay = origin + t / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        ins = self.inputs()
+        if not ins:
+            return
+        self.sequencer = sequencer
+        wait_until(ins[0][0])
+        if sequencer:
+            # 轮到第一个输入时再连接，免得排队期间被服务器按握手超时断开
+            sequencer.wait(self, 0)
+        try:
+            sock = socket.create_connection((host, port), timeout=10)
+            sock.settimeout(None)
+        except OSError as e:
+            self.error = str(e)
+            if sequencer:
+                sequencer.finish(self)
+            return
+        reader = threading.Thread(target=self.receive, args=(sock,), daemon=True)
+        reader.start()
+        first_send = True
+        try:
+            for i, (t, kind, payload) in enumerate(ins):
+                wait_until(t)
+                if sequencer:
+                    sequencer.wait(self, i)
+                if kind == CLOSE:
+                    break
+                if first_send and self.suffix:
+                    payload = rename_login(payload, self.suffix)
+                with self.lock:
+                    self.pending = time.monotonic()
+                sock.sendall(payload)
+                if first_send:
+                    # 服务器按一次 recv 读登录消息，和真实客户端一样等登录有了回应再继续发
+                    first_send = False
+                    self.answered.wait(10)
+                if sequencer:
+                    sequencer.done(self, i)
+            if sequencer:
+                sequencer.finish(self)
+            # 等服务器把最后一批响应发完
+            time.sleep(drain)
+        except OSError as e:
+            self.error = str(e)
+        finally:
+            if sequencer:
+                sequencer.finish(self)
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            reader.join(drain + 1)
+            sock.close()
+
+    def report(self):
+        expected, captured_latencies = expected_responses(self.events)
+        missing = Counter(expected) - Counter(self.types)
+        unexpected = Counter(self.types) - Counter(expected)
+        first_diff = next((i for i, (a, b) in enumerate(zip(expected, self.types)) if a != b),
+                          None if len(expected) == len(self.types) else min(len(expected), len(self.types)))
+        return {
+            "conn": self.conn_id,
+            "addr": self.addr,
+            "suffix": self.suffix,
+            "diverged": bool(missing or unexpected),
+            "first_difference": first_diff,
+            "missing": dict(missing),
+            "unexpected": dict(unexpected),
+            "captured_latencies": captured_latencies,
+            "replay_latencies": self.latencies,
+            "error": self.error
+        }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def replay(path, host, port, speed=1.0, copies=1, drain=0.5, only=None):
+    """按录制的时间间隔（除以 speed）并发回放所有连接，speed 为 0 时不等待但按录制的全局顺序逐个发送，返回汇总报告"""
+    _, sessions = read_capture(path)
+    runs = []
+    for copy in range(copies):
+        suffix = f"#{copy}" if copies > 1 else ""
+        for conn_id, session in sessions.items():
+            if only and conn_id not in only:
+                continue
+            runs.append(ReplaySession(conn_id, session, suffix))
+    sequencer = Sequencer(runs) if speed == 0 else None
+    origin = time.monotonic()
+    threads = [threading.Thread(target=run.run, args=(host, port, origin, speed, drain, sequencer), daemon=True)
+               for run in runs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - origin
+
+    reports = [run.report() for run in runs]
+    captured = [v for r in reports for v in r["captured_latencies"]]
+    replayed = [v for r in reports for v in r["replay_latencies"]]
+    return {
+        "capture": path,
+        "speed": speed,
+        "copies": copies,
+        "sessions": len(reports),
+        "elapsed": round(elapsed, 3),
+        "diverged": sum(1 for r in reports if r["diverged"]),
+        "errors": sum(1 for r in reports if r["error"]),
+        "latency": {
+            "captured_p50": round(percentile(captured, 0.5) * 1000, 2),
+            "captured_p90": round(percentile(captured, 0.9) * 1000, 2),
+            "replay_p50": round(percentile(replayed, 0.5) * 1000, 2),
+            "replay_p90": round(percentile(replayed, 0.9) * 1000, 2),
+            "replay_max": round(max(replayed, default=0.0) * 1000, 2)
+        },
+        "details": reports
+    }
+
+
+def start_fresh_server(**options):
+    """在临时目录里启动一个全新的 GomokuServer，返回端口"""
+    from Server import GomokuServer
+    from player_store import PlayerStore, SQLiteBackend
+
+    probe = socket.socket()
+    probe.bind(("localhost", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    os.chdir(tempfile.mkdtemp(prefix="gomoku_replay_"))
+    # 回放的连接都来自本机，放开按IP的连接频率限制
+    options.setdefault("conn_rate", 10000)
+    options.setdefault("conn_burst", 10000)
+    server = GomokuServer(port=port, player_store=PlayerStore(SQLiteBackend(":memory:")),
+                          persist_bans=False, position_index=None, **options)
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.3)
+    return port
+
+
+def print_report(report, top=10):
+    latency = report["latency"]
+    print(f"回放 {report['sessions']} 个连接（{report['copies']} 份，速度 {report['speed'] or '最快'}），"
+          f"用时 {report['elapsed']} 秒")
+    print(f"响应与录制不一致的连接: {report['diverged']}，连接错误: {report['errors']}")
+    print(f"首个响应延迟 录制 p50 {latency['captured_p50']}ms p90 {latency['captured_p90']}ms | "
+          f"回放 p50 {latency['replay_p50']}ms p90 {latency['replay_p90']}ms 最大 {latency['replay_max']}ms")
+    diverged = [r for r in report["details"] if r["diverged"] or r["error"]]
+    for r in diverged[:top]:
+        print(f"  连接 {r['conn']}{r['suffix']} ({r['addr']}): 第 {r['first_difference']} 条响应开始不同，"
+              f"缺少 {r['missing']}，多出 {r['unexpected']}" + (f"，错误: {r['error']}" if r["error"] else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按录制的流量回放，比较响应和延迟")
+    parser.add_argument("capture", help="流量录制文件")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--fresh", action="store_true", help="在本进程启动一个全新的服务器作为回放目标")
+    parser.add_argument("--ai", action="store_true", help="新服务器启用AI陪练（录制时的服务器启用了才加）")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速度倍数，0 表示按录制的先后顺序尽快回放")
+    parser.add_argument("--copies", type=int, default=1, help="同时回放几份（用户名加后缀）以放大负载")
+    parser.add_argument("--drain", type=float, default=0.5, help="每个连接发完后等待响应的秒数")
+    parser.add_argument("--conn", type=int, nargs="*", help="只回放这些连接序号")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", help="把报告写入该JSON文件")
+    args = parser.parse_args()
+
+    capture_path = os.path.abspath(args.capture)
+    json_path = os.path.abspath(args.json) if args.json else None
+    host, port = args.host, args.port
+    if args.fresh:
+        with contextlib.redirect_stdout(io.StringIO()):
+            host, port = "localhost", start_fresh_server(ai_opponent=args.ai)
+    result = replay(capture_path, host, port, args.speed, args.copies, args.drain, args.conn)
+    print_report(result, args.top)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
@@ -1,12 +1,145 @@
 import socket
 import threading
 import json
+import re
 import tkinter as tk
 from tkinter import simpledialog, messagebox, scrolledtext
 import time
+from collections import deque
+from itertools import islice
+from protocol import FrameDecoder
+from replay_service import assemble
+
+class VirtualList:
+    """只渲染可见行的列表：数据放在有序字典里，Listbox 里永远只有一屏的内容"""
+    
+    def __init__(self, parent, items, formatter, width=20, height=10):
+        self.items = items
+        self.formatter = formatter
+        self.height = height
+        self.top = 0
+        self.pending = False
+        self.frame = tk.Frame(parent)
+        self.listbox = tk.Listbox(self.frame, width=width, height=height)
+        self.scrollbar = tk.Scrollbar(self.frame, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.Y)
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll_by(-1 if e.delta > 0 else 1))
+        self.listbox.bind("<Button-4>", lambda e: self.scroll_by(-1))
+        self.listbox.bind("<Button-5>", lambda e: self.scroll_by(1))
+    
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+    
+    def set_items(self, items):
+        self.items = items
+        self.refresh()
+    
+    def refresh(self):
+        # 同一轮事件里的多次变化只重画一次
+        if not self.pending:
+            self.pending = True
+            self.frame.after_idle(self.render)
+    
+    def scroll_by(self, rows):
+        self.top += rows
+        self.render()
+    
+    def on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self.top = int(float(amount) * len(self.items))
+        elif unit == "pages":
+            self.top += int(amount) * self.height
+        else:
+            self.top += int(amount)
+        self.render()
+    
+    def render(self):
+        self.pending = False
+        total = len(self.items)
+        self.top = max(0, min(self.top, total - self.height))
+        self.listbox.delete(0, tk.END)
+        for key, value in islice(self.items.items(), self.top, self.top + self.height):
+            self.listbox.insert(tk.END, self.formatter(key, value))
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.height) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+class ChatPane:
+    """有行数上限的聊天窗口：同一轮到达的消息合并成一次插入，超出上限的旧行
+    移到内存里，用户向上滚到顶时再一页页加载回来"""
+    
+    def __init__(self, parent, max_lines=500, history_limit=5000, page_size=100, height=10):
+        self.text = scrolledtext.ScrolledText(parent, height=height, state='disabled')
+        self.text.configure(yscrollcommand=self.on_yscroll)
+        self.max_lines = max_lines
+        self.page_size = page_size
+        self.pending = []
+        self.older = deque(maxlen=history_limit)
+        self.flush_scheduled = False
+        self.loading = False
+    
+    def pack(self, **kwargs):
+        self.text.pack(**kwargs)
+    
+    def add(self, line):
+        self.pending.append(line)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.text.after(30, self.flush)
+    
+    def add_many(self, lines):
+        for line in lines:
+            self.add(line)
+    
+    def line_count(self):
+        return int(self.text.index("end-1c").split(".")[0]) - 1
+    
+    def flush(self):
+        self.flush_scheduled = False
+        lines, self.pending = self.pending, []
+        if not lines:
+            return
+        # 用户正往上翻看时不把视图拉回底部，也先不裁剪
+        at_bottom = self.text.yview()[1] >= 0.999
+        self.text.config(state='normal')
+        if len(lines) > self.max_lines:
+            # 一次来得比上限还多（比如加入时的聊天记录），只渲染最后一段
+            self.older.extend(self.text.get("1.0", "end-1c").splitlines())
+            self.older.extend(lines[:-self.max_lines])
+            self.text.delete("1.0", tk.END)
+            lines = lines[-self.max_lines:]
+        self.text.insert(tk.END, "\n".join(lines) + "\n")
+        if at_bottom:
+            excess = self.line_count() - self.max_lines
+            if excess > 0:
+                self.older.extend(self.text.get("1.0", f"{excess + 1}.0").splitlines())
+                self.text.delete("1.0", f"{excess + 1}.0")
+        self.text.config(state='disabled')
+        if at_bottom:
+            self.text.see(tk.END)
+    
+    def on_yscroll(self, first, last):
+        self.text.vbar.set(first, last)
+        if float(first) <= 0.0 and self.older and not self.loading:
+            self.loading = True
+            self.text.after_idle(self.load_older)
+    
+    def load_older(self):
+        self.loading = False
+        count = min(self.page_size, len(self.older))
+        if not count:
+            return
+        lines = [self.older.pop() for _ in range(count)][::-1]
+        self.text.config(state='normal')
+        self.text.insert("1.0", "\n".join(lines) + "\n")
+        self.text.config(state='disabled')
+        # 视图停在加载前看到的那一行
+        self.text.yview(f"{count + 1}.0")
 
 class GomokuUserClient:
-    def __init__(self):
+    def __init__(self, chat_max_lines=500):
         self.root = tk.Tk()
         self.root.title("五子棋用户端")
         self.root.geometry("700x800")
@@ -27,12 +160,16 @@ class GomokuUserClient:
         self.btn_connect = tk.Button(self.frame_connect, text="连接", command=self.connect_server)
         self.btn_connect.grid(row=0, column=4, padx=5)
         
-        self.user_listbox = tk.Listbox(self.root, width=20, height=10)
-        self.user_listbox.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
+        self.users = {}
+        self.presence_version = 0
+        self.presence_pending = {}
+        self.presence_syncing = False
+        self.user_list_view = VirtualList(self.root, self.users, self.format_user, width=24, height=20)
+        self.user_list_view.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
         tk.Label(self.root, text="在线用户").pack(side=tk.RIGHT)
         
-        self.chat_area = scrolledtext.ScrolledText(self.root, height=10, state='disabled')
-        self.chat_area.pack(pady=5, padx=10, fill=tk.BOTH)
+        self.chat_pane = ChatPane(self.root, max_lines=chat_max_lines)
+        self.chat_pane.pack(pady=5, padx=10, fill=tk.BOTH)
         
         self.frame_chat = tk.Frame(self.root)
         self.frame_chat.pack(pady=5, fill=tk.X)
@@ -50,27 +187,51 @@ class GomokuUserClient:
         self.control_frame = tk.Frame(self.root)
         self.control_frame.pack(pady=5)
         
-        self.btn_replay = tk.Button(self.control_frame, text="查看回放", command=self.show_replay)
+        self.btn_replay = tk.Button(self.control_frame, text="查看回放", command=self.open_replay)
         self.btn_replay.pack(side=tk.LEFT, padx=5)
         
         self.btn_refresh = tk.Button(self.control_frame, text="刷新用户", command=self.refresh_user_list)
         self.btn_refresh.pack(side=tk.LEFT, padx=5)
         
+        self.btn_match = tk.Button(self.control_frame, text="匹配对局", command=self.toggle_match)
+        self.btn_match.pack(side=tk.LEFT, padx=5)
+        
+        self.btn_tables = tk.Button(self.control_frame, text="棋桌列表", command=self.request_tables)
+        self.btn_tables.pack(side=tk.LEFT, padx=5)
+        
         self.status = tk.Label(self.root, text="未连接", relief=tk.SUNKEN, anchor=tk.W)
         self.status.pack(side=tk.BOTTOM, fill=tk.X)
         
+        self.analysis_label = tk.Label(self.root, text="", anchor=tk.W, justify=tk.LEFT)
+        self.analysis_label.pack(side=tk.BOTTOM, fill=tk.X)
+        
+        self.clock_label = tk.Label(self.root, text="", font=("Arial", 12))
+        self.clock_label.pack(side=tk.BOTTOM)
+        
         self.socket = None
         self.username = None
         self.role = None
         self.board = [[' ' for _ in range(15)] for _ in range(15)]
         self.cell_size = 30
         self.margin = 20
-        self.users = {}
         self.move_history = []
         self.replay_mode = False
         self.replay_index = 0
+        self.replay_moves = []
+        self.replay_chunks = {}
+        self.clock = None
+        self.clock_received = 0
+        self.session_token = None
+        self.rating = None
+        self.table_id = None
+        self.matching = False
+        self.game_id = None
+        self.closing = False
+        self.reconnect_grace = 60
+        self.retry_delay = 2
         
         self.draw_board()
+        self.tick_clock()
         
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.root.mainloop()
@@ -131,11 +292,21 @@ class GomokuUserClient:
             self.username = simpledialog.askstring("用户名", "请输入用户名:", parent=self.root)
             if not self.username:
                 return
+            password = simpledialog.askstring("密码", "请输入密码(留空以游客身份登录):",
+                                              parent=self.root, show="*")
+            register = bool(password) and messagebox.askyesno("注册", "是否用这个用户名和密码注册新账号？\n"
+                                                              "已有账号请选“否”", parent=self.root)
             
+            self.host, self.port = host, port
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((host, port))
             
-            login_msg = {"type": "login", "username": self.username, "is_admin": False}
+            login_msg = {"type": "login", "username": self.username, "is_admin": False,
+                         "encoding": "compact", "compression": "zlib"}
+            if password:
+                login_msg["password"] = password
+            if register:
+                login_msg["register"] = True
             self.socket.send(json.dumps(login_msg).encode())
             
             self.btn_connect.config(state=tk.DISABLED)
@@ -149,47 +320,132 @@ class GomokuUserClient:
             messagebox.showerror("连接错误", f"无法连接到服务器: {e}")
     
     def receive_messages(self):
-        buffer = ""
+        decoder = FrameDecoder()
         while True:
             try:
-                data = self.socket.recv(1024).decode()
+                data = self.socket.recv(4096)
                 if not data:
                     break
                     
-                buffer += data
-                while buffer:
-                    try:
-                        message, idx = self.parse_json(buffer)
-                        buffer = buffer[idx:]
-                        self.process_message(message)
-                        
-                    except json.JSONDecodeError:
-                        break
-                    except ValueError:
-                        buffer = ""
-                        break
+                for message in decoder.feed(data):
+                    self.process_message(message)
                 
             except Exception as e:
                 print(f"接收错误: {e}")
                 break
+        if not self.closing and self.session_token:
+            self.reconnect()
     
-    def parse_json(self, data):
-        try:
-            message = json.loads(data)
-            return message, len(data)
-        except json.JSONDecodeError as e:
-            if e.msg == "Extra data":
-                message = json.loads(data[:e.pos])
-                return message, e.pos
-            else:
-                raise
+    def reconnect(self):
+        """连接意外断开时，在服务器保留座位的时间内凭令牌自动重连"""
+        self.add_chat("系统", "与服务器的连接断开，正在尝试重连...")
+        deadline = time.monotonic() + self.reconnect_grace
+        # 服务器重启前会告知多久后可以重连，第一次按它说的等，之后每2秒一次
+        delay, self.retry_delay = self.retry_delay, 2
+        while not self.closing and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = 2
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=5)
+                sock.settimeout(None)
+                login_msg = {"type": "login", "username": self.username, "token": self.session_token,
+                             "game_id": self.game_id, "last_seq": self.stone_count(),
+                             "encoding": "compact", "compression": "zlib"}
+                sock.send(json.dumps(login_msg).encode())
+            except OSError as e:
+                print(f"重连失败: {e}")
+                continue
+            self.socket = sock
+            self.add_chat("系统", "已重新连接到服务器")
+            threading.Thread(target=self.receive_messages, daemon=True).start()
+            return
+        if not self.closing:
+            self.add_chat("系统", "重连失败，请重新连接")
+            self.session_token = None
+            self.btn_connect.config(state=tk.NORMAL)
+    
+    def stone_count(self):
+        return sum(cell != ' ' for row in self.board for cell in row)
     
     def process_message(self, message):
         if message["type"] == "role":
             self.role = message["role"]
+            if message.get("table_id") != self.table_id:
+                # 换到了另一张棋桌，之前的用户列表和棋盘都作废
+                self.table_id = message.get("table_id")
+                self.users = {}
+                self.presence_version = 0
+                self.presence_pending = {}
+                self.presence_syncing = False
+                self.update_user_list()
+                self.reset_game()
             self.status.config(text=f"已连接 - 用户名: {self.username} - 角色: {self.role}")
             
+        elif message["type"] == "session":
+            self.session_token = message["token"]
+            self.rating = message["rating"]
+            if self.rating is not None:
+                self.add_chat("系统", f"登录成功，当前等级分: {self.rating}")
+            
+        elif message["type"] == "ratings":
+            changes = "，".join(f"{name}: {rating}" for name, rating in message["ratings"].items())
+            self.add_chat("系统", f"等级分更新 - {changes}")
+            if self.username in message["ratings"]:
+                self.rating = message["ratings"][self.username]
+            
+        elif message["type"] == "match_status":
+            if message["status"] == "waiting":
+                self.set_matching(True)
+                queued = f" 队列中 {message['queued']} 人" if "queued" in message else ""
+                self.add_chat("系统", f"正在匹配对手...{queued}")
+            elif message["status"] == "transfer":
+                # 对手在集群里的另一个进程，服务器断开后凭这个令牌重连就会被送到对局所在的进程
+                self.set_matching(False)
+                self.session_token = message["token"]
+                self.retry_delay = 0
+                self.add_chat("系统", f"匹配成功! 对手: {message['opponent']}，正在进入对局...")
+            elif message["status"] == "matched":
+                self.set_matching(False)
+                rating = message.get("opponent_rating")
+                self.add_chat("系统", f"匹配成功! 对手: {message['opponent']}" + (f"({rating})" if rating else "")
+                              + f"，棋桌 {message['table_id']}")
+            else:
+                self.set_matching(False)
+                self.add_chat("系统", "已取消匹配")
+            
+        elif message["type"] == "table_list":
+            for table in message["tables"]:
+                players = f"{table['black'] or '空位'} vs {table['white'] or '空位'}"
+                state = f"第{table['moves']}手" if table["game_started"] else "未开始"
+                self.add_chat("系统", f"棋桌 {table['table_id']}: {players} ({state}, {table['spectators']}人观战)")
+            
         elif message["type"] == "game_start":
+            self.game_id = message.get("game_id")
+            self.add_chat("系统", message["message"])
+            self.set_clock(message.get("clock"))
+            
+        elif message["type"] == "resume":
+            # 重连后只补上断线期间错过的落子和聊天
+            for move in message["moves"]:
+                self.board[move["x"]][move["y"]] = move["piece"]
+            self.draw_board()
+            for chat in message["chats"]:
+                if chat["audience"] == "all" or (
+                    chat["audience"] == "spectators" and self.role == "SPECTATOR"):
+                    self.add_chat(f"{chat['username']}({chat['role']})", chat["message"])
+            self.set_clock(message.get("clock"))
+            self.add_chat("系统", f"已回到对局，补上了 {len(message['moves'])} 手，当前回合: {message['turn']}")
+            
+        elif message["type"] == "player_disconnected":
+            self.add_chat("系统", f"{message['username']} 断线了，为其保留座位 {message['grace']} 秒")
+            self.apply_presence(message.get("version"), "update", {"username": message["username"], "away": True})
+            
+        elif message["type"] == "player_reconnected":
+            self.add_chat("系统", f"{message['username']} 已重新连接")
+            self.apply_presence(message.get("version"), "update", {"username": message["username"], "away": False})
+            
+        elif message["type"] == "server_restart":
+            self.retry_delay = message.get("retry_after", 2)
             self.add_chat("系统", message["message"])
             
         elif message["type"] == "move_made":
@@ -201,8 +457,10 @@ class GomokuUserClient:
         elif message["type"] == "turn":
             turn = message["turn"]
             self.status.config(text=f"已连接 - 用户名: {self.username} - 角色: {self.role} - 当前回合: {turn}")
+            self.set_clock(message.get("clock"))
             
         elif message["type"] == "game_over":
+            self.set_clock(None)
             self.add_chat("系统", message["message"])
             self.show_victory(message["winner_name"], message["winner"])
             
@@ -228,26 +486,38 @@ class GomokuUserClient:
             
         elif message["type"] == "user_joined":
             self.add_chat("系统", f"{message['username']} 以 {message['role']} 身份加入游戏")
-            self.users[message["username"]] = {
+            self.apply_presence(message.get("version"), "add", {
+                "username": message["username"],
                 "role": message["role"],
-                "address": message.get("address", "未知")
-            }
-            self.update_user_list()
+                "address": message.get("address", "未知"),
+                "rating": message.get("rating")
+            })
             
         elif message["type"] == "user_left":
             self.add_chat("系统", f"{message['username']} 离开了游戏")
-            if message["username"] in self.users:
-                del self.users[message["username"]]
-            self.update_user_list()
+            self.apply_presence(message.get("version"), "remove", {"username": message["username"]})
+            
+        elif message["type"] == "presence":
+            self.on_presence(message)
+            
+        elif message["type"] == "replay_data":
+            chunks = self.replay_chunks.setdefault(message["game_id"], [])
+            chunks.append(message)
+            if len(chunks) == message["chunks"]:
+                replay, _ = assemble(self.replay_chunks.pop(message["game_id"]))
+                self.root.after(0, lambda: self.show_replay(replay["moves"], f"对局回放 - {replay['game_id']}"))
+            
+        elif message["type"] == "replay_list":
+            self.root.after(0, lambda: self.show_replay_list(message["player"], message["games"]))
             
         elif message["type"] == "move_history":
             self.move_history = message["history"]
             
         elif message["type"] == "chat_history":
-            for chat in message["history"]:
-                if chat["audience"] == "all" or (
-                    chat["audience"] == "spectators" and self.role == "SPECTATOR"):
-                    self.add_chat(f"{chat['username']}({chat['role']})", chat["message"])
+            self.chat_pane.add_many(f"{chat['username']}({chat['role']}): {chat['message']}"
+                                    for chat in message["history"]
+                                    if chat["audience"] == "all" or (
+                                        chat["audience"] == "spectators" and self.role == "SPECTATOR"))
             
         elif message["type"] == "user_list":
             self.users = {}
@@ -255,13 +525,18 @@ class GomokuUserClient:
                 self.users[user["username"]] = {
                     "role": user["role"],
                     "address": user["address"],
-                    "is_admin": user["is_admin"]
+                    "is_admin": user["is_admin"],
+                    "rating": user.get("rating")
                 }
-            self.update_user_list()
+            self.user_list_view.set_items(self.users)
             
         elif message["type"] == "banned":
             messagebox.showerror("连接被拒绝", message["message"])
             self.on_closing()
+
+        elif message["type"] == "rejected":
+            messagebox.showwarning("连接被拒绝", message["message"])
+            self.on_closing()
             
         elif message["type"] == "kicked":
             messagebox.showwarning("被踢出", message["message"])
@@ -271,6 +546,15 @@ class GomokuUserClient:
             self.add_chat("系统", f"⚠️ 检测到作弊行为: {message['cheater']} - 原因: {message['reason']}")
             self.add_chat("系统", f"⚠️ {message['winner']} 获胜!")
             
+        elif message["type"] == "analysis":
+            self.show_analysis(message)
+            
+        elif message["type"] == "ping":
+            self.socket.send(json.dumps({"type": "pong"}).encode())
+            
+        elif message["type"] == "pong":
+            pass
+            
         elif message["type"] == "cheating":
             messagebox.showerror("作弊检测", message["message"])
             self.on_closing()
@@ -285,22 +569,128 @@ class GomokuUserClient:
             self.socket.send(json.dumps(chat_msg).encode())
             self.entry_chat.delete(0, tk.END)
     
+    def toggle_match(self):
+        if not self.socket:
+            return
+        self.socket.send(json.dumps({"type": "cancel_match" if self.matching else "find_match"}).encode())
+    
+    def set_matching(self, matching):
+        self.matching = matching
+        self.btn_match.config(text="取消匹配" if matching else "匹配对局")
+    
+    def request_tables(self):
+        if self.socket:
+            self.socket.send(json.dumps({"type": "list_tables"}).encode())
+    
     def add_chat(self, sender, message):
-        self.chat_area.config(state='normal')
-        if sender:
-            self.chat_area.insert(tk.END, f"{sender}: {message}\n")
+        self.chat_pane.add(f"{sender}: {message}" if sender else message)
+    
+    def set_clock(self, clock):
+        self.clock = clock
+        self.clock_received = time.monotonic()
+        self.tick_clock(reschedule=False)
+    
+    def tick_clock(self, reschedule=True):
+        # 服务器只在回合切换时发送剩余时间，两次消息之间由客户端本地倒数
+        if self.clock:
+            elapsed = int((time.monotonic() - self.clock_received) * 1000)
+            parts = []
+            for side, name in (("BLACK", "黑"), ("WHITE", "白")):
+                left = self.clock[side] - (elapsed if self.clock.get("running") == side else 0)
+                seconds = max(0, left) // 1000
+                text = f"{name} {seconds // 60:02d}:{seconds % 60:02d}"
+                if "periods" in self.clock:
+                    text += f" (读秒{self.clock['periods'][side]}次)"
+                if self.clock.get("running") == side:
+                    text = f"▶ {text}"
+                parts.append(text)
+            self.clock_label.config(text="    ".join(parts))
         else:
-            self.chat_area.insert(tk.END, f"{message}\n")
-        self.chat_area.config(state='disabled')
-        self.chat_area.see(tk.END)
+            self.clock_label.config(text="")
+        if reschedule:
+            self.root.after(500, self.tick_clock)
+    
+    def show_analysis(self, message):
+        lines = [f"局面分析(第{message['move_number']}手):"]
+        for side, name in (("BLACK", "黑"), ("WHITE", "白")):
+            threats = message["threats"][side]
+            lines.append(f"{name}方 活三{threats['open_three']} 冲四{threats['four']} 活四{threats['open_four']}")
+        if message.get("final"):
+            p = message["win_probability"]
+            moves = " ".join(f"({m['x']}, {m['y']})" for m in message["best_moves"])
+            lines.append(f"胜率 黑{p['BLACK']:.0%} 白{p['WHITE']:.0%}  推荐: {moves}")
+        self.analysis_label.config(text="  ".join(lines))
+    
+    def format_user(self, username, info):
+        display_text = f"{username} ({info['role']})"
+        if info.get("rating") is not None:
+            display_text += f" {info['rating']}"
+        if info.get("is_admin", False):
+            display_text += " [管理员]"
+        if info.get("away"):
+            display_text += " [断线]"
+        return display_text
     
     def update_user_list(self):
-        self.user_listbox.delete(0, tk.END)
-        for username, info in self.users.items():
-            display_text = f"{username} ({info['role']})"
-            if info.get("is_admin", False):
-                display_text += " [管理员]"
-            self.user_listbox.insert(tk.END, display_text)
+        self.user_list_view.set_items(self.users)
+    
+    def apply_presence(self, version, op, user):
+        """按版本号应用一条名单变化。版本号跳号时先把这条存起来并向服务器要补发，
+        缺的几条补上之后再按顺序应用"""
+        if version is None:
+            self.update_presence(op, user)
+            return
+        if version <= self.presence_version:
+            return
+        if self.presence_version and version > self.presence_version + 1:
+            self.presence_pending[version] = (op, user)
+            if not self.presence_syncing and self.socket:
+                self.presence_syncing = True
+                self.socket.send(json.dumps({"type": "presence_sync", "since": self.presence_version}).encode())
+            return
+        self.presence_version = version
+        self.update_presence(op, user)
+        self.drain_presence()
+    
+    def drain_presence(self):
+        """应用已经接得上的暂存变化，丢掉快照已经包含的"""
+        while self.presence_version + 1 in self.presence_pending:
+            self.presence_version += 1
+            self.update_presence(*self.presence_pending.pop(self.presence_version))
+        for version in [v for v in self.presence_pending if v <= self.presence_version]:
+            del self.presence_pending[version]
+    
+    def update_presence(self, op, user):
+        username = user["username"]
+        if op == "remove":
+            self.users.pop(username, None)
+        elif op == "update":
+            if username in self.users:
+                self.users[username].update(user)
+        else:
+            self.users[username] = user
+        self.user_list_view.refresh()
+    
+    def on_presence(self, message):
+        if message.get("table_id") != self.table_id:
+            return
+        if "events" in message:
+            # 补发的增量：接上之后暂存的变化会按顺序应用
+            for event in message["events"]:
+                self.apply_presence(event["version"], event["op"], event["user"])
+            self.presence_syncing = False
+            return
+        # 分页快照：第一页清空名单，最后一页之后以快照的版本号为准
+        if message["offset"] == 0:
+            self.users = {}
+            self.user_list_view.set_items(self.users)
+        for user in message["users"]:
+            self.users[user["username"]] = user
+        if message["done"]:
+            self.presence_version = message["version"]
+            self.presence_syncing = False
+            self.drain_presence()
+        self.user_list_view.refresh()
     
     def refresh_user_list(self):
         if self.socket:
@@ -321,13 +711,54 @@ class GomokuUserClient:
         self.board = [[' ' for _ in range(15)] for _ in range(15)]
         self.draw_board()
     
-    def show_replay(self):
-        if not self.move_history:
+    def open_replay(self):
+        """留空查看本局，输入对局ID或玩家名时向服务器取历史对局"""
+        if not self.socket:
+            self.show_replay()
+            return
+        query = simpledialog.askstring("查看回放", "输入对局ID或玩家名查看历史对局，留空查看本局:", parent=self.root)
+        if query is None:
+            return
+        query = query.strip()
+        if not query:
+            self.show_replay()
+        elif re.fullmatch(r"\d+_[\w-]+", query):
+            self.fetch_replay(query)
+        else:
+            self.socket.send(json.dumps({"type": "replay_fetch", "player": query, "limit": 50}).encode())
+    
+    def fetch_replay(self, game_id):
+        self.replay_chunks.pop(game_id, None)
+        self.socket.send(json.dumps({"type": "replay_fetch", "game_id": game_id}).encode())
+    
+    def show_replay_list(self, player, games):
+        if not games:
+            messagebox.showinfo("回放", f"没有找到 {player} 的对局")
+            return
+        list_window = tk.Toplevel(self.root)
+        list_window.title(f"{player} 的对局")
+        list_window.geometry("520x300")
+        listbox = tk.Listbox(list_window)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        for game in games:
+            listbox.insert(tk.END, f"{game['game_id']}  黑 {game['black'] or '-'}  白 {game['white'] or '-'}  "
+                                   f"{game['moves']}手  胜者 {game['winner'] or '-'}")
+        
+        def load(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.fetch_replay(games[selection[0]]["game_id"])
+        
+        listbox.bind("<Double-Button-1>", load)
+    
+    def show_replay(self, moves=None, title="对局回放"):
+        self.replay_moves = self.move_history if moves is None else moves
+        if not self.replay_moves:
             messagebox.showinfo("回放", "暂无历史记录")
             return
             
         replay_window = tk.Toplevel(self.root)
-        replay_window.title("对局回放")
+        replay_window.title(title)
         replay_window.geometry("500x600")
         
         replay_canvas = tk.Canvas(replay_window, width=450, height=450, bg="#E8C87E")
@@ -353,7 +784,7 @@ class GomokuUserClient:
         tk.Button(control_frame, text="第一步", command=lambda: self.set_replay_step(0, replay_canvas)).pack(side=tk.LEFT, padx=5)
         tk.Button(control_frame, text="上一步", command=lambda: self.set_replay_step(self.replay_index-1, replay_canvas)).pack(side=tk.LEFT, padx=5)
         tk.Button(control_frame, text="下一步", command=lambda: self.set_replay_step(self.replay_index+1, replay_canvas)).pack(side=tk.LEFT, padx=5)
-        tk.Button(control_frame, text="最后一步", command=lambda: self.set_replay_step(len(self.move_history)-1, replay_canvas)).pack(side=tk.LEFT, padx=5)
+        tk.Button(control_frame, text="最后一步", command=lambda: self.set_replay_step(len(self.replay_moves)-1, replay_canvas)).pack(side=tk.LEFT, padx=5)
         tk.Button(control_frame, text="自动播放", command=lambda: self.auto_play(replay_canvas, replay_window)).pack(side=tk.LEFT, padx=5)
         
         info_label = tk.Label(replay_window, text="")
@@ -372,8 +803,8 @@ class GomokuUserClient:
     def set_replay_step(self, step, canvas):
         if step < 0:
             step = 0
-        elif step >= len(self.move_history):
-            step = len(self.move_history) - 1
+        elif step >= len(self.replay_moves):
+            step = len(self.replay_moves) - 1
             
         self.replay_index = step
         self.update_replay_display(canvas)
@@ -382,7 +813,7 @@ class GomokuUserClient:
         canvas.delete("pieces")
         
         for i in range(self.replay_index + 1):
-            move = self.move_history[i]
+            move = self.replay_moves[i]
             color = "black" if move["piece"] == 'B' else "white"
             canvas.create_oval(
                 self.margin + move["y"] * self.cell_size - 13,
@@ -392,13 +823,13 @@ class GomokuUserClient:
                 fill=color, outline="black", tags="pieces"
             )
         
-        if info_label and self.replay_index < len(self.move_history):
-            move = self.move_history[self.replay_index]
-            info_label.config(text=f"步数: {self.replay_index+1}/{len(self.move_history)} - {move['username']} 落子于 ({move['x']}, {move['y']})")
+        if info_label and self.replay_index < len(self.replay_moves):
+            move = self.replay_moves[self.replay_index]
+            info_label.config(text=f"步数: {self.replay_index+1}/{len(self.replay_moves)} - {move['username']} 落子于 ({move['x']}, {move['y']})")
     
     def auto_play(self, canvas, window):
         def play():
-            for i in range(len(self.move_history)):
+            for i in range(len(self.replay_moves)):
                 if not self.replay_mode:
                     return
                 self.replay_index = i
@@ -409,6 +840,7 @@ class GomokuUserClient:
         threading.Thread(target=play, daemon=True).start()
     
     def on_closing(self):
+        self.closing = True
         if self.socket:
             self.socket.close()
         self.root.destroy()
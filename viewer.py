@@ -1,10 +1,17 @@
 import json
+import re
 import tkinter as tk
-from tkinter import filedialog, messagebox, Toplevel, Scrollbar, Text
+from tkinter import filedialog, messagebox, simpledialog, Toplevel, Scrollbar, Text
 import time
 import os
 from PIL import Image, ImageTk
 import threading
+import queue
+from rules import board_from_moves
+from analysis import Analyzer
+from position_index import PositionIndex
+from archive import ArchiveReader
+from replay_service import fetch_remote
 
 class GomokuReplayViewer:
     def __init__(self):
@@ -15,10 +22,23 @@ class GomokuReplayViewer:
         self.file_menu = tk.Menu(self.menu_bar, tearoff=0)
         self.file_menu.add_command(label="打开回放文件", command=self.open_replay_file)
         self.file_menu.add_command(label="打开聊天记录", command=self.open_chat_log)
+        self.file_menu.add_command(label="打开归档对局", command=self.open_archive)
+        self.file_menu.add_command(label="从服务器获取对局", command=self.open_remote)
+        self.file_menu.add_command(label="打开局面索引", command=self.open_position_index)
         self.file_menu.add_separator()
         self.file_menu.add_command(label="退出", command=self.root.quit)
         self.menu_bar.add_cascade(label="文件", menu=self.file_menu)
         
+        self.analysis_var = tk.BooleanVar(value=False)
+        self.analysis_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.analysis_menu.add_checkbutton(label="分析当前局面", variable=self.analysis_var,
+                                           command=self.request_analysis)
+        self.analysis_menu.add_command(label="分析整局", command=self.analyze_whole_game)
+        self.book_var = tk.BooleanVar(value=False)
+        self.analysis_menu.add_checkbutton(label="查询开局库", variable=self.book_var,
+                                           command=self.show_book)
+        self.menu_bar.add_cascade(label="分析", menu=self.analysis_menu)
+        
         self.help_menu = tk.Menu(self.menu_bar, tearoff=0)
         self.help_menu.add_command(label="使用说明", command=self.show_help)
         self.menu_bar.add_cascade(label="帮助", menu=self.help_menu)
@@ -66,6 +86,14 @@ class GomokuReplayViewer:
         self.detail_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.detail_text = Text(self.detail_frame, height=10, state=tk.DISABLED)
         self.detail_text.pack(fill=tk.BOTH, expand=True)
+        self.analysis_frame = tk.LabelFrame(self.right_frame, text="局面分析")
+        self.analysis_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.analysis_text = Text(self.analysis_frame, height=5, state=tk.DISABLED)
+        self.analysis_text.pack(fill=tk.X)
+        self.book_frame = tk.LabelFrame(self.right_frame, text="开局库")
+        self.book_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.book_text = Text(self.book_frame, height=5, state=tk.DISABLED)
+        self.book_text.pack(fill=tk.X)
         self.chat_frame = tk.LabelFrame(self.right_frame, text="聊天记录")
         self.chat_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.chat_text = Text(self.chat_frame, height=15, state=tk.DISABLED)
@@ -86,7 +114,14 @@ class GomokuReplayViewer:
         self.play_delay = 1.0  # 每秒一步
         self.cell_size = 30
         self.margin = 20
+        self.analyzer = None
+        self.analysis_results = {}
+        self.analysis_queue = queue.Queue()
+        self.position_index = None
+        self.archive = None
+        self.server_address = "localhost:8888"
         self.draw_board()
+        self.poll_analysis()
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.root.mainloop()
     def draw_board(self):
@@ -125,34 +160,177 @@ class GomokuReplayViewer:
         
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
-                self.replay_data = json.load(f)
-            self.game_id_label.config(text=f"对局ID: {self.replay_data.get('game_id', '未知')}")
-            start_time = self.replay_data.get('start_time', 0)
-            end_time = self.replay_data.get('end_time', 0)
-            duration = end_time - start_time
-            minutes = int(duration // 60)
-            seconds = int(duration % 60)
-            self.duration_label.config(text=f"对局时长: {minutes}分{seconds}秒")
-            winner = self.replay_data.get('winner', '未知')
-            self.winner_label.config(text=f"获胜方: {winner}")
-            self.total_steps = len(self.replay_data.get('moves', []))
-            self.current_step = 0
-            self.progress_scale.config(to=self.total_steps)
-            self.update_progress()
-            self.update_detail_text()
-            game_id = self.replay_data.get('game_id')
-            if game_id:
-                chat_path = os.path.join("chat_logs", f"{game_id}.json")
-                if os.path.exists(chat_path):
-                    self.load_chat_log(chat_path)
-            self.draw_current_step()
-            
+                self.load_replay_data(json.load(f))
             self.status_bar.config(text=f"已加载回放文件: {os.path.basename(file_path)}")
-            
         except Exception as e:
             messagebox.showerror("错误", f"无法加载回放文件: {e}")
             self.status_bar.config(text="加载回放文件失败")
-    
+
+    def load_replay_data(self, replay_data, chat_data=None):
+        """显示一局回放，没有给出聊天记录时先在 chat_logs 目录找同名文件，再到归档里找"""
+        self.replay_data = replay_data
+        self.game_id_label.config(text=f"对局ID: {self.replay_data.get('game_id', '未知')}")
+        start_time = self.replay_data.get('start_time', 0)
+        end_time = self.replay_data.get('end_time', 0)
+        duration = end_time - start_time
+        minutes = int(duration // 60)
+        seconds = int(duration % 60)
+        self.duration_label.config(text=f"对局时长: {minutes}分{seconds}秒")
+        winner = self.replay_data.get('winner', '未知')
+        self.winner_label.config(text=f"获胜方: {winner}")
+        self.total_steps = len(self.replay_data.get('moves', []))
+        self.current_step = 0
+        self.analysis_results = {}
+        self.progress_scale.config(to=self.total_steps)
+        self.update_progress()
+        self.update_detail_text()
+        game_id = self.replay_data.get('game_id')
+        if chat_data is not None:
+            self.chat_data = chat_data
+            self.update_chat_display()
+        elif game_id:
+            chat_path = os.path.join("chat_logs", f"{game_id}.json")
+            if os.path.exists(chat_path):
+                self.load_chat_log(chat_path)
+            elif self.archive is not None and game_id in self.archive:
+                self.chat_data = self.archive.chat(game_id)
+                self.update_chat_display()
+        self.draw_current_step()
+
+    def open_archive(self):
+        """浏览归档里的对局，可按玩家筛选，双击载入"""
+        directory = "archive"
+        if not os.path.isdir(directory):
+            directory = filedialog.askdirectory(title="选择归档目录")
+            if not directory:
+                return
+        try:
+            if self.archive is None or self.archive.directory != directory:
+                self.archive = ArchiveReader(directory)
+            else:
+                self.archive.refresh()
+        except Exception as e:
+            messagebox.showerror("错误", f"无法打开归档: {e}")
+            return
+        window = Toplevel(self.root)
+        window.title(f"归档对局 ({len(self.archive)} 局)")
+        window.geometry("640x480")
+        search_frame = tk.Frame(window)
+        search_frame.pack(fill=tk.X, padx=5, pady=5)
+        tk.Label(search_frame, text="玩家:").pack(side=tk.LEFT)
+        player_var = tk.StringVar()
+        player_entry = tk.Entry(search_frame, textvariable=player_var, width=20)
+        player_entry.pack(side=tk.LEFT, padx=5)
+        list_frame = tk.Frame(window)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        scrollbar = Scrollbar(list_frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        listbox = tk.Listbox(list_frame, yscrollcommand=scrollbar.set, font=("Courier", 10))
+        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=listbox.yview)
+        shown = []
+
+        def search(event=None):
+            listbox.delete(0, tk.END)
+            shown.clear()
+            for game in self.archive.find(player_var.get().strip() or None, limit=500):
+                shown.append(game["game_id"])
+                listbox.insert(tk.END, self.format_game(game))
+
+        def load(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.load_archived_game(shown[selection[0]])
+
+        tk.Button(search_frame, text="查找", command=search).pack(side=tk.LEFT)
+        player_entry.bind("<Return>", search)
+        listbox.bind("<Double-Button-1>", load)
+        search()
+
+    def load_archived_game(self, game_id):
+        try:
+            record = self.archive.get(game_id)
+            if record is None:
+                messagebox.showerror("错误", f"归档中没有对局: {game_id}")
+                return
+            if record["replay"] is None:
+                self.chat_data = record["chat"]
+                self.update_chat_display()
+            else:
+                self.load_replay_data(record["replay"])
+            self.status_bar.config(text=f"已从归档加载对局: {game_id}")
+        except Exception as e:
+            messagebox.showerror("错误", f"无法读取归档对局: {e}")
+            self.status_bar.config(text="加载归档对局失败")
+
+    def format_game(self, game):
+        return (f"{game['game_id']}  黑 {game['black'] or '-'}  白 {game['white'] or '-'}  "
+                f"{game['moves']}手  胜者 {game['winner'] or '-'}")
+
+    def open_remote(self):
+        """从服务器取历史对局：输入对局ID直接载入，输入玩家名先列出该玩家的对局"""
+        address = simpledialog.askstring("服务器", "服务器地址(主机:端口):", initialvalue=self.server_address,
+                                         parent=self.root)
+        if not address:
+            return
+        query = simpledialog.askstring("从服务器获取对局", "对局ID或玩家名:", parent=self.root)
+        if not query or not query.strip():
+            return
+        try:
+            host, port = address.rsplit(":", 1)
+            port = int(port)
+        except ValueError:
+            messagebox.showerror("错误", "服务器地址格式应为 主机:端口")
+            return
+        self.server_address = address
+        query = query.strip()
+        if re.fullmatch(r"\d+_[\w-]+", query):
+            self.fetch_remote(host, port, game_id=query)
+        else:
+            self.fetch_remote(host, port, player=query)
+
+    def fetch_remote(self, host, port, game_id=None, player=None):
+        self.status_bar.config(text=f"正在从服务器获取: {game_id or player}")
+
+        def run():
+            try:
+                result = fetch_remote(host, port, game_id=game_id, player=player, limit=100)
+            except Exception as e:
+                self.root.after(0, lambda: [messagebox.showerror("错误", f"从服务器获取对局失败: {e}"),
+                                            self.status_bar.config(text="从服务器获取对局失败")])
+                return
+            if game_id:
+                self.root.after(0, lambda: [self.load_replay_data(*result),
+                                            self.status_bar.config(text=f"已从服务器加载对局: {game_id}")])
+            else:
+                self.root.after(0, lambda: self.show_remote_list(host, port, player, result))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def show_remote_list(self, host, port, player, games):
+        if not games:
+            messagebox.showinfo("从服务器获取对局", f"服务器上没有 {player} 的对局")
+            self.status_bar.config(text="就绪")
+            return
+        window = Toplevel(self.root)
+        window.title(f"{player} 的对局 ({len(games)} 局)")
+        window.geometry("640x400")
+        scrollbar = Scrollbar(window)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        listbox = tk.Listbox(window, yscrollcommand=scrollbar.set, font=("Courier", 10))
+        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=listbox.yview)
+        for game in games:
+            listbox.insert(tk.END, self.format_game(game))
+
+        def load(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.fetch_remote(host, port, game_id=games[selection[0]]["game_id"])
+
+        listbox.bind("<Double-Button-1>", load)
+        self.status_bar.config(text=f"{player} 共有 {len(games)} 局对局，双击载入")
+
     def open_chat_log(self):
         """打开聊天记录文件"""
         file_path = filedialog.askopenfilename(
@@ -206,6 +384,105 @@ class GomokuReplayViewer:
         """更新进度显示"""
         self.progress_label.config(text=f"步数: {self.current_step}/{self.total_steps}")
         self.progress_scale.set(self.current_step)
+        self.request_analysis()
+        self.show_book()
+    
+    def get_analyzer(self):
+        if self.analyzer is None:
+            self.analyzer = Analyzer(workers=os.cpu_count() or 1)
+        return self.analyzer
+    
+    def submit_analysis(self, step):
+        """在后台分析第 step 步之后的局面，结果经队列交回界面线程"""
+        if step in self.analysis_results:
+            return
+        game_id = self.replay_data.get('game_id')
+        board = board_from_moves(self.replay_data['moves'][:step])
+        self.get_analyzer().submit(board, lambda result: self.analysis_queue.put((game_id, step, result)))
+    
+    def request_analysis(self):
+        if not self.replay_data or not self.analysis_var.get():
+            self.show_analysis()
+            return
+        self.submit_analysis(self.current_step)
+        self.show_analysis()
+    
+    def analyze_whole_game(self):
+        if not self.replay_data:
+            return
+        self.analysis_var.set(True)
+        for step in range(self.total_steps + 1):
+            self.submit_analysis(step)
+        self.show_analysis()
+        self.status_bar.config(text=f"正在后台分析全部 {self.total_steps + 1} 个局面")
+    
+    def poll_analysis(self):
+        try:
+            while True:
+                game_id, step, result = self.analysis_queue.get_nowait()
+                if self.replay_data and game_id == self.replay_data.get('game_id'):
+                    self.analysis_results[step] = result
+                    if step == self.current_step:
+                        self.show_analysis()
+        except queue.Empty:
+            pass
+        self.root.after(100, self.poll_analysis)
+    
+    def show_analysis(self):
+        self.analysis_text.config(state=tk.NORMAL)
+        self.analysis_text.delete(1.0, tk.END)
+        if self.replay_data and self.analysis_var.get():
+            result = self.analysis_results.get(self.current_step)
+            if result is None:
+                self.analysis_text.insert(tk.END, "分析中...\n")
+            else:
+                for side, name in (("BLACK", "黑方"), ("WHITE", "白方")):
+                    threats = result["threats"][side]
+                    self.analysis_text.insert(
+                        tk.END, f"{name}: 活三 {threats['open_three']}  冲四 {threats['four']}  活四 {threats['open_four']}\n")
+                p = result["win_probability"]
+                self.analysis_text.insert(tk.END, f"胜率: 黑 {p['BLACK']:.0%}  白 {p['WHITE']:.0%}\n")
+                moves = " ".join(f"({m['x']}, {m['y']})" for m in result["best_moves"])
+                self.analysis_text.insert(tk.END, f"推荐落子: {moves}  (搜索深度 {result['depth']})\n")
+        self.analysis_text.config(state=tk.DISABLED)
+    
+    def open_position_index(self, file_path=None):
+        if file_path is None:
+            file_path = filedialog.askopenfilename(
+                title="选择局面索引文件",
+                filetypes=[("局面索引", "*.idx"), ("所有文件", "*.*")]
+            )
+        if not file_path:
+            return
+        try:
+            self.position_index = PositionIndex(file_path)
+            self.book_var.set(True)
+            self.status_bar.config(text=f"已加载局面索引: {len(self.position_index.game_ids)} 局对局")
+            self.show_book()
+        except Exception as e:
+            messagebox.showerror("错误", f"加载局面索引失败: {e}")
+    
+    def show_book(self):
+        """显示经过当前局面的对局数和后续各手的胜负统计"""
+        if self.book_var.get() and self.position_index is None and os.path.exists("positions.idx"):
+            self.open_position_index("positions.idx")
+            return
+        self.book_text.config(state=tk.NORMAL)
+        self.book_text.delete(1.0, tk.END)
+        if self.replay_data and self.book_var.get() and self.position_index is not None:
+            board = board_from_moves(self.replay_data['moves'][:self.current_step])
+            info = self.position_index.query(board, limit=5)
+            self.book_text.insert(
+                tk.END, f"经过此局面的对局: {info['games']}  黑胜 {info['black_wins']}  白胜 {info['white_wins']}\n")
+            for entry in info["book"]:
+                self.book_text.insert(
+                    tk.END, f"({entry['x']}, {entry['y']})  {entry['games']}局  黑胜 {entry['black_wins']}  白胜 {entry['white_wins']}\n")
+            others = [game_id for game_id in info["game_ids"] if game_id != self.replay_data.get('game_id')]
+            if others:
+                self.book_text.insert(tk.END, f"相关对局: {', '.join(others)}\n")
+        elif self.book_var.get() and self.position_index is None:
+            self.book_text.insert(tk.END, "未加载局面索引，请通过\"文件\" -> \"打开局面索引\"加载\n")
+        self.book_text.config(state=tk.DISABLED)
     
     def update_detail_text(self):
         self.detail_text.config(state=tk.NORMAL)
@@ -416,9 +693,25 @@ class GomokuReplayViewer:
    - 聊天记录显示对局过程中的所有聊天内容
 
 6. 获取回放文件
-   - 回放文件需要向管理员申请获取
+   - 点击"文件" -> "从服务器获取对局"，输入服务器地址和对局ID可以直接载入历史对局，
+     输入玩家名会列出该玩家最近的对局，双击载入
+   - 也可以向管理员申请回放文件
    - 回放文件保存在服务器的replays目录中
    - 聊天记录保存在服务器的chat_logs目录中
+   - 较早的对局由管理员用 python archive.py --compact 打包进 archive 目录，
+     点击"文件" -> "打开归档对局"可以按玩家查找并双击载入；
+     也可以用 python archive.py --export 对局ID 导出成原来的回放和聊天记录文件
+
+7. 局面分析
+   - 勾选"分析"菜单中的"分析当前局面"，右侧会显示双方的活三、冲四、活四数量，
+     黑白双方胜率估计和推荐落子点
+   - "分析整局"会在后台分析对局中的每一个局面，分析结果会缓存，重复的局面只计算一次
+
+8. 开局库
+   - 服务器管理员可以用 python position_index.py 从 replays 目录和归档生成局面索引文件 positions.idx
+   - 点击"文件" -> "打开局面索引"加载后，勾选"分析"菜单中的"查询开局库"
+   - 右侧会显示经过当前局面的对局数、之后各种下法的胜负统计和相关对局ID，
+     旋转或镜像后相同的局面视为同一局面
 
 注意事项：
 - 确保回放文件和聊天记录文件来自同一局游戏
@@ -436,6 +729,8 @@ class GomokuReplayViewer:
     def on_closing(self):
         """关闭窗口时的处理"""
         self.playing = False
+        if self.analyzer is not None:
+            self.analyzer.shutdown()
         self.root.destroy()
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import base64
+import hashlib
+import socket
+import struct
+import threading
+import zlib
+
+from protocol import (WebSocketFrame, encode_ws_frame, WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG,
+                      WS_FIN, WS_RSV1)
+
+# 只用标准库实现的 RFC 6455 服务端：握手、帧收发和 permessage-deflate。
+# WebSocketConnection 提供与 socket 相同的 send/recv 接口，服务器的
+# handle_client 不区分两种连接，浏览器收到的消息类型与 TCP 客户端一致。
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_HEADER = 8192
+MAX_MESSAGE = 1 << 16
+
+
+class HandshakeError(Exception):
+    pass
+
+
+def read_request(sock):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(1024)
+        if not chunk:
+            raise HandshakeError("握手未完成连接就关闭了")
+        data += chunk
+        if len(data) > MAX_HEADER:
+            raise HandshakeError("握手请求头过长")
+    head = data.split(b"\r\n\r\n", 1)[0].decode("latin-1")
+    lines = head.split("\r\n")
+    parts = lines[0].split()
+    if len(parts) != 3:
+        raise HandshakeError(f"无效的请求行: {lines[0]}")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return parts[0], parts[1], headers
+
+
+def negotiate_deflate(header):
+    """接受第一个可用的 permessage-deflate 提议。要求服务器窗口小于15位的不接受，
+    因为广播的压缩结果是按默认窗口缓存共享的"""
+    for offer in header.split(","):
+        params = [p.strip() for p in offer.split(";")]
+        if params[0] != "permessage-deflate":
+            continue
+        names = dict(p.partition("=")[::2] for p in params[1:])
+        bits = names.get("server_max_window_bits", "").strip('"')
+        if bits and bits != "15":
+            continue
+        return True
+    return False
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+
+def unmask(payload, mask):
+    n = len(payload)
+    if not n:
+        return payload
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(n, "big")
+
+
+def handshake(sock, page=None):
+    """完成握手并返回 WebSocketConnection。普通的 GET 请求返回观战页面后抛出 HandshakeError"""
+    method, path, headers = read_request(sock)
+    if headers.get("upgrade", "").lower() != "websocket":
+        if method == "GET" and page is not None:
+            body = page.encode()
+            sock.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        else:
+            sock.sendall(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+        raise HandshakeError(f"不是WebSocket请求: {method} {path}")
+    key = headers.get("sec-websocket-key")
+    if method != "GET" or not key or headers.get("sec-websocket-version") != "13":
+        sock.sendall(b"HTTP/1.1 400 Bad Request\r\nSec-WebSocket-Version: 13\r\nContent-Length: 0\r\n\r\n")
+        raise HandshakeError("无效的WebSocket握手")
+    deflate = negotiate_deflate(headers.get("sec-websocket-extensions", ""))
+    response = ("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept_key(key)}\r\n")
+    if deflate:
+        response += "Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover\r\n"
+    sock.sendall((response + "\r\n").encode())
+    return WebSocketConnection(sock, deflate)
+
+
+class WebSocketConnection:
+    """把 WebSocket 连接包装成 socket 的样子：send 写一条文本消息，recv 读出消息负载"""
+
+    websocket = True
+
+    def __init__(self, sock, deflate=False):
+        self.sock = sock
+        self.deflate = deflate
+        # 客户端可能保留压缩上下文，解压器在整个连接内共用
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS) if deflate else None
+        self.buffer = b""
+        self.send_lock = threading.Lock()
+        self.close_sent = False
+
+    def __getattr__(self, name):
+        # settimeout、shutdown、fileno 等直接交给底层 socket
+        return getattr(self.sock, name)
+
+    def send(self, data, flags=0):
+        if not isinstance(data, WebSocketFrame):
+            data = encode_ws_frame(bytes(data))
+        with self.send_lock:
+            sent = self.sock.send(data, flags) if flags else 0
+            # 帧不能只发一半，非阻塞发送没发完的部分阻塞着补齐
+            self.sock.sendall(data[sent:])
+        return len(data)
+
+    def sendall(self, data, flags=0):
+        self.send(data)
+
+    def _read_exact(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_frame(self):
+        header = self._read_exact(2)
+        if header is None:
+            return None
+        first, second = header
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self._read_exact(2) or b"\0\0")[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self._read_exact(8) or b"\0" * 8)[0]
+        if length > MAX_MESSAGE or not second & 0x80:
+            # 客户端发来的帧必须带掩码
+            return None
+        mask = self._read_exact(4)
+        payload = self._read_exact(length) if length else b""
+        if mask is None or payload is None:
+            return None
+        return first, unmask(payload, mask)
+
+    def _read_message(self):
+        fragments = []
+        compressed = False
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return None
+            first, payload = frame
+            opcode = first & 0x0F
+            if opcode == WS_PING:
+                self.send(encode_ws_frame(payload, opcode=WS_PONG))
+                continue
+            if opcode == WS_PONG:
+                continue
+            if opcode == WS_CLOSE:
+                self._send_close(payload[:2])
+                return None
+            if opcode in (WS_TEXT, WS_BINARY):
+                compressed = bool(first & WS_RSV1)
+                fragments = [payload]
+            else:
+                fragments.append(payload)
+            if sum(len(f) for f in fragments) > MAX_MESSAGE:
+                return None
+            if first & WS_FIN:
+                message = b"".join(fragments)
+                if compressed and self.inflater:
+                    message = self.inflater.decompress(message + b"\x00\x00\xff\xff", MAX_MESSAGE)
+                return message
+
+    def recv(self, bufsize, flags=0):
+        while not self.buffer:
+            message = self._read_message()
+            if message is None:
+                return b""
+            self.buffer = message
+        data, self.buffer = self.buffer[:bufsize], self.buffer[bufsize:]
+        return data
+
+    def _send_close(self, code=b""):
+        if self.close_sent:
+            return
+        self.close_sent = True
+        # 关闭时可能持有服务器的锁，关闭帧只尽力发一次，不等待
+        try:
+            self.sock.send(encode_ws_frame(code or struct.pack(">H", 1000), opcode=WS_CLOSE),
+                           getattr(socket, "MSG_DONTWAIT", 0))
+        except OSError:
+            pass
+
+    def close(self):
+        self._send_close()
+        self.sock.close()
+
+
+SPECTATOR_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>五子棋观战</title>
+<style>body{font-family:sans-serif;display:flex;gap:16px}#log{width:360px;height:600px;overflow-y:auto;border:1px solid #ccc;padding:4px;font-size:13px}</style>
+</head><body>
+<canvas id="board" width="600" height="600"></canvas><div id="log"></div>
+<script>
+const N = 15, C = 40, M = 20, canvas = document.getElementById("board"), ctx = canvas.getContext("2d");
+const log = document.getElementById("log");
+let board = [];
+function add(text) { const d = document.createElement("div"); d.textContent = text; log.appendChild(d); log.scrollTop = log.scrollHeight; }
+function draw() {
+  ctx.fillStyle = "#E6C88C"; ctx.fillRect(0, 0, canvas.width, canvas.height); ctx.strokeStyle = "#000";
+  for (let i = 0; i < N; i++) {
+    ctx.beginPath(); ctx.moveTo(M + i * C, M); ctx.lineTo(M + i * C, M + (N - 1) * C); ctx.stroke();
+    ctx.beginPath(); ctx.moveTo(M, M + i * C); ctx.lineTo(M + (N - 1) * C, M + i * C); ctx.stroke();
+  }
+  board.forEach((row, x) => row.forEach((cell, y) => {
+    if (cell === " ") return;
+    ctx.beginPath(); ctx.arc(M + y * C, M + x * C, C / 2 - 2, 0, 2 * Math.PI);
+    ctx.fillStyle = cell === "B" ? "#000" : "#fff"; ctx.fill(); ctx.stroke();
+  }));
+}
+const params = new URLSearchParams(location.search);
+const ws = new WebSocket((location.protocol === "https:" ? "wss://" : "ws://") + location.host + "/");
+ws.onopen = () => {
+  const login = {type: "login", spectate: true, username: params.get("name") || "web_" + Math.random().toString(36).slice(2, 8)};
+  if (params.get("game")) login.game_id = params.get("game");
+  ws.send(JSON.stringify(login));
+};
+ws.onmessage = (event) => {
+  const m = JSON.parse(event.data);
+  if (m.type === "ping") ws.send(JSON.stringify({type: "pong"}));
+  else if (m.type === "board") { board = m.board; draw(); }
+  else if (m.type === "move_made") { board[m.x][m.y] = m.piece; draw(); add(m.username + " 在 (" + m.x + ", " + m.y + ") 落子"); }
+  else if (m.type === "chat") add(m.username + "(" + m.role + "): " + m.message);
+  else if (m.type === "chat_history") m.history.filter(c => c.audience === "all").forEach(c => add(c.username + "(" + c.role + "): " + c.message));
+  else if (m.message) add(m.message);
+};
+ws.onclose = () => add("连接已断开");
+</script></body></html>
+"""